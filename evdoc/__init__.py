@@ -1,6 +1,16 @@
+import time
+STARTED = time.time()   # When evdoc started, for --profile-startup
+
+# Only the modules needed by every way of running evdoc are imported here.
+# The others are imported where they are first used: ui and app, which need
+# curses, when the editor starts, so batch mode never loads curses, and
+# search, journal and highlight later still.
+import storage
+import undo
+import loop
 import core
-import ui
-import app
+import buffers
+import columns
 import main
 
 VERSION = '0.0.1'
@@ -1,24 +1,126 @@
+import collections
 import curses
 import evdoc
+import evdoc.commands
+import evdoc.ui
+import functools
+import locale
 import os
+import Queue
+import re
+import sys
+import threading
+import time
 
 #==============================================================================
-# A simple logger class
+# A logger that writes to a file from a background thread. Messages are only
+# formatted if their level is enabled, and the most recent records are kept in
+# memory so they can be dumped after a crash.
 #==============================================================================
 
+DEBUG   = 10
+INFO    = 20
+WARNING = 30
+ERROR   = 40
+
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVEL_NAMES = dict((value, name.upper()) for name, value in LEVELS.items())
+
+def format_record(record):
+    "Format a log record, a tuple of (time, level, message, args), as a line"
+    when, level, msg, args = record
+    if args:
+        msg = msg % args
+    stamp = time.strftime('%H:%M:%S', time.localtime(when))
+    return "%s.%03d %-7s %s\n" % (stamp, int(when * 1000) % 1000,
+        LEVEL_NAMES.get(level, level), msg)
+
 class Logger(object):
     DEFAULT_FILE = 'debug.log'
+    CRASH_FILE   = 'crash.log'
+    QUEUE_SIZE   = 10000
+    RING_SIZE    = 1000
 
-    def __init__(self, file=None):
+    def __init__(self, file=None, level=DEBUG):
         self.filename = (file if file else self.DEFAULT_FILE)
-        self.file = open(self.filename, 'w')
+        self.file     = open(self.filename, 'w')
+        self.level    = level
+        self.dropped  = 0
+        self.ring     = collections.deque(maxlen=self.RING_SIZE)
+        self.queue    = Queue.Queue(self.QUEUE_SIZE)
+        self.thread   = threading.Thread(target=self._write_loop,
+            name='evdoc-logger')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def enabled(self, level):
+        "Return true if messages at the given level are logged"
+        return level >= self.level
+
+    def log(self, msg, *args):
+        "Log a debug message. The message is only formatted if it is logged."
+        self._log(DEBUG, msg, args)
+
+    def debug(self, msg, *args):
+        "Log a debug message"
+        self._log(DEBUG, msg, args)
+
+    def info(self, msg, *args):
+        "Log an informational message"
+        self._log(INFO, msg, args)
+
+    def warning(self, msg, *args):
+        "Log a warning"
+        self._log(WARNING, msg, args)
+
+    def error(self, msg, *args):
+        "Log an error"
+        self._log(ERROR, msg, args)
+
+    def _log(self, level, msg, args):
+        '''
+        Queue a record for the writer thread. This never blocks: if the queue
+        is full, the record is counted as dropped.
+        '''
+        if level < self.level:
+            return
+        record = (time.time(), level, msg, args)
+        self.ring.append(record)
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _write_loop(self):
+        "Write queued records to the file, flushing once per batch"
+        done = False
+        while not done:
+            records = [self.queue.get()]
+            while True:
+                try:
+                    records.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            for record in records:
+                if record is None:
+                    done = True
+                    break
+                self.file.write(format_record(record))
+            if self.dropped:
+                self.file.write("(%d messages dropped)\n" % self.dropped)
+                self.dropped = 0
+            self.file.flush()
 
-    def log(self, str):
-        self.file.write(str + "\n")
-        self.file.flush()
+    def dump(self, file=None):
+        "Write the most recent records to a file, by default crash.log"
+        with open(file if file else self.CRASH_FILE, 'w') as out:
+            for record in list(self.ring):
+                out.write(format_record(record))
 
     def close(self):
-        "Close the log file"
+        "Write any queued records and close the log file"
+        self.queue.put(None)
+        self.thread.join()
         self.file.close()
 
 #==============================================================================
@@ -29,16 +131,88 @@ class DummyLogger(object):
     def __init__(self,):
         pass
 
-    def log(self, str):
+    def enabled(self, level):
+        return False
+
+    def log(self, msg, *args):
+        pass
+
+    def debug(self, msg, *args):
+        pass
+
+    def info(self, msg, *args):
+        pass
+
+    def warning(self, msg, *args):
+        pass
+
+    def error(self, msg, *args):
+        pass
+
+    def dump(self, file=None):
         pass
 
     def close(self):
         pass
 
+#==============================================================================
+# Timing of the phases of starting up, for --profile-startup. Phases are timed
+# from when the evdoc package was imported, and the breakdown is printed once
+# curses has stopped. The dummy profile does nothing.
+#==============================================================================
+
+class StartupProfile(object):
+    def __init__(self, start):
+        self.start  = start
+        self.last   = start
+        self.phases = []        # (name, seconds) of each phase so far
+        self.finished = False
+
+    def finish(self):
+        '''
+        Stop timing, once started up. Phases after this, such as those of
+        opening other files, are ignored.
+        '''
+        self.finished = True
+
+    def phase(self, name):
+        "End the current phase of starting up, giving it a name"
+        if self.finished:
+            return
+        now = time.time()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def report(self, file=None):
+        "Print the time taken by each phase, by default to stderr"
+        file = file if file else sys.stderr
+        file.write("Startup profile:\n")
+        for name, seconds in self.phases:
+            file.write("  %-20s %8.1f ms\n" % (name, seconds * 1000))
+        file.write("  %-20s %8.1f ms\n" % ('total',
+            (self.last - self.start) * 1000))
+
+class DummyProfile(object):
+    def phase(self, name):
+        pass
+
+    def finish(self):
+        pass
+
+    def report(self, file=None):
+        pass
+
 #==============================================================================
 # The App class contains all low-level UI classes, plus the main runtime loop.
 #==============================================================================
 
+def match_status(search, y, x):
+    "Describe the matches of a search for the status bar, such as '3/10 matches'"
+    if not search:
+        return ''
+    total = "%d%s" % (search.total(), '' if search.done() else '+')
+    return "%d/%s matches" % (search.rank(y, x + 1), total)
+
 def update_status(app):
     doc = app.editor.document
     y, x = doc.getyx()
@@ -49,16 +223,76 @@ def update_status(app):
     else:
         lines_not_shown = len(doc.lines) - app.layout.editor_rows
         pct = "%d%%" % int(100 * app.editor.scroll_y / lines_not_shown)
-    app.status.update(y, x, pct)
+    app.status.update(y, x, pct,
+        matches=match_status(app.editor.search, y, x))
 
 class App(object):
     running = False
 
-    def __init__(self, args):
+    # Commands that can be typed at the prompt, mapped to the names of the
+    # methods that run them
+    COMMANDS = {
+        'w':    'save',
+        'save': 'save',
+        'goto': 'goto',
+        'u':    'undo',
+        'undo': 'undo',
+        'redo': 'redo',
+        'replace': 'replace',
+        'e':    'edit',
+        'edit': 'edit',
+        'b':    'switch_buffer',
+        'buffer': 'switch_buffer',
+        'ls':   'list_buffers',
+        'buffers': 'list_buffers',
+        'bd':   'close_buffer',
+        'bd!':  'discard_buffer',
+        'grep': 'grep',
+        'rgrep': 'rgrep',
+        'stats': 'show_stats',
+    }
+
+    # While a search is typed, look for a match in at most this many lines,
+    # leaving the rest of the document to the background
+    PREVIEW_LINES = 20000
+
+    def __init__(self, args, buffers=None):
+        '''
+        Set up the app for command line arguments. `buffers` is an
+        evdoc.buffers.BufferList of the files that are open already, such as
+        the one an evdoc.server.Server keeps between sessions.
+        '''
         self.args   = args
-        self.logger = evdoc.app.Logger() if args.debug else evdoc.app.DummyLogger()
-        self.layout = evdoc.ui.Layout()
-        self.screen = None
+        if args.debug or args.logfile:
+            self.logger = evdoc.app.Logger(args.logfile, LEVELS[args.log_level])
+        else:
+            self.logger = evdoc.app.DummyLogger()
+        if args.profile_startup:
+            self.profile = StartupProfile(evdoc.STARTED)
+        else:
+            self.profile = DummyProfile()
+        self.profile.phase('imports, arguments')
+        self.layout     = evdoc.ui.Layout()
+        self.screen     = None
+        self.scheduler  = evdoc.ui.RenderScheduler(self.logger)
+        self.loop       = evdoc.loop.EventLoop(self.logger)
+        self.focused    = None  # The EditBox that gets the keys
+        self.idle_timer = None  # Timer for work to do when the user is idle
+        self.saving     = None  # The Job saving the document, if any
+        self.origin     = None  # The cursor when the prompt was opened
+        self.previewed  = None  # The prompt text last searched for
+        self.journal    = None  # The Journal of the document, if it has a file
+        self.flush_timer = None # Timer for writing the journal
+        self.loading    = None  # The Job loading the file, if any
+        self.editor     = None
+        self.buffer     = None  # The Buffer being shown
+        self.grepping   = None  # The DirectorySearch running, if any
+        self.grep_results = None    # The Buffer it lists its matches in
+        self.stats      = None  # evdoc.stats.KeyTimings, with --stats
+        self.own_buffers = buffers is None
+        if buffers is None:
+            buffers = evdoc.buffers.BufferList(args.memory_budget)
+        self.buffers    = buffers
 
     def _start_curses(self):
         "Start curses, and initialize the `screen` class variable"
@@ -69,12 +303,17 @@ class App(object):
         # http://stackoverflow.com/questions/27372068/
         os.environ.setdefault('ESCDELAY', '25')
 
+        # Use the terminal's encoding, so curses shows UTF-8 text as
+        # characters rather than bytes
+        locale.setlocale(locale.LC_ALL, '')
+
         # Now initialize curses
         self.screen = curses.initscr()
         curses.cbreak()
         curses.noecho()
         self.screen.keypad(1)
         curses.mousemask(curses.ALL_MOUSE_EVENTS)
+        evdoc.ui.init_styles()
         App.running = True
 
     def _stop_curses(self):
@@ -89,25 +328,593 @@ class App(object):
         App.running = False
 
     def redraw(self):
-        "Redraw all windows"
-        # Note: the cursor shows up in the last window that is redrawn
+        "Redraw all windows that changed"
         self.title.update()
         self.frame.update()
         self.editor.update()
         self.status.update()
         self.prompt.update()
-        curses.doupdate()
+        self.scheduler.render()
 
     def resize(self):
         "Update the UI based on a terminal resize"
         self.layout.update()
-        self.logger.log("Resize to %d x %d" % (self.layout.terminal_cols, self.layout.terminal_rows))
+        self.logger.info("Resize to %d x %d", self.layout.terminal_cols, self.layout.terminal_rows)
         self.title.resize(self.layout)
         self.status.resize(self.layout)
         self.prompt.resize(self.layout)
         self.frame.resize(self.layout)
         self.editor.resize(self.layout)
 
+    def open(self, filename):
+        '''
+        Open a file in the editor, or show it if it is open already. A file
+        that does not exist yet is a new file. The file is loaded on a worker
+        thread, so the screen can be drawn meanwhile; keys are left waiting
+        until it is done.
+        '''
+        self.show(self.buffers.open(filename))
+
+    def show(self, buffer):
+        '''
+        Show a buffer in the editor, loading its document if it has none.
+        Other buffers are evicted if the documents no longer fit in the
+        memory budget.
+        '''
+        self._park()
+        first = not buffer.used
+        self.buffers.show(buffer)
+        self.buffer = buffer
+        self.status.update(file=buffer.name(), message='')
+        if buffer.document:
+            self._opened(buffer)
+        elif buffer.filename and not buffer.spill and os.path.exists(
+                buffer.filename):
+            self.status.update(message="Loading...")
+            self.loop.remove_reader(sys.stdin.fileno())
+            self.loading = self.loop.run_in_worker(
+                evdoc.core.Document.STORAGE.load, (buffer.filename,),
+                functools.partial(self._loaded, buffer, first))
+        else:
+            self._opened(buffer, buffer.load() is not None and first)
+
+    def _loaded(self, buffer, first, job):
+        "Called when the file being opened by show() has been loaded"
+        self.loading = None
+        if job.error:
+            if not isinstance(job.error, (IOError, OSError)):
+                raise job.error
+            # Such as a directory or a file that cannot be read. A buffer
+            # shown before is kept, so it can be shown again later.
+            if first:
+                self.buffers.remove(buffer)
+            self._show_recent()
+            self.status.update(message="Open failed: %s" % (
+                job.error.strerror or job.error))
+            if not self.loading:
+                self._ready()
+            return
+        recovered = buffer.load(job.result)
+        self.status.update(message='')
+        self.profile.phase('load file')
+        self._opened(buffer, recovered is not None and first)
+        if not first:
+            # Show where the cursor was left
+            update_status(self)
+        self._ready()
+
+    def _opened(self, buffer, recovered=False):
+        '''
+        Finish showing a buffer, once its document has been loaded.
+        `recovered` tells whether changes from its journal were replayed
+        that the user has not seen yet.
+        '''
+        import evdoc.highlight
+        doc = buffer.document
+        self.editor.set_document(doc)
+        if doc.filename:
+            self.editor.set_highlighter(
+                evdoc.highlight.for_filename(doc.filename))
+        if recovered and doc.modified():
+            self.status.update(message="Recovered unsaved changes")
+        self._start_journal()
+        self.buffers.trim()
+        self.profile.phase('recover journal')
+
+    def _park(self):
+        '''
+        Stop showing the current buffer, such as to show another one. Its
+        changes so far are written to its journal. An empty buffer with no
+        file is closed.
+        '''
+        buffer, self.buffer = self.buffer, None
+        if not buffer or buffer.document is not self.editor.document:
+            return
+        doc = buffer.document
+        buffer.cursor = doc.getyx()
+        if self._stop_journal():
+            buffer.journaled = doc.version
+        if (not doc.filename and not doc.modified() and len(doc.lines) == 1
+                and not doc.lines[0]):
+            self.buffers.remove(buffer)
+
+    def _start_journal(self):
+        "Keep a journal of the changes to the document, for recovering them after a crash"
+        import evdoc.journal
+        doc = self.editor.document
+        if self.journal:
+            self.journal.close(discard=True)
+            self.journal = None
+        if not doc.filename:
+            return
+        self.journal = evdoc.journal.Journal(doc, doc.filename)
+        if doc.modified():
+            self.journal.checkpoint()
+        else:
+            self.journal.begin()
+
+    def _stop_journal(self):
+        '''
+        Write the rest of the journal, and stop keeping it. It is removed if
+        the document has no unsaved changes. Returns true if it was written
+        without errors.
+        '''
+        if not self.journal:
+            return False
+        if self.flush_timer:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        journal, self.journal = self.journal, None
+        journal.close(discard=not journal.doc.modified())
+        return journal.error is None
+
+    def _schedule_flush(self):
+        "Write the changes to the journal after a while, if there are any"
+        if self.journal and self.journal.pending and not self.flush_timer:
+            self.flush_timer = self.loop.call_later(
+                self.journal.FLUSH_INTERVAL, self._flush_journal)
+
+    def _flush_journal(self):
+        self.flush_timer = None
+        if self.journal:
+            self.journal.flush()
+
+    def save(self, filename=''):
+        '''
+        Save the document on a worker thread, showing the progress in the
+        status bar. Editing can go on meanwhile; what is saved is a snapshot
+        of the document as it is now.
+        '''
+        if self.saving:
+            self.status.update(message="Already saving")
+            return
+        doc = self.editor.document
+        snapshot = doc.snapshot()
+        shown = [None]
+
+        def progress(written, total):
+            # Called on the worker thread
+            pct = 100 * written / total
+            if pct != shown[0]:
+                shown[0] = pct
+                self.loop.call_soon_threadsafe(functools.partial(
+                    self.status.update, message="Saving... %d%%" % pct))
+
+        self.saving = self.loop.run_in_worker(snapshot.save,
+            (filename if filename else None, progress),
+            lambda job: self._saved(job, doc, snapshot))
+
+    def _saved(self, job, doc, snapshot):
+        "Called when a save of a document started by save() is done"
+        import evdoc.journal
+        self.saving = None
+        if isinstance(job.error, (IOError, OSError, ValueError)):
+            self.status.update(message="Save failed: %s" % job.error)
+        elif job.error:
+            raise job.error
+        elif doc is not self.editor.document:
+            # Another buffer is shown now. The journal of this one was
+            # written when it was left, and is out of date now.
+            if doc.saved(snapshot) and not doc.modified():
+                evdoc.journal.discard(doc.filename)
+            self.status.update(message="Saved %s" % doc.filename)
+        else:
+            if doc.saved(snapshot):
+                filename = os.path.abspath(doc.filename)
+                if self.journal and self.journal.filename == filename:
+                    self.journal.saved(snapshot)
+                else:
+                    # The document was saved under a new name
+                    self._start_journal()
+            self.status.update(file=doc.filename,
+                message="Saved %d lines" % len(snapshot.lines))
+
+    def goto(self, line):
+        "Move the cursor to the start of a line. A bare number also does this."
+        try:
+            self.editor.goto(int(line))
+        except ValueError:
+            self.status.update(message="Not a line number: %s" % line)
+
+    def undo(self, count=''):
+        "Undo the last edit, or the last `count` edits"
+        self._undo(self.editor.undo, count, "Nothing to undo")
+
+    def redo(self, count=''):
+        "Redo the last edit that was undone, or the last `count` of them"
+        self._undo(self.editor.redo, count, "Nothing to redo")
+
+    def _undo(self, func, count, message):
+        try:
+            count = int(count) if count else 1
+        except ValueError:
+            self.status.update(message="Not a count: %s" % count)
+            return
+        for i in xrange(count):
+            if not func():
+                self.status.update(message=message)
+                break
+
+    def find(self, pattern, forward=True, regex=False, limit=None):
+        '''
+        Search the document for a pattern, showing all of its matches and
+        moving the cursor to the next one, if one is found in `limit` lines.
+        The rest of the document is searched in the background. An empty
+        pattern ends the search.
+        '''
+        if not pattern:
+            self.editor.set_search(None)
+            self.editor.update()
+            update_status(self)
+            return
+        import evdoc.search
+        try:
+            search = evdoc.search.Search(self.editor.document, pattern, regex)
+        except re.error as e:
+            self.editor.set_search(None)
+            self.editor.update()
+            self.status.update(message="Bad pattern: %s" % e)
+            update_status(self)
+            return
+        self.editor.set_search(search)
+        self._find_next(forward, limit)
+
+    def _find_next(self, forward=True, limit=None):
+        "Move to the next match of the search, and show whether there was one"
+        search = self.editor.search
+        found = self.editor.find_next(forward, limit)
+        if not found:
+            self.editor.update()
+        missing = not found and search.done()
+        self.status.update(message="Not found: %s" % search.pattern
+            if missing else '')
+        update_status(self)
+
+    def replace(self, text):
+        "Replace all matches of the search with some text, as one undo step"
+        search = self.editor.search
+        if not search:
+            self.status.update(message="Search for something to replace first")
+            return
+        try:
+            count = search.replace_all(text)
+        except re.error as e:
+            self.status.update(message="Bad replacement: %s" % e)
+            return
+        self.editor.update()
+        self.status.update(message="Replaced %d matches" % count)
+
+    def edit(self, filename):
+        "Open a file in a buffer of its own, or show it if it is open already"
+        if not filename:
+            self.status.update(message="Edit which file?")
+            return
+        self.open(filename)
+
+    def switch_buffer(self, which=''):
+        '''
+        Show another buffer: the one shown before this one, or one given by
+        its number in list_buffers(), or by part of its file name
+        '''
+        if not which:
+            buffer = self.buffers.recent()
+        elif which.isdigit():
+            number = int(which)
+            buffers = list(self.buffers)
+            buffer = buffers[number - 1] if 0 < number <= len(buffers) else None
+        else:
+            matches = [buffer for buffer in self.buffers
+                if which in buffer.name()]
+            buffer = matches[0] if len(matches) == 1 else None
+            if len(matches) > 1:
+                self.status.update(message="More than one buffer matches: %s"
+                    % which)
+                return
+        if not buffer:
+            self.status.update(message="No such buffer: %s" % which
+                if which else "No other buffer")
+            return
+        if buffer is not self.buffer:
+            self.show(buffer)
+
+    def list_buffers(self, arg=''):
+        '''
+        List the buffers in the status bar, by number. The current one is
+        marked with %, those with unsaved changes with +, and those evicted
+        from memory are in parentheses.
+        '''
+        names = []
+        for number, buffer in enumerate(self.buffers, 1):
+            name = buffer.name() if buffer.document else "(%s)" % buffer.name()
+            names.append("%d%s%s %s" % (number,
+                '%' if buffer is self.buffer else '',
+                '+' if buffer.modified() else '', name))
+        self.status.update(message='  '.join(names))
+
+    def close_buffer(self, arg='', force=False):
+        '''
+        Close the current buffer, unless it has unsaved changes, and show the
+        one shown before it. With `force` the changes are thrown away.
+        '''
+        buffer = self.buffer
+        if not buffer or self.loading:
+            return
+        if buffer.modified() and not force:
+            self.status.update(message="Unsaved changes: %s (bd! to discard "
+                "them)" % buffer.name())
+            return
+        if buffer is self.grep_results:
+            self._stop_grep()
+        self._park()
+        if buffer in self.buffers:
+            self.buffers.remove(buffer)
+        self._show_recent()
+
+    def _show_recent(self):
+        "Show the buffer shown most recently, or a new one if there is none"
+        other = self.buffers.recent()
+        if other:
+            self.show(other)
+        else:
+            self.show(self.buffers.add(evdoc.core.Document()))
+
+    def discard_buffer(self, arg=''):
+        "Close the current buffer, throwing away its unsaved changes"
+        self.close_buffer(arg, force=True)
+
+    def grep(self, text, regex=False):
+        '''
+        Search the files in the current directory and below for some text,
+        listing the lines that match in a buffer of their own as they are
+        found. Enter on one of them opens its file there. Without any text,
+        stops the search that is running, keeping what it found so far.
+        '''
+        import evdoc.grep
+        if not text:
+            if not self.grepping:
+                self.status.update(message="Search for what?")
+                return
+            self._stop_grep()
+            self.status.update(message="Search stopped")
+            return
+        try:
+            search = evdoc.grep.DirectorySearch(text, regex)
+        except re.error as e:
+            self.status.update(message="Bad pattern: %s" % e)
+            return
+        self._stop_grep()
+        doc = evdoc.core.Document()
+        doc.append_lines(["Lines matching %s in %s:" % (text, os.getcwd())])
+        doc.move(1, 0)
+        buffer = self.buffers.add(doc, "(%s %s)" % (
+            'rgrep' if regex else 'grep', text))
+        buffer.kind = 'grep'
+        buffer.pinned = True
+        self.grepping = search
+        self.grep_results = buffer
+        search.start(self.loop, functools.partial(self._grep_found, buffer),
+            functools.partial(self._grep_done, search))
+        self.show(buffer)
+        self.status.update(message="Searching...")
+
+    def rgrep(self, pattern):
+        "Like grep(), for a regular expression"
+        self.grep(pattern, regex=True)
+
+    def _grep_found(self, buffer, hits):
+        "Called with matches found by the search started by grep()"
+        import evdoc.grep
+        buffer.document.append_lines([evdoc.grep.format_hit(*hit)
+            for hit in hits])
+        if buffer is self.buffer:
+            self.editor.update()
+        self.status.update(message="Searching... %d matches in %d files"
+            % (self.grepping.hits, self.grepping.files))
+
+    def _grep_done(self, search):
+        "Called when the search started by grep() is done"
+        self._stop_grep()
+        if search.error:
+            self.status.update(message="Search failed: %s" % search.error)
+        else:
+            self.status.update(message="%s%d matches in %d files" % (
+                "Stopped after " if search.truncated() else "Found ",
+                search.hits, search.files))
+
+    def _stop_grep(self, wait=False):
+        "Stop the search started by grep(), if it is running"
+        if self.grepping:
+            self.grepping.cancel(wait)
+            self.grep_results.pinned = False
+            self.grepping = self.grep_results = None
+
+    def _open_hit(self):
+        '''
+        Open the file of the match listed in the line with the cursor, in a
+        buffer of search results, with the cursor at the match
+        '''
+        import evdoc.grep
+        doc = self.editor.document
+        hit = evdoc.grep.parse_hit(doc.lines[doc.getyx()[0]])
+        if not hit:
+            self.status.update(message="Not a match")
+            return
+        filename, y, x = hit
+        buffer = self.buffers.open(filename)
+        buffer.cursor = (y, x)
+        if buffer.document:
+            buffer.document.move(y, x)
+        self.show(buffer)
+
+    def show_stats(self, arg=''):
+        '''
+        Show how long each phase of handling keys has taken, in a buffer of
+        its own, if keys are being timed
+        '''
+        if not self.stats:
+            self.status.update(message="Keys are not being timed (start "
+                "evdoc with --stats)")
+            return
+        doc = evdoc.core.Document()
+        doc.append_lines(self.stats.report())
+        old = [buffer for buffer in self.buffers if buffer.title == '(stats)']
+        self.show(self.buffers.add(doc, '(stats)'))
+        for buffer in old:
+            self.buffers.remove(buffer)
+
+    def _start_stats(self):
+        "Time the phases of handling keys, if asked to on the command line"
+        if not (self.args.stats or self.args.stats_file):
+            return
+        import evdoc.stats
+        self.stats = evdoc.stats.KeyTimings()
+        self.stats.install(self)
+
+    def _export_stats(self):
+        "Write the timings of the phases of handling keys to the file asked for"
+        if not (self.stats and self.args.stats_file):
+            return
+        try:
+            self.stats.export(self.args.stats_file)
+        except (IOError, OSError) as e:
+            sys.stderr.write("evdoc: Could not write %s: %s\n" % (
+                self.args.stats_file, e.strerror or e))
+
+    def _preview_search(self):
+        "Search for the text at the prompt as it is typed, if it is a search"
+        text = self.prompt.contents()
+        if text == self.previewed:
+            return
+        was_search = evdoc.commands.parse_search(
+            self.previewed or '') is not None
+        self.previewed = text
+        search = evdoc.commands.parse_search(text)
+        if search is None and not was_search:
+            return
+        # Each version of the pattern is searched for from where the cursor
+        # was when the prompt was opened
+        self.editor.goto(*self.origin)
+        if search:
+            self.find(*search, limit=App.PREVIEW_LINES)
+        else:
+            self.find('')
+
+    def _cancel_search(self):
+        "Drop the search being typed at the prompt, and put the cursor back"
+        self.editor.set_search(None)
+        self.editor.goto(*self.origin)
+        self.prompt.clear()
+        self.previewed = None
+        update_status(self)
+
+    def focus(self, box):
+        "Send the keys to an EditBox"
+        self.focused = box
+        box.focus()
+
+    def _on_input(self):
+        "Handle the keys that are waiting, drawing once they have been handled"
+        c = self.focused.read_key()
+        while c != -1:
+            self._handle_key(c)
+            c = self.focused.read_key()
+            # Draw once the input that came with this key has been handled
+            self.scheduler.render(c != -1)
+        self._schedule_idle()
+        self._schedule_flush()
+
+    def _handle_key(self, c):
+        "Give a key to the focused EditBox, and act on the keys it leaves to us"
+        box = self.focused
+        if (box is self.editor and c == curses.ascii.LF and
+                self.buffer.kind == 'grep'):
+            self._open_hit()
+            return
+        c = box.handle_key(c)
+        if c is None:
+            if box is self.prompt:
+                self._preview_search()
+            return
+        if c == curses.KEY_RESIZE:
+            self.resize()
+            self.focus(self.editor)
+        elif box is self.editor:
+            if c == curses.ascii.ESC:
+                self.origin = self.editor.document.getyx()
+                self.previewed = None
+                self.focus(self.prompt)
+        else:
+            if c == curses.ascii.LF:
+                self.logger.info("From prompt: %s", self.prompt.contents())
+                self.run_command(self.prompt.contents())
+                self.prompt.clear()
+                update_status(self)
+            elif evdoc.commands.parse_search(
+                    self.prompt.contents()) is not None:
+                self._cancel_search()
+            self.focus(self.editor)
+
+    def _schedule_idle(self):
+        "Do the work left for when the user is idle, once no key comes for a while"
+        if self.idle_timer:
+            self.idle_timer.cancel()
+        self.idle_timer = self.loop.call_later(
+            evdoc.ui.EditBox.IDLE_TIMEOUT / 1000.0, self._on_idle)
+
+    def _on_idle(self):
+        self.idle_timer = None
+        more = self.editor.idle()
+        if self.editor.search:
+            update_status(self)
+        if more:
+            self._schedule_idle()
+
+    def run_command(self, text):
+        '''
+        Run a command typed at the prompt, such as 'w notes.txt', or a search,
+        such as '/word'
+        '''
+        search = evdoc.commands.parse_search(text)
+        if search is not None:
+            # The search was started while it was typed, but perhaps not
+            # far enough to find a match
+            pattern, forward, regex = search
+            if text == self.previewed and self.editor.search:
+                self.editor.goto(*self.origin)
+                self._find_next(forward)
+            else:
+                self.find(pattern, forward, regex)
+            self.previewed = None
+            return
+        command = evdoc.commands.parse_command(text)
+        if not command:
+            return
+        name, arg = command
+        if name not in App.COMMANDS:
+            self.status.update(message="Unknown command: %s" % name)
+            return
+        getattr(self, App.COMMANDS[name])(arg)
+
     def start(self):
         "Initialize curses, draw the UI, and start the main loop"
         input = ''
@@ -115,51 +922,74 @@ class App(object):
         try:
             # Start curses and initialize all curses-based objects
             self._start_curses()
+            self.profile.phase('start curses')
             self.title = evdoc.ui.Title(self.layout, self.logger, evdoc.TITLE)
             self.frame = evdoc.ui.Frame(self.layout, self.logger)
             self.editor = evdoc.ui.Editor(self.layout, self.logger)
             self.editor.set_on_char(update_status, self)
             self.status = evdoc.ui.StatusBar(self.layout, self.logger)
             self.prompt = evdoc.ui.Prompt(self.layout, self.logger)
+            for window in (self.title, self.frame, self.editor, self.status,
+                    self.prompt):
+                self.scheduler.register(window)
+            self._start_stats()
+            self.profile.phase('create windows')
+
+            # Start loading the file, and draw the first frame meanwhile
+            if self.args.file:
+                self.open(self.args.file)
+            else:
+                self.show(self.buffers.add(self.editor.document))
             self.redraw()
 
             # Hack: the title isn't showing on startup. A single call to resize
             # fixes that.
             self.resize()
+            self.focus(self.editor)
+            self.profile.phase('first frame')
+            if not self.loading:
+                self._ready()
 
-            # Run the main loop
-            # TODO: Clean up this while-loop. Too much nesting.
+            # Run the main loop. Keys are read whenever stdin is readable, and
+            # everything that changed is drawn after each round of the loop.
             while True:
-                self.editor.focus()
-                c = self.editor.edit()
-
-                if c == curses.KEY_RESIZE:
-                    self.resize()
-                elif c == curses.ascii.ESC:
-                    self.prompt.focus()
-                    c = self.prompt.edit()
-                    if c == curses.KEY_RESIZE:
-                        self.resize()
-                    elif c == curses.ascii.ESC:
-                        pass
-                    elif c == curses.ascii.LF:
-                        self.logger.log("From prompt: " + self.prompt.contents())
-                        self.prompt.clear()
+                self.loop.run_once()
+                self.scheduler.render()
 
         # Ignore keyboard interrupts and exit cleanly
         except KeyboardInterrupt:
             pass
 
-        # For other interrupts, re-raise them so we can debug
+        # For other interrupts, dump the recent log messages and re-raise
+        # them so we can debug
         except:
+            self.logger.dump()
             raise
 
         # Stop curses before we exit
         finally:
             self.stop()
             self.logger.close()
+            self.profile.report()
+            self._export_stats()
+
+    def _ready(self):
+        "Start reading keys, once the file has been opened"
+        self.loop.add_reader(sys.stdin.fileno(), self._on_input)
+        self._schedule_idle()
+        self.profile.phase('ready')
+        self.profile.finish()
 
     def stop(self):
         "Stop curses and stop the app. You must call this before exiting."
+        self._stop_grep(wait=True)
+        self.loop.close()
+        # Keep the journal if there are unsaved changes, and leave the
+        # buffers as they are for the next session, if there is one
+        self._park()
+        if self.editor:
+            self.editor.close()
+        if self.own_buffers:
+            self.buffers.close()
         if evdoc.app.App.running:
             self._stop_curses()
@@ -0,0 +1,265 @@
+import itertools
+import multiprocessing
+import os
+import re
+import signal
+import sys
+import time
+import evdoc
+import evdoc.commands
+import evdoc.search
+
+#==============================================================================
+# Batch mode, which runs a script of prompt commands on many files without a
+# screen: evdoc --batch SCRIPT FILE... Each line of the script is a command as
+# it would be typed at the prompt, such as 'r/colou?r' then 'replace color'.
+# Lines that are blank or start with '#' are skipped.
+#
+# Each file is loaded, edited and, if it changed, saved in place the way the
+# editor saves, by writing a temporary file and renaming it over the old one.
+# The files are shared out among a pool of worker processes, so the text of
+# each file stays in the process that edits it. Neither curses nor the modules
+# that use it are imported, which keeps starting up the workers cheap.
+#==============================================================================
+
+class ScriptError(Exception):
+    "A batch script that cannot be run, or a command in it that failed"
+
+class Script(object):
+    '''
+    The commands of a batch script, checked once before any file is edited.
+    Each command is a (line number, method name, arguments) tuple, the method
+    being one of BatchEditor's.
+    '''
+    def __init__(self, text, name='script'):
+        self.name     = name
+        self.commands = []
+        searched = None     # The last pattern searched for, compiled
+        for number, line in enumerate(text.splitlines(), 1):
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            where = "%s:%d" % (name, number)
+            search = evdoc.commands.parse_search(line)
+            if search is not None:
+                pattern, forward, regex = search
+                try:
+                    compiled = evdoc.search.compile_pattern(pattern, regex)
+                except re.error as e:
+                    raise ScriptError("%s: Bad pattern: %s" % (where, e))
+                self.commands.append((number, 'find', search))
+                searched = compiled if pattern else None
+                expand = regex
+                continue
+
+            command, arg = evdoc.commands.parse_command(line)
+            if command not in BatchEditor.COMMANDS:
+                raise ScriptError("%s: Unknown command: %s" % (where, command))
+            method = BatchEditor.COMMANDS[command]
+            if method == 'goto':
+                arg = self._number(arg, where, "Not a line number")
+            elif method in ('undo', 'redo'):
+                arg = self._number(arg or '1', where, "Not a count")
+            elif method == 'replace' and not searched:
+                raise ScriptError("%s: Search for something to replace first"
+                    % where)
+            elif method == 'replace' and expand:
+                try:
+                    evdoc.search.check_template(searched, arg)
+                except re.error as e:
+                    raise ScriptError("%s: Bad replacement: %s" % (where, e))
+            self.commands.append((number, method, (arg,)))
+
+    @staticmethod
+    def _number(arg, where, message):
+        try:
+            return int(arg)
+        except ValueError:
+            raise ScriptError("%s: %s: %s" % (where, message, arg))
+
+    @classmethod
+    def load(cls, filename):
+        "Read a script from a file, or from stdin if the name is '-'"
+        if filename == '-':
+            return cls(sys.stdin.read(), '<stdin>')
+        try:
+            with open(filename) as f:
+                return cls(f.read(), filename)
+        except (IOError, OSError) as e:
+            raise ScriptError("%s: %s" % (filename, e.strerror))
+
+class BatchEditor(object):
+    '''
+    Runs the commands of a Script on a Document, doing what the app does for
+    them at the prompt, minus the screen
+    '''
+    # The commands that can be run, mapped to the methods that run them. Those
+    # that switch between buffers only make sense in the editor.
+    COMMANDS = {
+        'w':    'save',
+        'save': 'save',
+        'goto': 'goto',
+        'u':    'undo',
+        'undo': 'undo',
+        'redo': 'redo',
+        'replace': 'replace',
+    }
+
+    def __init__(self, document):
+        self.document = document
+        self.filename = document.filename   # The file being edited
+        self.search   = None
+        self.changed  = False   # Whether that file was saved with changes
+
+    def run(self, script):
+        "Run all the commands of a script. Raises ScriptError if one fails."
+        for number, method, args in script.commands:
+            try:
+                getattr(self, method)(*args)
+            except (IOError, OSError) as e:
+                raise ScriptError("%s:%d: %s" % (script.name, number,
+                    e.strerror or e))
+            except re.error as e:
+                raise ScriptError("%s:%d: %s" % (script.name, number, e))
+
+    def close(self):
+        "Stop searching, so the document can be freed"
+        if self.search:
+            self.search.close()
+            self.search = None
+
+    def find(self, pattern, forward, regex):
+        "Move the cursor to the next match of a pattern, if any"
+        self.close()
+        if not pattern:
+            return
+        self.search = evdoc.search.Search(self.document, pattern, regex)
+        y, x = self.document.getyx()
+        match = self.search.find(y, x, forward)
+        if match:
+            self.document.move(match[0], match[1])
+
+    def save(self, filename=''):
+        "Save the document, to another file if one is given"
+        doc = self.document
+        doc.save(filename or None)
+        if (os.path.abspath(doc.filename) == os.path.abspath(self.filename)
+                and doc.version != doc.reset_version):
+            self.changed = True
+
+    def goto(self, line):
+        self.document.move(line, 0)
+
+    def undo(self, count):
+        for i in xrange(count):
+            if not self.document.undo():
+                break
+
+    def redo(self, count):
+        for i in xrange(count):
+            if not self.document.redo():
+                break
+
+    def replace(self, text):
+        self.search.replace_all(text)
+
+def edit(script, filename):
+    '''
+    Run a script on a file, and save the file if it was changed and not
+    saved by the script. Once the script has saved the document to another
+    file with 'w NAME', later changes are left unsaved. Returns true if the
+    file was saved with changes.
+    '''
+    doc = evdoc.core.Document()
+    try:
+        doc.load(filename)
+    except (IOError, OSError) as e:
+        raise ScriptError(e.strerror or str(e))
+    editor = BatchEditor(doc)
+    try:
+        editor.run(script)
+        if doc.modified() and doc.filename == filename:
+            try:
+                editor.save()
+            except (IOError, OSError) as e:
+                raise ScriptError(e.strerror or str(e))
+    finally:
+        editor.close()
+    return editor.changed
+
+#------------------------------------------------------------------------------
+# Running a script on many files
+#------------------------------------------------------------------------------
+
+# The script run by this process, when it is a worker
+_script = None
+
+def _start_worker(script):
+    global _script
+    _script = script
+    # Ctrl-C is for the parent, which stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _edit(filenames):
+    "Edit files with the worker's script, returning (filename, changed, error) for each"
+    results = []
+    for filename in filenames:
+        try:
+            results.append((filename, edit(_script, filename), None))
+        except ScriptError as e:
+            results.append((filename, False, str(e)))
+    return results
+
+def run(script, filenames, jobs=None):
+    '''
+    Run a script on some files, in `jobs` processes at once, one per CPU by
+    default. The names of the files changed are printed, and errors and a
+    summary are printed to stderr. Returns the number of files that failed.
+    '''
+    jobs = min(jobs or multiprocessing.cpu_count(), len(filenames))
+    start = time.time()
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, _start_worker, (script,))
+        # Enough files per task that handing them out costs little, but few
+        # enough that the workers finish at about the same time. They are
+        # handed out as lists, since with a chunksize imap_unordered()
+        # returns an iterator that cannot be waited on with a timeout.
+        size = max(1, min(64, len(filenames) // (jobs * 8)))
+        chunks = [filenames[i:i + size]
+            for i in xrange(0, len(filenames), size)]
+        results = pool.imap_unordered(_edit, chunks)
+    else:
+        _start_worker(script)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        results = itertools.imap(_edit, ([filename] for filename in filenames))
+
+    changed = failed = 0
+    try:
+        while True:
+            try:
+                # With a timeout, waiting can be interrupted by Ctrl-C
+                edits = results.next(1 << 20) if pool else results.next()
+            except StopIteration:
+                break
+            for filename, edited, error in edits:
+                if error:
+                    failed += 1
+                    sys.stderr.write("evdoc: %s: %s\n" % (filename, error))
+                elif edited:
+                    changed += 1
+                    sys.stdout.write(filename + "\n")
+    except KeyboardInterrupt:
+        if pool:
+            pool.terminate()
+            pool.join()
+        raise
+    if pool:
+        pool.close()
+        pool.join()
+
+    elapsed = time.time() - start
+    sys.stdout.flush()
+    sys.stderr.write("Changed %d of %d files, %d failed, in %.2f s "
+        "(%.0f files/s)\n" % (changed, len(filenames), failed, elapsed,
+        len(filenames) / elapsed if elapsed else 0))
+    return failed
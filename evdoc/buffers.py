@@ -0,0 +1,248 @@
+import os
+import tempfile
+import evdoc
+
+#==============================================================================
+# The files open in the editor. Each one is a Buffer, of which the editor
+# shows one at a time. The documents of the others stay in memory while they
+# fit in a budget, so switching back to them is instant; past it, those shown
+# least recently are evicted, and loaded again when next shown.
+#
+# Evicting a document keeps its text on disk rather than in memory. A
+# document with no unsaved changes is already in its file. One with unsaved
+# changes is in its journal, which is brought up to date first if need be,
+# so it comes back the way a document does after a crash. One that has no
+# file is written to a temporary file. Either way the text is memory-mapped
+# when loaded again, so even a huge buffer comes back quickly. Its undo
+# history is lost, however.
+#==============================================================================
+
+class Buffer(object):
+    '''
+    A file open in the editor, or a document that has no file yet. Its
+    Document is None while it is evicted. A buffer with a title instead of a
+    file holds text of the editor's own, such as the results of a search,
+    whose changes are never unsaved.
+    '''
+    def __init__(self, filename=None, document=None, title=None):
+        self.filename  = filename   # As given, which may be relative
+        self.document  = document
+        self.title     = title
+        self.kind      = None       # What a titled buffer holds, such as 'grep'
+        self.pinned    = False      # Never evicted while true
+        self.cursor    = (0, 0)     # Where the cursor was when last shown
+        self.changed   = False      # Whether it had unsaved changes when evicted
+        self.spill     = None       # The temporary file holding its text, if any
+        self.journaled = None       # The version of the document in its journal
+        self.identity  = None       # The identity of the file when loaded
+        self.saved_version = None   # The document's saved version then
+        self.size      = 0          # The memory the document took when measured
+        self.measured  = None       # The version of the document then
+        self.used      = 0          # When it was last shown, as a count
+
+    def name(self):
+        "Return the name of the buffer's file as shown to the user"
+        filename = self.document.filename if self.document else self.filename
+        return filename if filename else self.title or '(new file)'
+
+    def path(self):
+        "Return the absolute name of the buffer's file, or None if it has none"
+        filename = self.document.filename if self.document else self.filename
+        return os.path.abspath(filename) if filename else None
+
+    def modified(self):
+        "Return true if the buffer has unsaved changes"
+        if self.title and not self.path():
+            return False
+        return self.document.modified() if self.document else self.changed
+
+    def load(self, lines=None):
+        '''
+        Load the document of a buffer that has none, with the cursor where it
+        was. `lines` are those of its file, if they have been read already
+        with Document.STORAGE.load(), such as on another thread. Changes in
+        the journal are replayed; returns the number replayed, as
+        evdoc.journal.recover() does.
+        '''
+        import evdoc.journal
+        doc = evdoc.core.Document()
+        recovered = None
+        if self.spill:
+            doc.load(self.spill)
+            doc.filename = None
+            doc.saved_version = None
+            # The mapping keeps the text for as long as it is needed
+            os.unlink(self.spill)
+            self.spill = None
+        elif self.filename:
+            if lines is not None or os.path.exists(self.filename):
+                doc.load(self.filename, lines)
+            else:
+                doc.filename = self.filename
+            recovered = evdoc.journal.recover(doc, self.filename)
+            if recovered is not None:
+                doc.filename = self.filename
+                self.journaled = doc.version
+            self.identity = evdoc.journal.file_identity(self.filename)
+        self.saved_version = doc.saved_version
+        doc.move(*self.cursor)
+        self.document = doc
+        return recovered
+
+    def evict(self):
+        '''
+        Drop the document, keeping its text on disk. Returns false if it
+        could not be written, in which case the document is kept.
+        '''
+        import evdoc.journal
+        doc = self.document
+        self.filename = doc.filename
+        self.changed = doc.modified()
+        if self.changed and doc.filename:
+            if self.journaled != doc.version or not evdoc.journal.has_journal(
+                    doc.filename):
+                journal = evdoc.journal.Journal(doc, doc.filename)
+                journal.checkpoint()
+                journal.close()
+                if journal.error:
+                    return False
+        elif self.changed:
+            fd, name = tempfile.mkstemp(prefix='evdoc-', suffix='.spill')
+            os.close(fd)
+            try:
+                doc.snapshot().save(name)
+            except (IOError, OSError):
+                os.unlink(name)
+                return False
+            self.spill = name
+        self.cursor = doc.getyx()
+        self.journaled = None
+        self.measured = None
+        self.document = None
+        return True
+
+    def stale(self):
+        '''
+        Return true if the buffer's file was changed by something else since
+        it was loaded, and the buffer has no unsaved changes that loading it
+        again would lose
+        '''
+        import evdoc.journal
+        doc = self.document
+        if not doc or not doc.filename or doc.modified():
+            return False
+        identity = evdoc.journal.file_identity(doc.filename)
+        if doc.saved_version != self.saved_version:
+            # Saved by the editor since, so the file is as it should be
+            self.saved_version = doc.saved_version
+            self.identity = identity
+            return False
+        return identity != self.identity
+
+    def measure(self):
+        "Return about how many bytes of memory the document takes"
+        if self.measured != self.document.version:
+            self.size = self.document.memory_size()
+            self.measured = self.document.version
+        return self.size
+
+class BufferList(object):
+    '''
+    The buffers open in the editor, in the order they were opened, and the
+    one being shown. The documents of the buffers are kept within a memory
+    budget by trim().
+    '''
+    # The memory the documents of all buffers may take, in bytes
+    BUDGET = 256 << 20
+
+    def __init__(self, budget=None):
+        self.budget  = budget if budget is not None else BufferList.BUDGET
+        self.buffers = []
+        self.current = None     # The Buffer being shown
+        self.clock   = 0        # Counts the buffers shown
+
+    def __len__(self):
+        return len(self.buffers)
+
+    def __iter__(self):
+        return iter(self.buffers)
+
+    def find(self, filename):
+        "Return the buffer of a file, or None if it is not open"
+        path = os.path.abspath(filename)
+        for buffer in self.buffers:
+            if buffer.path() == path:
+                return buffer
+        return None
+
+    def open(self, filename):
+        "Return the buffer of a file, adding one with no document if it is not open"
+        buffer = self.find(filename)
+        if not buffer:
+            buffer = Buffer(filename)
+            self.buffers.append(buffer)
+        return buffer
+
+    def add(self, document, title=None):
+        "Add a buffer for a document that is already open, and return it"
+        buffer = Buffer(document.filename, document, title)
+        self.buffers.append(buffer)
+        return buffer
+
+    def show(self, buffer):
+        "Record that a buffer is being shown"
+        self.clock += 1
+        buffer.used = self.clock
+        self.current = buffer
+
+    def recent(self):
+        "Return the buffer shown most recently, other than the current one, or None"
+        others = [buffer for buffer in self.buffers
+            if buffer is not self.current]
+        return max(others, key=lambda buffer: buffer.used) if others else None
+
+    def remove(self, buffer):
+        '''
+        Close a buffer, throwing away any unsaved changes, including those
+        in its journal or temporary file
+        '''
+        import evdoc.journal
+        self.buffers.remove(buffer)
+        if buffer is self.current:
+            self.current = None
+        if buffer.modified() and buffer.path():
+            evdoc.journal.discard(buffer.path())
+        if buffer.spill:
+            os.unlink(buffer.spill)
+            buffer.spill = None
+
+    def memory_size(self):
+        "Return about how many bytes of memory the documents of all buffers take"
+        return sum(buffer.measure() for buffer in self.buffers
+            if buffer.document)
+
+    def trim(self):
+        '''
+        Evict the documents of the buffers shown least recently until all of
+        them fit in the budget. The current buffer is never evicted. Returns
+        the number evicted. Neither are pinned buffers.
+        '''
+        total = self.memory_size()
+        evicted = 0
+        for buffer in sorted(self.buffers, key=lambda buffer: buffer.used):
+            if total <= self.budget:
+                break
+            if buffer is self.current or buffer.pinned or not buffer.document:
+                continue
+            size = buffer.size
+            if buffer.evict():
+                total -= size
+                evicted += 1
+        return evicted
+
+    def close(self):
+        "Remove the temporary files of all buffers, such as when the editor quits"
+        for buffer in self.buffers:
+            if buffer.spill:
+                os.unlink(buffer.spill)
+                buffer.spill = None
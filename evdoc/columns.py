@@ -0,0 +1,251 @@
+import bisect
+import collections
+import re
+import unicodedata
+
+#==============================================================================
+# Display columns of lines. Lines are UTF-8 byte strings, in which a character
+# may take several bytes, and zero, one or two cells on the screen: combining
+# marks take none, and wide characters such as CJK ones take two. Tabs take
+# up to the next tab stop. Control characters and bytes that are not valid
+# UTF-8 are shown as '?'.
+#
+# A LineColumns maps between byte offsets in a line and display columns. The
+# line is split into chunks of about CHUNK_SIZE bytes, and the column where
+# each chunk starts is kept, so a lookup finds its chunk with a binary search
+# and only walks the characters within it. Chunks of plain ASCII, which most
+# are, need no walking at all, and neither do other chunks without tabs or
+# control characters to measure. The chunks are only measured as far as a
+# lookup needs, so the start of a huge line is cheap to show.
+#==============================================================================
+
+TAB_WIDTH = 8
+CHUNK_SIZE = 1024
+
+# The bytes that are one character one column wide
+_PLAIN = ''.join(chr(c) for c in xrange(0x20, 0x7f))
+_PLAIN_RUN = re.compile('[ -~]+')
+# The bytes that are shown as themselves or are part of UTF-8 characters
+_TEXT = _PLAIN + ''.join(chr(c) for c in xrange(0x80, 0x100))
+_NON_ASCII = re.compile(u'[^\x00-\x7f]')
+
+# The widths of the characters seen so far
+_widths = {}
+
+def char_width(char):
+    "Return the number of columns a unicode character takes"
+    width = _widths.get(char)
+    if width is None:
+        if unicodedata.combining(char) or unicodedata.category(char) in (
+                'Mn', 'Me', 'Cf'):
+            width = 0
+        elif unicodedata.east_asian_width(char) in ('W', 'F'):
+            width = 2
+        else:
+            width = 1
+        _widths[char] = width
+    return width
+
+def _utf8_length(byte):
+    "Return the length of the UTF-8 sequence that starts with a byte, or 1 if it cannot start one"
+    code = ord(byte)
+    if 0xc2 <= code < 0xe0:
+        return 2
+    if 0xe0 <= code < 0xf0:
+        return 3
+    if 0xf0 <= code < 0xf5:
+        return 4
+    return 1
+
+def is_plain(line):
+    "Return true if every byte of a line is a character one column wide"
+    return not line.translate(None, _PLAIN)
+
+def text_width(text):
+    '''
+    Return the width of a string of UTF-8 characters with no tabs or control
+    characters, without going through its characters one by one. Returns
+    None for any other string.
+    '''
+    if text.translate(None, _TEXT):
+        return None
+    try:
+        text = text.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    wide = _NON_ASCII.findall(text)
+    return len(text) + sum(map(char_width, wide)) - len(wide)
+
+class LineColumns(object):
+    '''
+    Maps between byte offsets and display columns in a line. Offsets within
+    a character count as the offset of the character.
+    '''
+    def __init__(self, line):
+        self.line    = line
+        self.offsets = [0]      # The offset where each chunk starts
+        self.columns = [0]      # The column where each chunk starts
+        self.plain   = []       # Whether each chunk is plain ASCII
+
+    def _chars(self, x, col, end):
+        '''
+        Iterate over the characters from offset x, at column col, to offset
+        `end`, as tuples of (offset, length, column, width, text). A run of
+        plain ASCII comes as one item whose length and width are equal, which
+        is never the case for a single character of more than one byte.
+        '''
+        line = self.line
+        plain_run = _PLAIN_RUN.match
+        while x < end:
+            match = plain_run(line, x, end)
+            if match:
+                text = match.group()
+                yield x, len(text), col, len(text), text
+                x += len(text)
+                col += len(text)
+                continue
+            c = line[x]
+            length = 1
+            if c == '\t':
+                width = TAB_WIDTH - col % TAB_WIDTH
+                text = ' ' * width
+            elif c < '\x80':
+                width, text = 1, '?'
+            else:
+                length = _utf8_length(c)
+                try:
+                    text = line[x:x+length].decode('utf-8')
+                    width = char_width(text)
+                except UnicodeDecodeError:
+                    length, width, text = 1, 1, '?'
+            yield x, length, col, width, text
+            x += length
+            col += width
+
+    def _measure(self):
+        "Measure the next chunk. Returns false if the whole line has been measured."
+        line = self.line
+        x, col = self.offsets[-1], self.columns[-1]
+        if x >= len(line):
+            return False
+        end = min(x + CHUNK_SIZE, len(line))
+        if end < len(line):
+            # Move the end back to the start of a character. More than three
+            # continuation bytes cannot all be in one character.
+            for back in xrange(4):
+                if not '\x80' <= line[end - back] < '\xc0':
+                    end -= back
+                    break
+        chunk = line[x:end]
+        if is_plain(chunk):
+            self.plain.append(True)
+            self.offsets.append(end)
+            self.columns.append(col + end - x)
+            return True
+
+        self.plain.append(False)
+        width = text_width(chunk)
+        if width is None:
+            width = sum(item[3] for item in self._chars(x, col, end))
+        self.offsets.append(end)
+        self.columns.append(col + width)
+        return True
+
+    def _chunk(self, points, value):
+        "Return the chunk holding an offset or column, measuring chunks up to it"
+        while points[-1] <= value and self._measure():
+            pass
+        return min(bisect.bisect_right(points, value) - 1, len(self.plain) - 1)
+
+    def column(self, x):
+        "Return the column where the character at offset x starts"
+        if x <= 0 or not self.line:
+            return 0
+        i = self._chunk(self.offsets, x)
+        if i < 0:
+            return 0
+        start, col = self.offsets[i], self.columns[i]
+        if x >= self.offsets[i+1]:
+            return self.columns[i+1]
+        if self.plain[i]:
+            return col + x - start
+        width = text_width(self.line[start:x])
+        if width is not None:
+            return col + width
+        for offset, length, col, width, text in self._chars(start, col, x + 1):
+            if offset + length > x:
+                if length == width:
+                    return col + x - offset
+                return col if offset == x else col + width
+        return col
+
+    def offset(self, col):
+        '''
+        Return the offset of the character shown at a column, or the end of
+        the line if it is shorter
+        '''
+        if col <= 0 or not self.line:
+            return 0
+        i = self._chunk(self.columns, col)
+        if i < 0:
+            return 0
+        start, first = self.offsets[i], self.columns[i]
+        if col >= self.columns[i+1]:
+            return self.offsets[i+1]
+        if self.plain[i]:
+            return start + col - first
+        for offset, length, column, width, text in self._chars(start, first,
+                self.offsets[i+1]):
+            if column + width > col:
+                return offset + col - column if length == width else offset
+        return self.offsets[i+1]
+
+    def render(self, col, width):
+        '''
+        Return the UTF-8 text that shows columns [col, col + width) of the
+        line. Characters cut by either edge are shown as spaces.
+        '''
+        end_col = col + width
+        x = self.offset(col)
+        i = self._chunk(self.offsets, x)
+        if i >= 0 and self.plain[i] and (self.offsets[i+1] - x >= width or
+                self.offsets[i+1] == len(self.line)):
+            return self.line[x:x + width]
+        pieces = []
+        for offset, length, column, width, text in self._chars(x,
+                self.column(x), len(self.line)):
+            if column >= end_col:
+                break
+            if column < col or column + width > end_col:
+                # Cut by an edge
+                if length == width:
+                    text = text[max(col - column, 0):end_col - column]
+                else:
+                    text = ' ' * (min(column + width, end_col) -
+                        max(column, col))
+            pieces.append(text)
+        return u''.join(pieces).encode('utf-8') if pieces else ''
+
+class ColumnCache(object):
+    '''
+    The LineColumns of the longest lines recently shown, which are the
+    costly ones to measure. Lines of one chunk or less are measured anew
+    each time.
+    '''
+    SIZE = 64
+
+    def __init__(self):
+        self.cache = collections.OrderedDict()  # y -> LineColumns
+
+    def get(self, y, line):
+        "Return the LineColumns for line y, whose text is `line`"
+        if len(line) <= CHUNK_SIZE:
+            return LineColumns(line)
+        columns = self.cache.pop(y, None)
+        if columns is None or (columns.line is not line and
+                columns.line != line):
+            columns = LineColumns(line)
+        self.cache[y] = columns
+        if len(self.cache) > ColumnCache.SIZE:
+            self.cache.popitem(last=False)
+        return columns
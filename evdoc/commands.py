@@ -0,0 +1,32 @@
+#==============================================================================
+# The language of the commands typed at the prompt, which batch mode runs from
+# scripts too. A command is either a search, which starts with one of the
+# prefixes in SEARCHES, or a name and an argument separated by a space, such
+# as 'w notes.txt'. A bare number is short for 'goto' that line.
+#==============================================================================
+
+# Searches start with one of these, which is mapped to whether to search
+# forward, and whether the pattern is a regular expression
+SEARCHES = {
+    '/':  (True,  False),
+    '?':  (False, False),
+    'r/': (True,  True),
+    'r?': (False, True),
+}
+
+def parse_search(text):
+    "Return (pattern, forward, regex) for a search such as '/word', or None"
+    for prefix in sorted(SEARCHES, key=len, reverse=True):
+        if text.startswith(prefix):
+            forward, regex = SEARCHES[prefix]
+            return text[len(prefix):], forward, regex
+    return None
+
+def parse_command(text):
+    "Return (name, argument) for a command other than a search, or None if it is blank"
+    name, _, arg = text.strip().partition(' ')
+    if not name:
+        return None
+    if name.isdigit():
+        name, arg = 'goto', name
+    return name, arg.strip()
@@ -1,18 +1,154 @@
-import curses.ascii
+import bisect
+import collections
+import functools
+import itertools
+import os
+import evdoc.storage
+import evdoc.undo
+
+def _undoable(kind):
+    '''
+    Decorator for Document methods that edit it, which makes all of the
+    changes made by one call a single step in the undo history. Successive
+    steps of the same kind, such as typed characters, may be merged.
+    '''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args):
+            self.history.begin(kind, self.getyx())
+            try:
+                return method(self, *args)
+            finally:
+                self.history.end(self.getyx())
+        return wrapper
+    return decorator
+
+def _is_continuation(c):
+    "Return true if c is a byte that continues a UTF-8 character"
+    return '\x80' <= c < '\xc0'
+
+def char_start(line, x):
+    "Return the offset of the start of the UTF-8 character before offset x"
+    start = x - 1
+    while start > max(x - 4, 0) and _is_continuation(line[start]):
+        start -= 1
+    return max(start, 0)
+
+def char_end(line, x):
+    "Return the offset of the end of the UTF-8 character at offset x"
+    end = x + 1
+    while end < min(x + 4, len(line)) and _is_continuation(line[end]):
+        end += 1
+    return min(end, len(line))
 
 #==============================================================================
 # Basic document object, with lines separated
 #==============================================================================
 
 class Document(object):
-    def __init__(self):
-        self.clear()
+    # The storage engine used for the lines of new documents. Any class from
+    # evdoc.storage will do.
+    STORAGE = evdoc.storage.RopeStorage
+    SAVE_BUFFER_SIZE = 1 << 20
+    # The most text, in bytes, that the undo history keeps
+    UNDO_LIMIT = 32 << 20
+    # The number of recent changes kept for mapping lines of old versions
+    CHANGE_LOG = 10000
+    # apply_edits() makes separate changes for edits with at least this many
+    # untouched lines between them
+    EDIT_GAP = 64
+
+    def __init__(self, storage=None):
+        self.storage       = storage if storage else Document.STORAGE
+        self.filename      = None
+        self.listeners     = []
+        self.lines         = self.storage([''])
+        self.history       = evdoc.undo.History(Document.UNDO_LIMIT)
+        self.version       = 0      # Incremented by every change
+        self.changes       = collections.deque(maxlen=Document.CHANGE_LOG)
+        self.reset_version = 0      # The version when last cleared or loaded
+        self.saved_version = 0      # The version when last saved
+        self.y             = 0
+        self.x             = 0
+
+    def add_listener(self, func):
+        '''
+        Call func(start, end, count) after every change to the document,
+        meaning that the lines in the range [start, end) were replaced by
+        `count` new lines.
+        '''
+        self.listeners.append(func)
+
+    def remove_listener(self, func):
+        "Stop calling a function added with add_listener()"
+        self.listeners.remove(func)
 
     def clear(self):
         "Clear the document of all contents"
-        self.lines = ['']
-        self.y = 0
-        self.x = 0
+        self._reset(self.storage(['']))
+
+    def load(self, filename, lines=None):
+        '''
+        Replace the contents of the document with those of a file, and move
+        the cursor to the top. With the rope storage engine the file is
+        memory-mapped, so opening even a huge file is fast. The lines may be
+        given if they have already been read with self.storage.load(), such
+        as on another thread.
+        '''
+        if lines is None:
+            lines = self.storage.load(filename)
+        self._reset(lines)
+        self.filename = filename
+
+    def save(self, filename=None, progress=None):
+        '''
+        Save the document to a file, or to the file it was loaded from. See
+        Snapshot.save(), which this calls on a snapshot of the document.
+        '''
+        snapshot = self.snapshot()
+        snapshot.save(filename, progress)
+        self.saved(snapshot)
+
+    def snapshot(self):
+        "Return a Snapshot of the current version of the document"
+        return Snapshot(self)
+
+    def saved(self, snapshot):
+        '''
+        Record that a snapshot of the document was saved, perhaps by another
+        thread while the document was edited. Returns false if the document
+        was cleared or loaded from a file since the snapshot was taken.
+        '''
+        if snapshot.version < self.reset_version:
+            return False
+        self.filename = snapshot.filename
+        self.saved_version = snapshot.version
+        return True
+
+    def modified(self):
+        "Return true if the document changed since it was loaded or saved"
+        return self.version != self.saved_version
+
+    def memory_size(self):
+        "Return about how many bytes of memory the lines and undo history take"
+        return self.lines.memory_size() + self.history.size
+
+    def map_line(self, y, version):
+        '''
+        Map line y of an earlier version of the document, such as that of a
+        snapshot, to its line number now. Returns None if the line has been
+        changed or deleted since, or if the version is too old to tell.
+        '''
+        first = self.version - len(self.changes)
+        if version < first:
+            return None
+        changes = itertools.islice(self.changes, version - first, None)
+        for change_version, start, end, count in changes:
+            if y >= end:
+                y += count - (end - start)
+            elif y >= start:
+                return None
+        return y
 
     def getyx(self):
         "Return the cursor location as (y,x)"
@@ -40,7 +176,7 @@ class Document(object):
     def move_left(self):
         "Move the cursor left, if possible"
         if self.x > 0:
-            self.move(self.y, self.x-1)
+            self.move(self.y, char_start(self.lines[self.y], self.x))
         elif self.y > 0:
             self.move(self.y-1, self.x)
             self.move(self.y, self.max_x())
@@ -48,7 +184,7 @@ class Document(object):
     def move_right(self):
         "Move the cursor right, if possible"
         if self.x < self.max_x():
-            self.move(self.y, self.x+1)
+            self.move(self.y, char_end(self.lines[self.y], self.x))
         elif self.y < self.max_y():
             self.move(self.y+1, 0)
 
@@ -60,57 +196,240 @@ class Document(object):
         "Return the highest value for x for the cursor on the current line"
         return len(self.lines[self.y]) if len(self.lines) > 0 else 0
 
+    @_undoable('insert')
     def addch(self, c):
         '''
         Insert a character at the current cursor location. Ignores
-        non-printable characters.
+        non-printable characters other than tabs. Bytes of UTF-8 characters
+        are inserted as they are.
         '''
         if type(c) == int:
             c = chr(c)
         if c == "\n":
             self._insert_new_line()
-        elif curses.ascii.isprint(c):
+        elif c == "\t" or c >= "\x80" or " " <= c <= "~":
             self._insert_string(c)
 
+    @_undoable('insert')
     def addstr(self, str):
-        "Insert a string at the current cursor location. Handles newline chars."
-        start = 0
-        length = len(str)
-        while start < length:
-            # Look for the next newline, or end of string
-            end = start
-            while end < length and str[end] != "\n":
-                end += 1
-            # Insert the string, and optionally a newline
-            self._insert_string(str[start:end])
-            if end < length and str[end] == "\n":
-                self._insert_new_line()
-            start = end + 1
+        '''
+        Insert a string at the current cursor location. Handles newline chars.
+        The string is split once and all of its lines are spliced into the
+        document with a single structural change.
+        '''
+        new_lines = str.split("\n")
+        if len(new_lines) == 1:
+            self._insert_string(str)
+            return
+
+        # The first new line is joined to the left side of the current line,
+        # and the last new line to its right side
+        line = self.lines[self.y]
+        last = new_lines[-1]
+        new_lines[0] = line[:self.x] + new_lines[0]
+        new_lines[-1] = last + line[self.x:]
+        self._replace_lines(self.y, self.y+1, new_lines)
+
+        # Move the cursor to the end of the inserted text
+        self.y += len(new_lines) - 1
+        self.x = len(last)
 
+    @_undoable('delete')
     def backspace(self):
         "Delete the character to the left of the cursor"
         if self.x == 0:
             if self.y != 0:
                 new_x = len(self.lines[self.y-1])
                 new_y = self.y-1
-                self.lines[self.y-1] += self.lines[self.y]
-                self.lines = self.lines[:self.y] + self.lines[self.y+1:]
+                joined = self.lines[self.y-1] + self.lines[self.y]
+                self._replace_lines(self.y-1, self.y+1, [joined])
                 self.move(new_y, new_x)
         else:
             s = self.lines[self.y]
-            self.lines[self.y] = s[:self.x-1] + s[self.x:]
-            self.x -= 1
+            x = char_start(s, self.x)
+            self._set_line(self.y, s[:x] + s[self.x:])
+            self.x = x
 
+    @_undoable('delete')
     def delete(self):
         "Delete the character at the cursor"
         max_y = len(self.lines) - 1
         max_x = len(self.lines[self.y])
         if self.x < max_x:
             s = self.lines[self.y]
-            self.lines[self.y] = s[:self.x] + s[self.x+1:]
+            self._set_line(self.y, s[:self.x] + s[char_end(s, self.x):])
         elif self.y < max_y:
-            self.lines[self.y] += self.lines[self.y+1]
-            self.lines = self.lines[:self.y+1] + self.lines[self.y+2:]
+            joined = self.lines[self.y] + self.lines[self.y+1]
+            self._replace_lines(self.y, self.y+2, [joined])
+
+    @_undoable(None)
+    def apply_edits(self, edits):
+        '''
+        Apply a batch of edits, each a tuple of ((y1, x1), (y2, x2), text)
+        that replaces the text from (y1, x1) up to (y2, x2) with the given
+        text, which may hold newlines. Locations refer to the document as it
+        is before any of the edits, which may come in any order but must not
+        overlap. All edits are checked before any is applied, and raise
+        ValueError if one is invalid. The edits are a single undo step, and
+        the cursor moves with the text around it.
+
+        Each run of nearby edits is made with one splice of the lines they
+        touch, so a batch costs about as much as the text it touches,
+        however many edits it has.
+        '''
+        edits = sorted(edits, key=lambda edit: edit[0])
+        count = len(self.lines)
+        for i, (start, end, text) in enumerate(edits):
+            if not (start <= end and 0 <= start[0] and end[0] < count and
+                    start[1] >= 0):
+                raise ValueError("Invalid edit range: %s to %s" % (start, end))
+            if i > 0 and edits[i-1][1] > start:
+                raise ValueError("Edits overlap at %s" % (start,))
+
+        # Split the edits into runs, and work out the new lines of each run
+        runs = []
+        for edit in edits:
+            if runs and edit[0][0] - runs[-1][-1][1][0] < Document.EDIT_GAP:
+                runs[-1].append(edit)
+            else:
+                runs.append([edit])
+        changes = [self._splice(run) for run in runs]
+
+        # Lines added or removed above the cursor move it down or up
+        y, x = self.getyx()
+        new_y, new_x = y, x
+        for first, last, lines, cursor in changes:
+            if last < y:
+                new_y += len(lines) - (last + 1 - first)
+            elif cursor:
+                new_y += cursor[0] - y
+                new_x = cursor[1]
+
+        # Apply the changes from the bottom up, so the line numbers of the
+        # ones above stay put
+        for first, last, lines, cursor in reversed(changes):
+            self._replace_lines(first, last + 1, lines)
+        self.move(new_y, new_x)
+
+    def append_lines(self, lines):
+        '''
+        Add lines to the end of the document, before the last line if it is
+        empty, as it is in a new document or one that ends with a newline.
+        The cursor stays where it is. This is for text that streams in, such
+        as the results of a search, and is not a step in the undo history.
+        '''
+        end = len(self.lines)
+        if not self.lines[end - 1]:
+            end -= 1
+        self._apply(end, end, lines)
+
+    def _splice(self, edits):
+        '''
+        Work out the change made by a run of sorted edits, as a tuple of
+        (first line, last line, new lines, cursor), where cursor is the new
+        location of the cursor if it is within the lines, and otherwise None
+        '''
+        first, last = edits[0][0][0], edits[-1][1][0]
+        text = "\n".join(block for block, count in
+            self.lines.iter_blocks(first, last + 1))
+
+        # The offset of the start of each line in the text, and one past the
+        # end of the text
+        starts = [0]
+        find = text.find
+        for i in xrange(last - first):
+            starts.append(find("\n", starts[-1]) + 1)
+        starts.append(len(text) + 1)
+
+        def offset(location):
+            y, x = location
+            start = starts[y - first]
+            if x > starts[y - first + 1] - 1 - start:
+                raise ValueError("Invalid edit location: %s" % (location,))
+            return start + x
+
+        y, x = self.getyx()
+        cursor = offset((y, x)) if first <= y <= last else None
+        moved = cursor
+        pieces = []
+        done = 0
+        for start, end, new in edits:
+            start, end = offset(start), offset(end)
+            pieces.append(text[done:start])
+            pieces.append(new)
+            done = end
+            if cursor is not None and cursor >= start:
+                # The cursor moves with the text after it, or to the end of
+                # the new text if the text it was in was replaced
+                delta = len(new) - (end - start)
+                moved += delta if cursor >= end else start + len(new) - cursor
+        pieces.append(text[done:])
+        text = ''.join(pieces)
+
+        if moved is not None:
+            line_start = text.rfind("\n", 0, moved) + 1
+            moved = (first + text.count("\n", 0, moved), moved - line_start)
+        return first, last, text.split("\n"), moved
+
+    def undo(self):
+        '''
+        Undo the last step in the history, and move the cursor to where it
+        was before it. Returns false if there was nothing to undo.
+        '''
+        step = self.history.undo()
+        if step is None:
+            return False
+        for start, old, new in reversed(step.changes):
+            self._apply(start, start + len(new), old)
+        self.move(*step.before)
+        return True
+
+    def redo(self):
+        '''
+        Redo the last step that was undone, and move the cursor to where it
+        was after it. Returns false if there was nothing to redo.
+        '''
+        step = self.history.redo()
+        if step is None:
+            return False
+        for start, old, new in step.changes:
+            self._apply(start, start + len(old), new)
+        self.move(*step.after)
+        return True
+
+    def _changed(self, start, end, count):
+        "Tell the listeners that lines [start, end) were replaced by `count` lines"
+        self.version += 1
+        self.changes.append((self.version, start, end, count))
+        for func in self.listeners:
+            func(start, end, count)
+
+    def _reset(self, lines):
+        "Replace all of the lines, and move the cursor to the top"
+        old_count = len(self.lines)
+        self.lines = lines
+        self.y = 0
+        self.x = 0
+        self.history.clear()
+        self._changed(0, old_count, len(lines))
+        self.reset_version = self.version
+        self.saved_version = self.version
+
+    def _set_line(self, y, line):
+        "Replace a single line"
+        self.history.record(y, [self.lines[y]], [line])
+        self.lines[y] = line
+        self._changed(y, y+1, 1)
+
+    def _replace_lines(self, start, end, lines):
+        "Replace the lines in the range [start, end) with the given lines"
+        self.history.record(start, self.lines.copy_lines(start, end), lines)
+        self._apply(start, end, lines)
+
+    def _apply(self, start, end, lines):
+        "Replace the lines in the range [start, end), without recording it"
+        self.lines.replace_lines(start, end, lines)
+        self._changed(start, end, len(lines))
 
     def _insert_string(self, str):
         '''
@@ -123,7 +442,7 @@ class Document(object):
             lhs = line[:self.x]
             rhs = line[self.x:]
             # Create the new line
-            self.lines[self.y] = lhs + str + rhs
+            self._set_line(self.y, lhs + str + rhs)
             # Move the cursor
             self.x += len(str)
 
@@ -133,45 +452,532 @@ class Document(object):
         line = self.lines[self.y]
         lhs = line[:self.x]
         rhs = line[self.x:]
-        # Insert a new line, which equals the right side). The existing line
-        # becomes the left side.
-        self.lines = self.lines[:self.y+1] + [rhs] + self.lines[self.y+1:]
-        self.lines[self.y] = lhs
+        # The existing line becomes the left side, followed by a new line
+        # which equals the right side
+        self._replace_lines(self.y, self.y+1, [lhs, rhs])
         # Move the cursor
         self.y += 1
         self.x = 0
 
+#==============================================================================
+# Snapshots of a document. A snapshot keeps the lines of one version of the
+# document, and is not changed by later edits, so worker threads can read it
+# while the user keeps typing. Results computed from it can be mapped back to
+# the live document with Document.map_line().
+#==============================================================================
+
+class Snapshot(object):
+    '''
+    The lines, file name and cursor of a Document at one version. With the
+    rope storage engine taking a snapshot is O(1), since it shares the tree
+    of the document.
+    '''
+    def __init__(self, doc):
+        self.lines    = doc.lines.snapshot()
+        self.version  = doc.version
+        self.filename = doc.filename
+        self.cursor   = doc.getyx()
+
+    def save(self, filename=None, progress=None):
+        '''
+        Save the snapshot to a file, or to the file the document was loaded
+        from. This may run on another thread. The text is streamed in blocks
+        to a temporary file in the same directory, which is synced to disk
+        and then renamed over the target, so a failed save never leaves a
+        partial file behind. If given, the progress function is called as
+        progress(lines_written, total_lines) after each block.
+        '''
+        import tempfile
+        filename = filename if filename else self.filename
+        if not filename:
+            raise ValueError("The document has no file name")
+
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, temp = tempfile.mkstemp(dir=directory,
+            prefix='.' + os.path.basename(filename) + '.', suffix='.tmp')
+        try:
+            # Write the blocks, separated by newlines
+            total = len(self.lines)
+            written = 0
+            with os.fdopen(fd, 'wb', Document.SAVE_BUFFER_SIZE) as file:
+                for text, count in self.lines.iter_blocks():
+                    if written > 0:
+                        file.write("\n")
+                    file.write(text)
+                    written += count
+                    if progress:
+                        progress(written, total)
+                file.flush()
+                os.fsync(file.fileno())
+
+            # Keep the permissions of the file we are replacing, or use the
+            # usual ones for a new file
+            if os.path.exists(filename):
+                os.chmod(temp, os.stat(filename).st_mode & 07777)
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(temp, 0666 & ~umask)
+            os.rename(temp, filename)
+        except:
+            os.unlink(temp)
+            raise
+
+        self.filename = filename
+
+#==============================================================================
+# Counts with a fast prefix-sum search. Used to map between rows of a wrapped
+# document and the lines they show.
+#==============================================================================
+
+class _Fenwick(object):
+    "A Fenwick tree over a list of numbers, for prefix sums in O(log n)"
+    def __init__(self, values):
+        self.size  = len(values)
+        self.total = sum(values)
+        self.tree  = [0] + list(values)
+        for i in xrange(1, self.size + 1):
+            j = i + (i & -i)
+            if j <= self.size:
+                self.tree[j] += self.tree[i]
+
+    def add(self, i, delta):
+        "Add delta to value i"
+        self.total += delta
+        i += 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix(self, i):
+        "Return the sum of values [0, i)"
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def find(self, n):
+        '''
+        Return (i, rest) for the value i that contains the n'th unit of the
+        total, where rest is n minus the sum of the values before i. Returns
+        i == size if n is past the total.
+        '''
+        pos = 0
+        step = 1
+        while step * 2 <= self.size:
+            step *= 2
+        while step:
+            if pos + step <= self.size and self.tree[pos + step] <= n:
+                pos += step
+                n -= self.tree[pos]
+            step /= 2
+        return pos, n
+
+def _flatten(blocks):
+    "Join a list of lists into one list"
+    return [item for block in blocks for item in block]
+
+class CountIndex(object):
+    '''
+    A list of counts, each with an optional piece of data, which can find the
+    item holding the n'th unit of the total in O(log n). Items are kept in
+    blocks, with Fenwick trees over the lengths and sums of the blocks, so
+    that replacing a few items only costs O(log n) plus the size of a block.
+    '''
+    BLOCK_SIZE = 512
+
+    def __init__(self, counts=(), data=None):
+        counts = list(counts)
+        self._build(counts, data if data is not None else [None] * len(counts))
+
+    def _build(self, counts, data):
+        "Split flat lists of counts and data into blocks"
+        size = CountIndex.BLOCK_SIZE
+        self.counts = [counts[i:i+size] for i in xrange(0, len(counts), size)]
+        self.data   = [data[i:i+size] for i in xrange(0, len(data), size)]
+        if not self.counts:
+            self.counts, self.data = [[]], [[]]
+        self._reindex()
+
+    def _reindex(self):
+        "Rebuild the trees over the blocks"
+        self.lengths = _Fenwick([len(block) for block in self.counts])
+        self.sums    = _Fenwick([sum(block) for block in self.counts])
+
+    def __len__(self):
+        return self.lengths.total
+
+    def total(self):
+        "Return the sum of all counts"
+        return self.sums.total
+
+    def _locate(self, i):
+        "Return (block, offset) of item i. The end of the list is in the last block."
+        block, offset = self.lengths.find(i)
+        if block == len(self.counts):
+            block -= 1
+            offset = len(self.counts[block])
+        return block, offset
+
+    def get(self, i):
+        "Return (count, data) of item i"
+        block, offset = self._locate(i)
+        return self.counts[block][offset], self.data[block][offset]
+
+    def set(self, i, count, data=None):
+        "Set the count and data of item i"
+        block, offset = self._locate(i)
+        self.sums.add(block, count - self.counts[block][offset])
+        self.counts[block][offset] = count
+        self.data[block][offset] = data
+
+    def prefix(self, i):
+        "Return the sum of the counts of items [0, i)"
+        block, offset = self._locate(i)
+        return self.sums.prefix(block) + sum(self.counts[block][:offset])
+
+    def find(self, n):
+        '''
+        Return (i, rest) for the item i that holds the n'th unit of the
+        total, where rest is n minus the sum of the counts before i. Returns
+        i == len(self) if n is past the total.
+        '''
+        block, rest = self.sums.find(n)
+        if block == len(self.counts):
+            return len(self), rest
+        for offset, count in enumerate(self.counts[block]):
+            if rest < count:
+                return self.lengths.prefix(block) + offset, rest
+            rest -= count
+        return self.lengths.prefix(block) + len(self.counts[block]), rest
+
+    def replace(self, start, end, counts, data=None):
+        "Replace the items in the range [start, end) with the given ones"
+        counts = list(counts)
+        data = list(data) if data is not None else [None] * len(counts)
+        block, offset = self._locate(start)
+        if offset + (end - start) <= len(self.counts[block]):
+            # The common case: a change within one block
+            old = self.counts[block][offset:offset + end - start]
+            self.counts[block][offset:offset + end - start] = counts
+            self.data[block][offset:offset + end - start] = data
+            size = len(self.counts[block])
+            if size > 2 * CountIndex.BLOCK_SIZE or (size == 0 and
+                    len(self.counts) > 1):
+                self._rebuild_blocks(block, block + 1)
+            else:
+                self.lengths.add(block, len(counts) - len(old))
+                self.sums.add(block, sum(counts) - sum(old))
+            return
+
+        # Otherwise flatten the blocks the range covers and split them again
+        last, last_offset = self._locate(end)
+        first = self.lengths.prefix(block)
+        flat_counts = _flatten(self.counts[block:last + 1])
+        flat_data = _flatten(self.data[block:last + 1])
+        flat_counts[start - first:end - first] = counts
+        flat_data[start - first:end - first] = data
+        self._replace_blocks(block, last + 1, flat_counts, flat_data)
+
+    def _rebuild_blocks(self, first, last):
+        "Split blocks [first, last) again into blocks of the usual size"
+        self._replace_blocks(first, last, _flatten(self.counts[first:last]),
+            _flatten(self.data[first:last]))
+
+    def _replace_blocks(self, first, last, counts, data):
+        "Replace blocks [first, last) with blocks holding the given items"
+        size = CountIndex.BLOCK_SIZE
+        self.counts[first:last] = [counts[i:i+size] for i in xrange(0, len(counts), size)]
+        self.data[first:last] = [data[i:i+size] for i in xrange(0, len(data), size)]
+        if not self.counts:
+            self.counts, self.data = [[]], [[]]
+        self._reindex()
+
 #==============================================================================
 # Word-wrapped document
 #==============================================================================
 
+def wrap_line(line, width):
+    '''
+    Return a tuple of the offsets at which the rows of a line start when it is
+    word-wrapped to the given width. Lines break after a space where possible,
+    and words longer than a row are broken at the edge.
+    '''
+    starts = [0]
+    start = 0
+    while len(line) - start > width:
+        end = start + width
+        if line[end] == ' ':
+            start = end
+        else:
+            space = line.rfind(' ', start, end)
+            start = space + 1 if space >= start else end
+        starts.append(start)
+    return tuple(starts)
+
+class _WrappedRows(object):
+    "The rows of a word-wrapped document, as a read-only sequence of strings"
+    def __init__(self, wrapped):
+        self.wrapped = wrapped
+
+    def __len__(self):
+        return self.wrapped.index.total()
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self[i] for i in xrange(*row.indices(len(self)))]
+        y, x, length = self.wrapped.location(row)
+        return self.wrapped.doc.lines[y][x:x+length]
+
+    def __iter__(self):
+        for row in xrange(len(self)):
+            yield self[row]
+
 #TODO: should this be a subclass of Document?
 class WordWrappedDocument(object):
+    '''
+    A view of a document with its lines word-wrapped to a width. The cursor
+    and `lines` are in rows of the wrapped text, and edits go through to the
+    document.
+
+    The wrapped layout of each line is cached in a CountIndex, along with the
+    number of rows it takes, so mapping between rows and document locations
+    is O(log n) and an edit only rewraps the lines it changed. Lines are
+    wrapped lazily: after a resize, or loading a big file, lines count as a
+    guess at their number of rows until they are first looked at, or until
+    wrap_pending() gets to them.
+
+    Listeners are told about changes in rows, just as Document listeners are
+    told about changes in lines, including rows that move when a guess is
+    corrected.
+    '''
+    # Changes to more lines than this are wrapped lazily
+    LAZY_LINES = 1000
+
     def __init__(self, doc, width):
-        self.doc = doc
+        self.doc       = doc
+        self.width     = max(width, 1)
+        self.listeners = []
+        self.index     = CountIndex()
+        self.lines     = _WrappedRows(self)  # The rows, as strings
+        self.scan      = None       # The first line that may need wrapping
+        self.y         = 0
+        self.x         = 0
+        self._on_change(0, 0, len(doc.lines))
+        doc.add_listener(self._on_change)
+
+    def add_listener(self, func):
+        '''
+        Call func(start, end, count) after every change to the wrapped text,
+        meaning that the rows in the range [start, end) were replaced by
+        `count` new rows.
+        '''
+        self.listeners.append(func)
+
+    def remove_listener(self, func):
+        "Stop calling a function added with add_listener()"
+        self.listeners.remove(func)
+
+    def close(self):
+        "Stop following changes to the document"
+        self.doc.remove_listener(self._on_change)
+
+    def _changed(self, start, end, count):
+        "Tell the listeners that rows [start, end) were replaced by `count` rows"
+        for func in self.listeners:
+            func(start, end, count)
+
+    def _on_change(self, start, end, count):
+        "Document listener. Rewrap the changed lines."
+        if self.scan is not None and start < self.scan:
+            # Keep pointing at the first line not wrapped yet, or at the
+            # changed lines if they replaced it
+            self.scan = max(start, self.scan + count - (end - start))
+        if count > WordWrappedDocument.LAZY_LINES:
+            self.scan = min(self.scan, start) if self.scan is not None else start
+            self._replace(start, end, [1] * count, None)
+        else:
+            self._rewrap(start, end, count)
+
+    def _rewrap(self, start, end, count):
+        "Wrap lines [start, start+count) of the document, replacing items [start, end)"
+        data = [wrap_line(line, self.width)
+            for line in self.doc.lines[start:start+count]]
+        self._replace(start, end, [len(starts) for starts in data],
+            [(self.width, starts) for starts in data])
+
+    def _replace(self, start, end, counts, data):
+        "Replace items [start, end) of the index, and tell the listeners"
+        first_row = self.index.prefix(start)
+        old_rows = self.index.prefix(end) - first_row
+        self.index.replace(start, end, counts, data)
+        self._changed(first_row, first_row + old_rows, sum(counts))
+
+    def _wrap(self, y):
+        '''
+        Return the row offsets of line y, wrapping it first if its layout is
+        not known for the current width.
+        '''
+        count, data = self.index.get(y)
+        if data is not None and data[0] == self.width:
+            return data[1]
+        starts = wrap_line(self.doc.lines[y], self.width)
+        self.index.set(y, len(starts), (self.width, starts))
+        if len(starts) != count:
+            first_row = self.index.prefix(y)
+            self._changed(first_row, first_row + count, len(starts))
+        return starts
+
+    def wrap_pending(self, limit=1000):
+        '''
+        Wrap up to `limit` of the lines whose layout is a guess, for example
+        while the user is idle. Returns true if there are more to do.
+        '''
+        if self.scan is None:
+            return False
+        start = min(self.scan, len(self.index))
+        end = min(start + limit, len(self.index))
+        self._rewrap(start, end, end - start)
+        self.scan = end if end < len(self.index) else None
+        return self.scan is not None
+
+    def wrap_rows(self, row, count):
+        "Make sure the layout of the `count` rows from `row` is exact"
+        y = self.position_of(row)[0]
+        while y < len(self.index) and count > 0:
+            count -= len(self._wrap(y))
+            y += 1
+
+    def resize(self, width, top=0, rows=0):
+        '''
+        Change the width of the wrapped text. Only the `rows` rows from the
+        line shown at row `top` are wrapped now; the rest are wrapped lazily.
+        Returns the row that the top line moved to.
+        '''
+        width = max(width, 1)
+        if width == self.width:
+            return top
+        y, x = self.position_of(top)
         self.width = width
-        self.lines = []     # Holds document location as tuple: (y, x, length)
-        self.y = 0
-        self.x = 0
+        self.scan = 0
+        self.wrap_rows(self.row_of(y, x)[0], rows)
+        # Every row may have changed
+        self._changed(0, self.index.total(), self.index.total())
+        return self.row_of(y, x)[0]
+
+    def row_of(self, y, x=0):
+        "Return the (row, column) of the wrapped text showing document location (y,x)"
+        y = max(0, min(y, len(self.index) - 1))
+        starts = self._wrap(y)
+        r = bisect.bisect_right(starts, x) - 1
+        return self.index.prefix(y) + r, x - starts[r]
+
+    def location(self, row):
+        "Return the (y, x, length) of the part of the document shown on a row"
+        row = max(0, min(row, self.index.total() - 1))
+        y, r = self.index.find(row)
+        starts = self._wrap(y)
+        r = min(r, len(starts) - 1)
+        if r + 1 < len(starts):
+            return (y, starts[r], starts[r+1] - starts[r])
+        return (y, starts[r], len(self.doc.lines[y]) - starts[r])
+
+    def position_of(self, row, col=0):
+        '''
+        Return the document location (y,x) shown at a row and column of the
+        wrapped text. The column is kept within the row.
+        '''
+        y, x, length = self.location(row)
+        if x + length < len(self.doc.lines[y]):
+            length -= 1     # The end of a row is the start of the next one
+        return (y, x + max(0, min(col, length)))
 
     def move(self, y, x):
         '''
         Set the cursor location. Will keep cursor within bounds of the document.
         Also updates the cursor in the original document.
         '''
-        pass
+        self.doc.move(*self.position_of(y, x))
+        self.getyx()
 
     def getyx(self):
         "Return the cursor location as (y,x)"
+        self.y, self.x = self.row_of(*self.doc.getyx())
         return (self.y, self.x)
 
+    def move_up(self):
+        "Move the cursor up, if possible"
+        y, x = self.getyx()
+        if y == 0:
+            self.doc.move(0, 0)
+            self.getyx()
+        else:
+            self.move(y-1, x)
+
+    def move_down(self):
+        "Move the cursor down, if possible"
+        y, x = self.getyx()
+        if y == self.max_y():
+            self.doc.move(self.doc.max_y(), len(self.doc.lines[-1]))
+            self.getyx()
+        else:
+            self.move(y+1, x)
+
+    def move_left(self):
+        "Move the cursor left, if possible"
+        self.doc.move_left()
+        self.getyx()
+
+    def move_right(self):
+        "Move the cursor right, if possible"
+        self.doc.move_right()
+        self.getyx()
+
+    def max_y(self):
+        "Return the highest value for y for the cursor"
+        return max(0, self.index.total() - 1)
+
+    def max_x(self):
+        "Return the highest value for x for the cursor on the current row"
+        return self.location(self.getyx()[0])[2]
+
     def addch(self, c):
         '''
         Insert a character at the current cursor location. Ignores
         non-printable characters.
         '''
-        pass
+        self.doc.addch(c)
+        self.getyx()
 
     def addstr(self, str):
         "Insert a string at the current cursor location. Handles newline chars."
-        pass
+        self.doc.addstr(str)
+        self.getyx()
+
+    def backspace(self):
+        "Delete the character to the left of the cursor"
+        self.doc.backspace()
+        self.getyx()
+
+    def delete(self):
+        "Delete the character at the cursor"
+        self.doc.delete()
+        self.getyx()
+
+    def apply_edits(self, edits):
+        "Apply a batch of edits in document coordinates. See Document.apply_edits()."
+        self.doc.apply_edits(edits)
+        self.getyx()
+
+    def undo(self):
+        "Undo the last edit. Returns false if there was nothing to undo."
+        done = self.doc.undo()
+        self.getyx()
+        return done
+
+    def redo(self):
+        "Redo the last edit that was undone. Returns false if there was none."
+        done = self.doc.redo()
+        self.getyx()
+        return done
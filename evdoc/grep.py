@@ -0,0 +1,268 @@
+import itertools
+import mmap
+import multiprocessing
+import os
+import re
+import signal
+import sre_constants
+import sre_parse
+import stat
+import threading
+import time
+import evdoc.search
+
+#==============================================================================
+# Searching the files in a directory tree, from the prompt with 'grep text' or
+# 'rgrep pattern'. The files are searched by a pool of worker processes, so
+# the search runs on every CPU and leaves the editor's own process free. A
+# thread of the editor hands the files out and collects the matching lines,
+# which it passes to the event loop a batch at a time as they come in.
+#
+# Each file is memory-mapped and searched as a whole, not line by line. Text
+# that every match must contain is looked for first with mmap.find(), which
+# is much faster than the regular expression, and only the lines it is found
+# in are matched against the pattern. Files on disk are searched, not the
+# documents open in the editor, and binary files are skipped.
+#==============================================================================
+
+# A line of the results, as written by format_hit()
+HIT = re.compile(r'(.+?):(\d+):(\d+): ')
+
+def required_literal(pattern, regex=False):
+    '''
+    Return text that every match of a search pattern contains, the longer the
+    better, or None if no such text is known
+    '''
+    if not regex:
+        return pattern or None
+    try:
+        parsed = sre_parse.parse(pattern, re.MULTILINE)
+    except (re.error, sre_constants.error):
+        return None
+    if parsed.pattern.flags & (re.IGNORECASE | re.LOCALE | re.UNICODE):
+        return None
+    # Runs of literal characters at the top level must all be in a match
+    best = run = ''
+    for op, arg in parsed:
+        if op == sre_constants.LITERAL:
+            run += chr(arg)
+            if len(run) > len(best):
+                best = run
+        else:
+            run = ''
+    return best or None
+
+def format_hit(filename, y, x, line):
+    "Return a line of the results for a match at (y, x) in a file"
+    return "%s:%d:%d: %s" % (filename, y + 1, x + 1,
+        line[:DirectorySearch.LINE_LENGTH])
+
+def parse_hit(line):
+    "Return (filename, y, x) for a line written by format_hit(), or None"
+    match = HIT.match(line)
+    if not match:
+        return None
+    return (match.group(1), int(match.group(2)) - 1,
+        int(match.group(3)) - 1)
+
+def walk(root):
+    "Generate the names of the files under a directory, skipping hidden ones"
+    for path, dirs, files in os.walk(root):
+        dirs[:] = sorted(name for name in dirs if not name.startswith('.'))
+        for name in sorted(files):
+            if not name.startswith('.'):
+                filename = os.path.join(path, name)
+                yield os.path.relpath(filename) if root == '.' else filename
+
+def search_file(filename, regex, literal, limit):
+    '''
+    Return a (y, x, line) tuple for each line of a file that matches a
+    compiled pattern, up to `limit` of them, where x is where the first match
+    in the line starts. `literal` is text that every match contains, or None.
+    '''
+    info = os.stat(filename)
+    if not stat.S_ISREG(info.st_mode) or not info.st_size:
+        return []
+    with open(filename, 'rb') as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if "\0" in mapping[:DirectorySearch.BINARY_CHECK]:
+            return []
+        hits = []
+        size = len(mapping)
+        y = counted = pos = 0   # Line y starts at offset `counted`
+        while pos < size and len(hits) < limit:
+            if literal is not None:
+                found = mapping.find(literal, pos)
+                if found < 0:
+                    break
+            else:
+                match = regex.search(mapping, pos)
+                if not match:
+                    break
+                found = match.start()
+            start = mapping.rfind("\n", 0, found) + 1
+            end = mapping.find("\n", found)
+            if end < 0:
+                end = size
+            line = mapping[start:end]
+            for match in regex.finditer(line):
+                # Empty matches are ignored, as they are in the editor
+                if match.end() > match.start():
+                    y += mapping[counted:start].count("\n")
+                    counted = start
+                    hits.append((y, match.start(), line))
+                    break
+            pos = end + 1
+        return hits
+    finally:
+        mapping.close()
+
+# The search run by this process, when it is a worker
+_worker = None
+
+def _start_worker(pattern, regex):
+    global _worker
+    _worker = (evdoc.search.compile_pattern(pattern, regex),
+        required_literal(pattern, regex))
+    # Ctrl-C is for the editor, which stops the workers itself. The workers
+    # are forks of the editor, in which curses would handle being stopped or
+    # killed by restoring the terminal, which is the editor's to restore.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGTSTP, signal.SIG_DFL)
+
+def _search(filenames):
+    '''
+    Search files for the worker's pattern. Returns the number of files
+    searched, and a list of (filename, hits) for each one that has matches.
+    '''
+    regex, literal = _worker
+    found = []
+    for filename in filenames:
+        try:
+            hits = search_file(filename, regex, literal,
+                DirectorySearch.MAX_HITS)
+        except (IOError, OSError, ValueError, mmap.error):
+            # Gone, unreadable, or not something that can be mapped
+            continue
+        if hits:
+            found.append((filename, hits))
+    return len(filenames), found
+
+def _chunks(items, size):
+    "Generate lists of `size` items at a time"
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            break
+        yield chunk
+
+class DirectorySearch(object):
+    '''
+    A search of the files under a directory for a pattern, which is taken
+    literally unless `regex` is true. Raises re.error if the regular
+    expression is not valid. Once started, the matches found are passed to
+    the event loop in batches, until the search is done or cancelled.
+    '''
+    # The number of worker processes, one per CPU by default
+    JOBS = None
+    # The number of files handed to a worker at a time
+    CHUNK_FILES = 16
+    # Matches found are passed on at most this often, in seconds, and the
+    # collecting thread notices a cancel() within this time
+    BATCH_TIME = 0.05
+    # The search stops after this many matching lines
+    MAX_HITS = 100000
+    # Files with a NUL byte in this many bytes at the start are binary
+    BINARY_CHECK = 8192
+    # Lines of the results show at most this many bytes of the matching line
+    LINE_LENGTH = 200
+
+    def __init__(self, pattern, regex=False, root='.'):
+        evdoc.search.compile_pattern(pattern, regex)
+        self.pattern   = pattern
+        self.regex     = regex
+        self.root      = root
+        self.files     = 0      # The files searched so far
+        self.hits      = 0      # The matching lines found so far
+        self.cancelled = False
+        self.error     = None   # Why the search could not be started, if so
+        self.thread    = None
+
+    def start(self, loop, on_hits, on_done):
+        '''
+        Start searching, on a thread of its own. on_hits(hits) is called on
+        the loop thread with a list of (filename, y, x, line) tuples whenever
+        matches have been found, and on_done() once the search is done, or
+        has failed with self.error set. Neither is called once the search
+        has been cancelled.
+        '''
+        self.thread = threading.Thread(target=self._run,
+            args=(loop, on_hits, on_done), name="evdoc-grep")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def cancel(self, wait=False):
+        '''
+        Stop searching. The workers are stopped in the background, unless
+        `wait` is true, such as when the editor quits.
+        '''
+        self.cancelled = True
+        if wait and self.thread:
+            self.thread.join()
+
+    def truncated(self):
+        "Return true if the search stopped at MAX_HITS matches"
+        return self.hits >= DirectorySearch.MAX_HITS
+
+    def _run(self, loop, on_hits, on_done):
+        jobs = DirectorySearch.JOBS or multiprocessing.cpu_count()
+        try:
+            pool = multiprocessing.Pool(jobs, _start_worker,
+                (self.pattern, self.regex))
+        except OSError as e:
+            self.error = e
+            loop.call_soon_threadsafe(self._post, on_done)
+            return
+        try:
+            # The files are handed out as lists, since with a chunksize
+            # imap_unordered() returns an iterator that cannot be waited on
+            # with a timeout
+            chunks = _chunks(walk(self.root), DirectorySearch.CHUNK_FILES)
+            results = pool.imap_unordered(_search, chunks)
+            batch = []
+            posted = 0
+            while not self.cancelled and not self.truncated():
+                try:
+                    searched, found = results.next(DirectorySearch.BATCH_TIME)
+                except multiprocessing.TimeoutError:
+                    searched, found = 0, ()
+                except StopIteration:
+                    break
+                self.files += searched
+                for filename, hits in found:
+                    hits = hits[:DirectorySearch.MAX_HITS - self.hits]
+                    self.hits += len(hits)
+                    batch.extend((filename,) + hit for hit in hits)
+                if batch and time.time() - posted >= DirectorySearch.BATCH_TIME:
+                    loop.call_soon_threadsafe(self._post, on_hits, batch)
+                    batch = []
+                    posted = time.time()
+            if batch:
+                loop.call_soon_threadsafe(self._post, on_hits, batch)
+        finally:
+            if self.cancelled or self.truncated():
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+        if not self.cancelled:
+            loop.call_soon_threadsafe(self._post, on_done)
+
+    def _post(self, func, *args):
+        # On the loop thread, where the search may have been cancelled since
+        # this was posted
+        if not self.cancelled:
+            func(*args)
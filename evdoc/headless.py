@@ -0,0 +1,542 @@
+import collections
+import curses.ascii
+import select
+import sys
+import time
+import evdoc
+
+#==============================================================================
+# A headless stand-in for the curses module. It keeps an in-memory model of
+# the terminal, counts rendering calls, and estimates the bytes a real
+# terminal would receive on each doupdate(). Input comes from a queue of key
+# bursts instead of a TTY. Use install() to run the UI classes against it.
+#==============================================================================
+
+class error(Exception):
+    pass
+
+version = 'headless'
+ascii   = curses.ascii
+
+A_NORMAL    = 0
+A_STANDOUT  = 1 << 16
+A_UNDERLINE = 1 << 17
+A_REVERSE   = 1 << 18
+A_BOLD      = 1 << 21
+A_COLOR     = 0xff << 8
+
+COLOR_BLACK   = 0
+COLOR_RED     = 1
+COLOR_GREEN   = 2
+COLOR_YELLOW  = 3
+COLOR_BLUE    = 4
+COLOR_MAGENTA = 5
+COLOR_CYAN    = 6
+COLOR_WHITE   = 7
+
+KEY_DOWN      = 258
+KEY_UP        = 259
+KEY_LEFT      = 260
+KEY_RIGHT     = 261
+KEY_HOME      = 262
+KEY_BACKSPACE = 263
+KEY_F0        = 264
+KEY_DC        = 330
+KEY_NPAGE     = 338
+KEY_PPAGE     = 339
+KEY_END       = 360
+KEY_MOUSE     = 409
+KEY_RESIZE    = 410
+
+BUTTON1_PRESSED  = 0x2
+BUTTON1_CLICKED  = 0x4
+ALL_MOUSE_EVENTS = 0x7ffffff
+
+def KEY_F(n):
+    "Return the key code of function key n"
+    return KEY_F0 + n
+
+#==============================================================================
+# The terminal model. There is a single screen, like in curses.
+#==============================================================================
+
+class Terminal(object):
+    def __init__(self, rows, cols):
+        self.rows      = rows
+        self.cols      = cols
+        self.bursts    = collections.deque()    # Pending input, as key queues
+        self.burst     = collections.deque()    # Keys of the burst being read
+        self.mouse     = []     # Pending mouse events for getmouse()
+        self.delivered = None   # When the current burst was first read
+        self.latencies = []     # Seconds from each burst to the next read
+        self.counts    = {}     # Number of calls of each curses function
+        self.bytes     = 0      # Estimated bytes written to the terminal
+        self.cursor    = (0, 0)
+        self.cleared   = False
+        self.shifts    = []     # Line moves for the terminal to do itself
+        self.physical  = self._blank(rows, cols)
+        self.virtual   = self._blank(rows, cols)
+
+    @staticmethod
+    def _blank(rows, cols):
+        return [[(' ', 0)] * cols for row in xrange(rows)]
+
+    def count(self, name):
+        "Count a call of a curses function"
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def feed(self, keys, mouse=None):
+        '''
+        Queue a burst of keys, which are read as if they arrived together. A
+        key can also be a tuple of (rows, cols), which resizes the terminal
+        when it is read and is read as KEY_RESIZE.
+        '''
+        self.bursts.append((collections.deque(keys), mouse))
+
+    def resize(self, rows, cols):
+        "Resize the terminal. The resize is reported when the key is read."
+        self.rows = rows
+        self.cols = cols
+        self.physical = self._blank(rows, cols)
+        self.virtual = self._blank(rows, cols)
+        self.cleared = True
+
+    def read_key(self, block, waits=False):
+        '''
+        Return the next key of the current burst. When the burst is used up,
+        return -1 if not blocking, or start the next burst. When there is no
+        input left a blocking read raises KeyboardInterrupt, which ends the
+        app's main loop. A read that waits counts as blocking for latencies.
+        '''
+        c = self._next_key(block, waits)
+        if isinstance(c, tuple):
+            self.resize(*c)
+            c = KEY_RESIZE
+        return c
+
+    def _next_key(self, block, waits):
+        if self.burst:
+            return self.burst.popleft()
+        if block or waits:
+            self._handled()
+        if not block:
+            return -1
+        self.next_burst()
+        return self.burst.popleft()
+
+    def next_burst(self):
+        '''
+        Start reading the next burst of keys. When there is no input left
+        this raises KeyboardInterrupt, which ends the app's main loop.
+        '''
+        if not self.bursts:
+            raise KeyboardInterrupt()
+        self.burst, mouse = self.bursts.popleft()
+        if mouse:
+            self.mouse.append(mouse)
+        self.delivered = time.time()
+
+    def _handled(self):
+        "Record the latency of the last burst, now that the app waits for more"
+        if self.delivered is not None:
+            self.latencies.append(time.time() - self.delivered)
+            self.delivered = None
+
+    def text(self):
+        "Return what the terminal shows, as a list of strings"
+        return [''.join(c for c, attr in row) for row in self.physical]
+
+    def update(self):
+        '''
+        Make the physical screen match the virtual one, adding up the bytes
+        that a terminal would need for it: the changed cells, plus cursor
+        movements and attribute changes between them.
+        '''
+        if self.cleared:
+            self.physical = self._blank(self.rows, self.cols)
+            self.bytes += 4
+            self.cleared = False
+            self.shifts = []
+
+        # Lines moved with scroll() or insdelln() are moved by the terminal
+        for top, bottom, n in self.shifts:
+            rows = self.physical[top:bottom]
+            blank = self._blank(min(abs(n), bottom - top), self.cols)
+            rows = rows[n:] + blank if n > 0 else blank + rows[:n]
+            self.physical[top:bottom] = rows[:bottom - top]
+            self.bytes += 12 + abs(n)
+        self.shifts = []
+
+        cy, cx = (-1, -1)
+        current = 0
+        for y in xrange(self.rows):
+            old = self.physical[y]
+            new = self.virtual[y]
+            for x in xrange(self.cols):
+                if old[x] == new[x]:
+                    continue
+                if (y, x) != (cy, cx):
+                    self.bytes += len("\x1b[%d;%dH" % (y + 1, x + 1))
+                c, attr = new[x]
+                if attr != current:
+                    self.bytes += 6
+                    current = attr
+                self.bytes += len(c)
+                old[x] = new[x]
+                cy, cx = y, x + 1
+        if (cy, cx) != self.cursor:
+            y, x = self.cursor
+            self.bytes += len("\x1b[%d;%dH" % (y + 1, x + 1))
+
+the_terminal = None
+
+#==============================================================================
+# Windows
+#==============================================================================
+
+class Window(object):
+    def __init__(self, rows, cols, begin_y, begin_x):
+        self.rows    = rows
+        self.cols    = cols
+        self.begin_y = begin_y
+        self.begin_x = begin_x
+        self.y       = 0
+        self.x       = 0
+        self.attr    = 0
+        self.delay   = True
+        self.waits   = False    # Reads have a timeout
+        self.scrolls = False
+        self.touched = True
+        self.moved   = False    # The cursor moved since the last refresh
+        self.cleared = False
+        self.shifts  = []
+        self.cells   = Terminal._blank(rows, cols)
+
+    def _count(self, name):
+        the_terminal.count(name)
+
+    def keypad(self, flag):
+        pass
+
+    def idlok(self, flag):
+        pass
+
+    def leaveok(self, flag):
+        pass
+
+    def scrollok(self, flag):
+        self.scrolls = bool(flag)
+
+    def nodelay(self, flag):
+        self.delay = not flag
+        self.waits = False
+
+    def timeout(self, delay):
+        '''
+        Reads with a timeout do not block, since in a replay no more input
+        comes while waiting. The app is idle while it waits, though, so the
+        time taken to handle the input read before ends there.
+        '''
+        self.delay = delay < 0
+        self.waits = delay > 0
+
+    def getyx(self):
+        return (self.y, self.x)
+
+    def getbegyx(self):
+        return (self.begin_y, self.begin_x)
+
+    def getmaxyx(self):
+        return (self.rows, self.cols)
+
+    def enclose(self, y, x):
+        return (self.begin_y <= y < self.begin_y + self.rows and
+            self.begin_x <= x < self.begin_x + self.cols)
+
+    def move(self, y, x):
+        if not (0 <= y < self.rows and 0 <= x < self.cols):
+            raise error("move() returned ERR")
+        self.y = y
+        self.x = x
+        self.moved = True
+
+    def resize(self, rows, cols):
+        self._count('resize')
+        cells = Terminal._blank(rows, cols)
+        for y in xrange(min(rows, self.rows)):
+            cells[y][:min(cols, self.cols)] = self.cells[y][:min(cols, self.cols)]
+        self.cells = cells
+        self.rows = rows
+        self.cols = cols
+        self.y = min(self.y, rows - 1)
+        self.x = min(self.x, cols - 1)
+        self.touched = True
+
+    def mvwin(self, y, x):
+        self.begin_y = y
+        self.begin_x = x
+        self.touched = True
+
+    def bkgd(self, c, attr=0):
+        pass
+
+    def attrset(self, attr):
+        self.attr = attr
+
+    def addstr(self, *args):
+        '''
+        addstr([y, x,] str[, attr]). Like curses, writing past the bottom-right
+        cell of a window that does not scroll is an error.
+        '''
+        self._count('addstr')
+        if len(args) >= 3:
+            self.move(args[0], args[1])
+            args = args[2:]
+        text = args[0]
+        attr = args[1] if len(args) > 1 else self.attr
+        for c in text:
+            self.cells[self.y][self.x] = (c, attr)
+            self.touched = True
+            self.x += 1
+            if self.x == self.cols:
+                self.x = 0
+                if self.y == self.rows - 1:
+                    if not self.scrolls:
+                        self.x = self.cols - 1
+                        raise error("addstr() returned ERR")
+                    self.scroll(1)
+                else:
+                    self.y += 1
+
+    def addnstr(self, *args):
+        self._count('addnstr')
+        if len(args) >= 4:
+            self.addstr(args[0], args[1], args[2][:args[3]], *args[4:])
+        else:
+            self.addstr(args[0][:args[1]], *args[2:])
+
+    def chgat(self, *args):
+        self._count('chgat')
+        y, x = self.y, self.x
+        if len(args) == 4:
+            y, x, num, attr = args
+        elif len(args) == 2:
+            num, attr = args
+        else:
+            num, attr = -1, args[0]
+        end = self.cols if num < 0 else min(x + num, self.cols)
+        for i in xrange(x, end):
+            self.cells[y][i] = (self.cells[y][i][0], attr)
+        self.touched = True
+
+    def clrtoeol(self):
+        self._count('clrtoeol')
+        self.cells[self.y][self.x:] = [(' ', 0)] * (self.cols - self.x)
+        self.touched = True
+
+    def erase(self):
+        self._count('erase')
+        self.cells = Terminal._blank(self.rows, self.cols)
+        self.touched = True
+
+    def clear(self):
+        self._count('clear')
+        self.erase()
+        self.cleared = True
+
+    def border(self):
+        self._count('border')
+        for x in xrange(self.cols):
+            self.cells[0][x] = ('-', 0)
+            self.cells[self.rows - 1][x] = ('-', 0)
+        for y in xrange(self.rows):
+            self.cells[y][0] = ('|', 0)
+            self.cells[y][self.cols - 1] = ('|', 0)
+        self.touched = True
+
+    def scroll(self, n=1):
+        '''
+        Scroll the contents of the window up by n rows, or down if negative.
+        The terminal is asked to move the lines itself.
+        '''
+        self._count('scroll')
+        if not self.scrolls:
+            raise error("scroll() returned ERR")
+        self._shift(0, n)
+
+    def insdelln(self, n):
+        "Insert n blank rows at the cursor row, or delete -n rows if negative"
+        self._count('insdelln')
+        self._shift(self.y, -n)
+
+    def _shift(self, top, n):
+        "Move rows [top, rows) up by n rows (down if n is negative)"
+        rows = self.cells[top:]
+        blank = Terminal._blank(min(abs(n), len(rows)), self.cols)
+        rows = rows[n:] + blank if n > 0 else blank + rows[:n]
+        self.cells[top:] = rows[:self.rows - top]
+        self.shifts.append((top, n))
+        self.touched = True
+
+    def redrawln(self, beg, num):
+        self.touched = True
+
+    def noutrefresh(self):
+        '''
+        Copy the window to the virtual screen. Any rows the window moved are
+        passed on, so that the terminal can move them too, like curses does
+        with idlok() on.
+        '''
+        self._count('noutrefresh')
+        term = the_terminal
+        if self.cleared:
+            term.cleared = True
+            self.cleared = False
+        for top, n in self.shifts:
+            term.shifts.append((self.begin_y + top, self.begin_y + self.rows, n))
+        self.shifts = []
+        for y in xrange(self.rows):
+            sy = self.begin_y + y
+            if sy >= term.rows:
+                break
+            width = max(min(self.cols, term.cols - self.begin_x), 0)
+            term.virtual[sy][self.begin_x:self.begin_x + width] = self.cells[y][:width]
+        term.cursor = (min(self.begin_y + self.y, term.rows - 1),
+            min(self.begin_x + self.x, term.cols - 1))
+        self.touched = False
+        self.moved = False
+
+    def refresh(self):
+        self.noutrefresh()
+        doupdate()
+
+    def getch(self):
+        '''
+        Read a key. Like curses, a window that changed or whose cursor moved
+        since it was last refreshed is refreshed first.
+        '''
+        self._count('getch')
+        if self.touched or self.moved:
+            self.refresh()
+        return the_terminal.read_key(self.delay, self.waits)
+
+#==============================================================================
+# Module-level functions
+#==============================================================================
+
+def initscr():
+    the_terminal.count('initscr')
+    return Window(the_terminal.rows, the_terminal.cols, 0, 0)
+
+def newwin(rows, cols, begin_y=0, begin_x=0):
+    the_terminal.count('newwin')
+    return Window(rows, cols, begin_y, begin_x)
+
+def doupdate():
+    the_terminal.count('doupdate')
+    the_terminal.update()
+
+def ungetch(c):
+    the_terminal.burst.appendleft(c)
+
+def getmouse():
+    y, x, bstate = the_terminal.mouse.pop(0)
+    return (0, x, y, 0, bstate)
+
+def endwin():
+    pass
+
+def cbreak():
+    pass
+
+def nocbreak():
+    pass
+
+def echo():
+    pass
+
+def noecho():
+    pass
+
+def curs_set(visibility):
+    pass
+
+def mousemask(mask):
+    return (mask, 0)
+
+def has_colors():
+    return True
+
+def start_color():
+    pass
+
+def use_default_colors():
+    pass
+
+def init_pair(pair, fg, bg):
+    pass
+
+def color_pair(pair):
+    return (pair << 8) & A_COLOR
+
+def wait_readable(fds, timeout):
+    '''
+    Stand-in for EventLoop.wait_readable(). The terminal stands for stdin,
+    which is readable while a burst is being read. Once the burst is used up
+    the app is idle, so the time taken to handle it ends there. A wait with
+    a timeout ends at once, as if no input came in time, since in a replay
+    none would. Otherwise the next burst arrives. Other file descriptors,
+    such as the pipe that wakes the loop when a job is done, are polled.
+    '''
+    stdin = sys.stdin.fileno()
+    others = [fd for fd in fds if fd != stdin]
+    ready = select.select(others, [], [], 0)[0] if others else []
+    if stdin in fds:
+        if the_terminal.burst:
+            return [stdin] + ready
+        the_terminal._handled()
+        if not ready and timeout is None:
+            the_terminal.next_burst()
+            return [stdin]
+    return ready
+
+#==============================================================================
+# Installing the stand-in
+#==============================================================================
+
+_saved = {}
+
+def install(rows=24, cols=80):
+    '''
+    Make the evdoc UI use this module instead of curses, with a terminal of
+    the given size. Returns the Terminal, which is used to feed input and to
+    read the counters.
+    '''
+    global the_terminal
+    import evdoc.ui
+    import evdoc.app
+    import evdoc.loop
+    this = sys.modules[__name__]
+    the_terminal = Terminal(rows, cols)
+    if not _saved:
+        _saved['ui'] = evdoc.ui.curses
+        _saved['app'] = evdoc.app.curses
+        _saved['terminal_size'] = evdoc.ui.Layout.__dict__['terminal_size']
+        _saved['wait_readable'] = evdoc.loop.EventLoop.__dict__['wait_readable']
+    evdoc.ui.curses = this
+    evdoc.app.curses = this
+    evdoc.ui.Layout.terminal_size = staticmethod(
+        lambda: (the_terminal.rows, the_terminal.cols))
+    evdoc.loop.EventLoop.wait_readable = staticmethod(wait_readable)
+    return the_terminal
+
+def uninstall():
+    "Make the evdoc UI use curses again"
+    import evdoc.ui
+    import evdoc.app
+    import evdoc.loop
+    if _saved:
+        evdoc.ui.curses = _saved.pop('ui')
+        evdoc.app.curses = _saved.pop('app')
+        evdoc.ui.Layout.terminal_size = _saved.pop('terminal_size')
+        evdoc.loop.EventLoop.wait_readable = _saved.pop('wait_readable')
@@ -0,0 +1,199 @@
+import os
+import re
+
+#==============================================================================
+# Syntax highlighting. A highlighter splits each line into styled spans. To
+# do that it needs the state of its lexer at the end of the line before, such
+# as whether it is inside a fenced code block, so those states are cached per
+# line by a HighlightCache.
+#==============================================================================
+
+class Highlighter(object):
+    "Base class for highlighters. Does not highlight anything."
+    # The lexer state at the start of a document
+    initial_state = None
+
+    def tokenize(self, line, state):
+        '''
+        Return (spans, state) for a line, given the state at the end of the
+        line before it. Spans are (start, end, style) tuples, where the style
+        is a name such as 'heading' or 'code'.
+        '''
+        return [], state
+
+class MarkdownHighlighter(Highlighter):
+    '''
+    Highlights Markdown: headings, quotes, list markers, fenced and inline
+    code, emphasis and links. The state is the fence of the code block the
+    line is in, or None.
+    '''
+    FENCE    = re.compile(r'\s{0,3}(```+|~~~+)')
+    HEADING  = re.compile(r'\s{0,3}#{1,6}(\s|$)')
+    QUOTE    = re.compile(r'\s{0,3}>')
+    LIST     = re.compile(r'\s*([-*+]|\d+[.)])\s')
+    INLINE   = re.compile(
+        r'(?P<code>`+)(?P<code_text>.+?)(?P=code)'
+        r'|(?P<strong>\*\*[^*\s](?:.*?[^*\s])?\*\*|__[^_\s](?:.*?[^_\s])?__)'
+        r'|(?P<emphasis>\*[^*\s](?:[^*]*?[^*\s])?\*|\b_[^_\s](?:[^_]*?[^_\s])?_\b)'
+        r'|(?P<link>!?\[[^\]]*\]\([^)]*\))')
+
+    def tokenize(self, line, state):
+        fence = MarkdownHighlighter.FENCE.match(line)
+        if state is not None:
+            # Inside a code block, which ends with the same kind of fence
+            if fence and fence.group(1).startswith(state):
+                state = None
+            return [(0, len(line), 'code')], state
+        if fence:
+            return [(0, len(line), 'code')], fence.group(1)
+        if MarkdownHighlighter.HEADING.match(line):
+            return [(0, len(line), 'heading')], None
+        if MarkdownHighlighter.QUOTE.match(line):
+            return [(0, len(line), 'quote')], None
+
+        spans = []
+        start = 0
+        marker = MarkdownHighlighter.LIST.match(line)
+        if marker:
+            spans.append((marker.start(1), marker.end(1), 'list'))
+            start = marker.end()
+        for match in MarkdownHighlighter.INLINE.finditer(line, start):
+            spans.append((match.start(), match.end(), match.lastgroup
+                if match.lastgroup != 'code_text' else 'code'))
+        return spans, None
+
+# Highlighters for file name extensions
+HIGHLIGHTERS = {
+    '.md':       MarkdownHighlighter,
+    '.markdown': MarkdownHighlighter,
+}
+
+def for_filename(filename):
+    "Return a highlighter for a file, or None if there is none for its type"
+    ext = os.path.splitext(filename or '')[1].lower()
+    cls = HIGHLIGHTERS.get(ext)
+    return cls() if cls else None
+
+#==============================================================================
+# The per-line cache of lexer states
+#==============================================================================
+
+# The state of a line that has not been tokenized. Highlighters may use None.
+_UNKNOWN = object()
+
+class HighlightCache(object):
+    '''
+    Highlights the lines of a Document, caching the lexer state at the end of
+    every line. The states of lines [0, valid) are exact. States after that
+    are unknown or guesses, made by tokenizing from SYNC_LINES lines before
+    a line that is drawn far ahead of the exact ones.
+
+    After an edit, lines are retokenized from the edit only until their end
+    state is the same as before, and at most EDIT_LINES past it. The rest,
+    like most of a large file that was just opened, is tokenized lazily by
+    highlight_pending(). Whenever that changes the state that a line starts
+    with, on_repaint(start, end) is called for the lines [start, end) whose
+    highlighting may have changed.
+    '''
+    SYNC_LINES = 200
+    EDIT_LINES = 1000
+
+    def __init__(self, doc, highlighter, on_repaint=None):
+        self.doc         = doc
+        self.highlighter = highlighter
+        self.on_repaint  = on_repaint
+        self.states      = [_UNKNOWN] * len(doc.lines)
+        self.valid       = 0
+        doc.add_listener(self._on_change)
+
+    def close(self):
+        "Stop following changes to the document"
+        self.doc.remove_listener(self._on_change)
+
+    def pending(self):
+        "Return true if there are lines left to tokenize"
+        return self.valid < len(self.states)
+
+    def spans(self, y):
+        "Return the (start, end, style) spans of line y"
+        spans, state = self.highlighter.tokenize(self.doc.lines[y],
+            self._state_before(y))
+        if y >= self.valid:
+            self._store(y, state)
+            if y == self.valid:
+                self.valid += 1
+        return spans
+
+    def _store(self, y, state):
+        '''
+        Set the state at the end of line y, which is not one of the exact
+        ones. If it changed, the next line may have been drawn with the old
+        one, so it is repainted.
+        '''
+        old = self.states[y]
+        self.states[y] = state
+        if old is not _UNKNOWN and old != state and y + 1 < len(self.states):
+            self._repaint(y + 1, y + 2)
+
+    def _state_before(self, y):
+        "Return the state at the start of line y, exact if it is near enough"
+        if y == 0:
+            return self.highlighter.initial_state
+        if y <= self.valid:
+            return self.states[y-1]
+        if y - self.valid <= HighlightCache.SYNC_LINES:
+            self.highlight_pending(y - self.valid)
+            return self.states[y-1]
+        if self.states[y-1] is _UNKNOWN:
+            # Guess, by tokenizing the lines before from the initial state
+            state = self.highlighter.initial_state
+            start = y - HighlightCache.SYNC_LINES
+            for i, line in enumerate(self.doc.lines[start:y], start):
+                state = self.highlighter.tokenize(line, state)[1]
+                self._store(i, state)
+        return self.states[y-1]
+
+    def highlight_pending(self, limit=2000):
+        '''
+        Tokenize up to `limit` of the lines after the exact ones, for example
+        while the user is idle. Returns true if there are more to do.
+        '''
+        start = self.valid
+        end = min(start + limit, len(self.states))
+        state = self.states[start-1] if start else self.highlighter.initial_state
+        for y, line in enumerate(self.doc.lines[start:end], start):
+            state = self.highlighter.tokenize(line, state)[1]
+            self._store(y, state)
+        self.valid = end
+        return self.pending()
+
+    def _on_change(self, start, end, count):
+        "Document listener. Retokenize from the edit until the states converge."
+        self.states[start:end] = [_UNKNOWN] * count
+        if end >= self.valid:
+            # The state the next line was drawn with is gone, so draw it again
+            self.valid = min(self.valid, start)
+            self._repaint(start + count, min(start + count + 1, len(self.states)))
+            return
+        self.valid += count - (end - start)
+
+        state = self.states[start-1] if start else self.highlighter.initial_state
+        y = start
+        while y < self.valid:
+            if y >= start + count + HighlightCache.EDIT_LINES:
+                self.valid = y
+                break
+            old = self.states[y]
+            state = self.highlighter.tokenize(self.doc.lines[y], state)[1]
+            self.states[y] = state
+            if y >= start + count and state == old:
+                break
+            y += 1
+
+        # The lines after the edit, up to where the states converged, now
+        # start in a different state
+        self._repaint(start + count, min(y + 1, len(self.states)))
+
+    def _repaint(self, start, end):
+        if self.on_repaint and start < end:
+            self.on_repaint(start, end)
@@ -0,0 +1,288 @@
+import json
+import os
+import Queue
+import tempfile
+import threading
+import zlib
+
+#==============================================================================
+# A crash-safe journal of the edits to a document. Every change is appended
+# to a journal file next to the document, so that if evdoc dies before the
+# document is saved, the edits can be replayed on top of the file when it is
+# next opened.
+#
+# The journal starts with a base record naming the file the changes apply
+# to, which is the document's own file as it was when loaded or last saved,
+# or a checkpoint: a copy of the document written once the journal grows too
+# long, so that replaying it stays quick. Changes are kept in memory as they
+# happen, and handed to a writer thread in batches by flush(), so typing
+# never waits for the disk.
+#
+# Each record is a header line of "kind version start end size crc" followed
+# by `size` bytes of data. The kind is B for the base, whose data is JSON,
+# C for a change that replaced lines [start, end) with the lines in the data,
+# or D for one that deleted them. A record cut short by a crash fails its
+# checksum, and it and everything after it are ignored.
+#==============================================================================
+
+def journal_path(filename):
+    "Return the name of the journal for a file"
+    directory, name = os.path.split(os.path.abspath(filename))
+    return os.path.join(directory, '.' + name + '.evdoc-journal')
+
+def checkpoint_path(filename, version):
+    "Return the name of the checkpoint of a file at a document version"
+    return journal_path(filename) + '.%d' % version
+
+def _journal_files(filename):
+    "Return the names of the journal of a file, its checkpoints and temporary files"
+    path = journal_path(filename)
+    directory, name = os.path.split(path)
+    return [os.path.join(directory, other) for other in os.listdir(directory)
+        if other == name or other.startswith(name + '.')]
+
+def file_identity(filename):
+    "Return a dict that tells whether a file has changed, or None if it does not exist"
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+def _record(kind, version, start, end, data):
+    "Return a journal record as a string"
+    return "%s %d %d %d %d %d\n%s" % (kind, version, start, end, len(data),
+        zlib.crc32(data) & 0xffffffff, data)
+
+def read_records(file):
+    '''
+    Iterate over the records of a journal file as tuples of (kind, version,
+    start, end, data). Stops at the first record that is incomplete or
+    damaged.
+    '''
+    while True:
+        header = file.readline()
+        try:
+            kind, version, start, end, size, crc = header.split()
+            version, start, end, size, crc = (int(version), int(start),
+                int(end), int(size), int(crc))
+        except ValueError:
+            return
+        data = file.read(size)
+        if len(data) != size or zlib.crc32(data) & 0xffffffff != crc:
+            return
+        yield kind, version, start, end, data
+
+def _read_base(records):
+    '''
+    Return the base record from the records of a journal, as a dict, or None
+    if there is none or the file it names has changed since
+    '''
+    for kind, version, start, end, data in records:
+        if kind != 'B':
+            return None
+        base = json.loads(data)
+        if file_identity(base['file']) != base['identity']:
+            return None
+        return base
+    return None
+
+def has_journal(filename):
+    "Return true if a file has a journal that recover() would replay"
+    try:
+        file = open(journal_path(filename), 'rb')
+    except IOError:
+        return False
+    with file:
+        return _read_base(read_records(file)) is not None
+
+def discard(filename):
+    "Remove the journal of a file and its checkpoints, if there are any"
+    try:
+        names = _journal_files(filename)
+    except OSError:
+        return
+    for name in names:
+        os.unlink(name)
+
+def recover(doc, filename):
+    '''
+    Replay the journal of a file into a document that has just loaded the
+    file, or is empty if the file does not exist. The journal is only used
+    if it is based on the file as it is now, or on a checkpoint of it.
+    Returns the number of changes replayed, or None if there was no usable
+    journal.
+    '''
+    filename = os.path.abspath(filename)
+    try:
+        file = open(journal_path(filename), 'rb')
+    except IOError:
+        return None
+    with file:
+        records = read_records(file)
+        base = _read_base(records)
+        if base is None:
+            return None
+
+        if base['file'] != filename:
+            # Load the checkpoint in place of the file. The document then
+            # differs from the file, even with no changes after it.
+            doc.load(base['file'])
+            doc.filename = filename
+            doc.saved_version = None
+        count = 0
+        for kind, version, start, end, data in records:
+            doc._apply(start, end, data.split("\n") if kind == 'C' else [])
+            count += 1
+        return count
+
+class Journal(object):
+    '''
+    The journal of the changes to a Document that is kept in a file. Call
+    begin() once the document has been loaded, flush() every now and then,
+    saved() after the document has been saved, and close() when done.
+    '''
+    # How often the app calls flush(), in seconds
+    FLUSH_INTERVAL = 1.0
+    # Start over from a checkpoint once the journal is bigger than this
+    CHECKPOINT_SIZE = 64 << 20
+
+    def __init__(self, doc, filename):
+        self.doc      = doc
+        self.filename = os.path.abspath(filename)
+        self.path     = journal_path(filename)
+        self.pending  = []      # Changes not yet given to the writer
+        self.size     = 0       # Bytes written since the base record
+        self.error    = None    # The last error the writer had, if any
+        self.file     = None
+        self.queue    = Queue.Queue()
+        self.thread   = threading.Thread(target=self._write_loop,
+            name='evdoc-journal')
+        self.thread.daemon = True
+        self.thread.start()
+        doc.add_listener(self._on_change)
+
+    def _on_change(self, start, end, count):
+        '''
+        Document listener. Keep the new lines until the next flush. A change
+        that replaces exactly the lines of the one before it, such as typing
+        on one line, replaces that change.
+        '''
+        lines = self.doc.lines.copy_lines(start, start + count)
+        if self.pending:
+            version, last_start, last_end, last_lines = self.pending[-1]
+            if start == last_start and end == last_start + len(last_lines):
+                self.pending[-1] = (self.doc.version, start, last_end, lines)
+                return
+        self.pending.append((self.doc.version, start, end, lines))
+
+    def begin(self):
+        "Start a new journal, based on the document's file as it is now"
+        self.pending = []
+        self.size = 0
+        self.queue.put(('begin', self.doc.version, self.filename))
+
+    def checkpoint(self):
+        "Start a new journal, based on a copy of the document as it is now"
+        self.pending = []
+        self.size = 0
+        self.queue.put(('checkpoint', self.doc.version, self.doc.snapshot()))
+
+    def saved(self, snapshot):
+        "The document was saved from a snapshot. Start over from the file."
+        if snapshot.version == self.doc.version:
+            self.begin()
+        else:
+            # The document was edited during the save
+            self.checkpoint()
+
+    def flush(self):
+        "Give the changes so far to the writer thread"
+        if self.size > Journal.CHECKPOINT_SIZE:
+            self.checkpoint()
+        elif self.pending:
+            self.queue.put(('changes', self.pending))
+            self.pending = []
+
+    def close(self, discard=False):
+        '''
+        Write the changes so far, and stop the writer. If `discard`, for
+        when the document has no unsaved changes, remove the journal.
+        '''
+        if discard:
+            self.pending = []
+            self.queue.put(('discard',))
+        else:
+            self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.doc.remove_listener(self._on_change)
+
+    #--------------------------------------------------------------------------
+    # The writer thread
+    #--------------------------------------------------------------------------
+
+    def _write_loop(self):
+        while True:
+            op = self.queue.get()
+            if op is None:
+                break
+            try:
+                getattr(self, '_' + op[0])(*op[1:])
+            except (IOError, OSError) as e:
+                # Keep going; a later checkpoint may work
+                self.error = e
+        if self.file:
+            self.file.close()
+
+    def _begin(self, version, base):
+        "Replace the journal with one holding only a base record"
+        data = json.dumps({'file': base, 'identity': file_identity(base)})
+        directory = os.path.dirname(self.path)
+        fd, temp = tempfile.mkstemp(dir=directory,
+            prefix=os.path.basename(self.path) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(_record('B', version, 0, 0, data))
+                file.flush()
+                os.fsync(file.fileno())
+            os.rename(temp, self.path)
+        except:
+            os.unlink(temp)
+            raise
+        if self.file:
+            self.file.close()
+        self.file = open(self.path, 'ab')
+
+        # Checkpoints other than the base are not needed any more
+        for name in _journal_files(self.filename):
+            if name not in (self.path, base) and not name.endswith('.tmp'):
+                os.unlink(name)
+
+    def _checkpoint(self, version, snapshot):
+        "Write a snapshot to a checkpoint, and start a journal based on it"
+        name = checkpoint_path(self.filename, version)
+        snapshot.save(name)
+        self._begin(version, name)
+
+    def _changes(self, changes):
+        "Append changes to the journal"
+        if not self.file:
+            return
+        for version, start, end, lines in changes:
+            if len(lines):
+                data = "\n".join(text for text, count in lines.iter_blocks())
+                record = _record('C', version, start, end, data)
+            else:
+                record = _record('D', version, start, end, '')
+            self.file.write(record)
+            self.size += len(record)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def _discard(self):
+        "Remove the journal and its checkpoints"
+        if self.file:
+            self.file.close()
+            self.file = None
+        discard(self.filename)
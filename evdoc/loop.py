@@ -0,0 +1,225 @@
+import collections
+import errno
+import fcntl
+import heapq
+import itertools
+import os
+import Queue
+import select
+import threading
+import time
+
+#==============================================================================
+# The event loop of the app. It waits for input on file descriptors, runs
+# timers, and runs heavy jobs on a pool of worker threads. Callbacks always
+# run on the thread that runs the loop, which is the only one that may touch
+# the UI or the live document; workers should only read snapshots.
+#==============================================================================
+
+class Timer(object):
+    "A function to call at a given time. See EventLoop.call_later()."
+    def __init__(self, when, func, args):
+        self.when      = when
+        self.func      = func
+        self.args      = args
+        self.cancelled = False
+
+    def cancel(self):
+        "Do not call the function"
+        self.cancelled = True
+
+class Job(object):
+    '''
+    A function run on a worker thread. When it finishes, the callback is
+    called on the loop thread as callback(job), with either job.result or
+    job.error set. job.error is the exception the function raised.
+    '''
+    def __init__(self, func, args, callback):
+        self.func      = func
+        self.args      = args
+        self.callback  = callback
+        self.result    = None
+        self.error     = None
+        self.done      = False
+        self.cancelled = False
+
+    def cancel(self):
+        "Do not call the callback. The function still runs if it has started."
+        self.cancelled = True
+
+    def run(self):
+        "Run the function. Called on a worker thread."
+        try:
+            self.result = self.func(*self.args)
+        except Exception as e:
+            self.error = e
+
+class WorkerPool(object):
+    '''
+    A fixed number of worker threads, started when the first job is submitted,
+    which run jobs in the order they were submitted.
+    '''
+    def __init__(self, loop, count):
+        self.loop    = loop
+        self.count   = count
+        self.jobs    = Queue.Queue()
+        self.threads = []
+
+    def submit(self, job):
+        "Queue a job for the next free worker"
+        if not self.threads:
+            for i in xrange(self.count):
+                thread = threading.Thread(target=self._work,
+                    name="evdoc-worker-%d" % i)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        self.jobs.put(job)
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            if not job.cancelled:
+                job.run()
+            self.loop.call_soon_threadsafe(self.loop._finish, job)
+
+    def shutdown(self):
+        "Let the workers finish the queued jobs, and wait for them to stop"
+        for thread in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+class EventLoop(object):
+    # The number of worker threads
+    WORKERS = 2
+
+    def __init__(self, logger, workers=None):
+        self.logger  = logger
+        self.readers = {}       # File descriptor -> function to call
+        self.timers  = []       # Heap of (when, sequence, Timer)
+        self.ready   = collections.deque()  # Calls posted by other threads
+        self.pending = 0        # Jobs submitted and not finished
+        self.pool    = WorkerPool(self, workers or EventLoop.WORKERS)
+        self.counter = itertools.count()
+
+        # Other threads wake the loop by writing to a pipe
+        self.wake_read, self.wake_write = os.pipe()
+        for fd in (self.wake_read, self.wake_write):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    @staticmethod
+    def wait_readable(fds, timeout):
+        '''
+        Wait until some of the file descriptors are readable, or for at most
+        `timeout` seconds if it is not None, and return the readable ones
+        '''
+        return select.select(fds, [], [], timeout)[0]
+
+    def add_reader(self, fd, func):
+        "Call func() whenever a file descriptor is readable"
+        self.readers[fd] = func
+
+    def remove_reader(self, fd):
+        "Stop watching a file descriptor added with add_reader()"
+        self.readers.pop(fd, None)
+
+    def call_later(self, delay, func, *args):
+        "Call func(*args) after `delay` seconds. Returns a Timer."
+        timer = Timer(time.time() + delay, func, args)
+        heapq.heappush(self.timers, (timer.when, next(self.counter), timer))
+        return timer
+
+    def call_soon_threadsafe(self, func, *args):
+        "Call func(*args) on the loop thread as soon as possible. For any thread."
+        self.ready.append((func, args))
+        try:
+            os.write(self.wake_write, 'x')
+        except OSError as e:
+            # The pipe is full, so the loop will wake anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def run_in_worker(self, func, args=(), callback=None):
+        '''
+        Run func(*args) on a worker thread, then call callback(job) on the
+        loop thread. Returns the Job.
+        '''
+        job = Job(func, args, callback)
+        self.pending += 1
+        self.pool.submit(job)
+        return job
+
+    def _finish(self, job):
+        self.pending -= 1
+        job.done = True
+        if job.error is not None:
+            self.logger.warning("Job %s failed: %s", job.func.__name__, job.error)
+        if job.callback and not job.cancelled:
+            job.callback(job)
+
+    def run_once(self):
+        '''
+        Wait for input, a timer or a finished job, and call the functions for
+        whatever is ready
+        '''
+        while self.timers and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)
+        timeout = None
+        for_timer = self.timers and not self.ready
+        if self.ready:
+            timeout = 0
+        elif self.timers:
+            timeout = max(self.timers[0][0] - time.time(), 0)
+
+        fds = [self.wake_read] + self.readers.keys()
+        try:
+            readable = EventLoop.wait_readable(fds, timeout)
+        except (select.error, OSError) as e:
+            # A signal such as SIGWINCH interrupted the wait. Curses reports
+            # a resize as a key, so let the readers look for input.
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = self.readers.keys()
+        now = time.time()
+        if for_timer and not readable:
+            # The wait timed out, so the first timer is due, even if the
+            # clock says it is a little early
+            now = max(now, self.timers[0][0])
+
+        if self.wake_read in readable:
+            try:
+                while os.read(self.wake_read, 4096):
+                    pass
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+        while self.ready:
+            func, args = self.ready.popleft()
+            func(*args)
+
+        while self.timers and self.timers[0][0] <= now:
+            timer = heapq.heappop(self.timers)[2]
+            if not timer.cancelled:
+                timer.func(*timer.args)
+
+        for fd in readable:
+            func = self.readers.get(fd)
+            if func:
+                func()
+
+    def close(self):
+        '''
+        Finish the jobs that were submitted, and close the loop. Finished
+        jobs do not call their callbacks any more.
+        '''
+        if self.wake_read is None:
+            return
+        self.pool.shutdown()
+        os.close(self.wake_read)
+        os.close(self.wake_write)
+        self.wake_read = self.wake_write = None
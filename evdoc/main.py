@@ -1,8 +1,24 @@
 import argparse
-import curses
 import sys
 import evdoc
 
+def megabytes(text):
+    "Convert a number of megabytes given on the command line to bytes"
+    try:
+        return int(float(text) * (1 << 20))
+    except ValueError:
+        raise argparse.ArgumentTypeError("not a number: %s" % text)
+
+def positive(text):
+    "Convert a count given on the command line to an int of at least 1"
+    try:
+        count = int(text)
+    except ValueError:
+        count = 0
+    if count < 1:
+        raise argparse.ArgumentTypeError("not a positive number: %s" % text)
+    return count
+
 def run():
     "Run the evdoc program"
 
@@ -13,18 +29,86 @@ def run():
     )
     parser.add_argument('-d', '--debug', dest='debug', default=False,
         action='store_true', help='Print debugging output to file debug.log')
+    parser.add_argument('-l', '--logfile', dest='logfile', default=None,
+        metavar='FILE', help='Print debugging output to the given file')
+    parser.add_argument('--log-level', dest='log_level', default='debug',
+        choices=['debug', 'info', 'warning', 'error'],
+        help='The lowest level of message to log (default: debug)')
+    parser.add_argument('--memory-budget', dest='memory_budget', default=None,
+        type=megabytes, metavar='MB',
+        help='Evict buffers not shown when the open documents take more '
+            'memory than this (default: %d)' % (evdoc.buffers.BufferList.BUDGET >> 20))
+    parser.add_argument('--profile-startup', dest='profile_startup',
+        default=False, action='store_true',
+        help='Print how long each phase of starting up took, on exit')
+    parser.add_argument('--stats', dest='stats', default=False,
+        action='store_true',
+        help='Time each phase of handling keys, for the stats command')
+    parser.add_argument('--stats-file', dest='stats_file', default=None,
+        metavar='FILE',
+        help='Time each phase of handling keys, and write the timings to '
+            'FILE as JSON on exit')
+    parser.add_argument('-c', '--client', dest='client', default=False,
+        action='store_true',
+        help='Edit in the evdoc server, starting one if none is running')
+    parser.add_argument('--server', dest='server', default=False,
+        action='store_true',
+        help='Run a server that keeps documents open between sessions')
+    parser.add_argument('--batch', dest='batch', default=None,
+        metavar='SCRIPT',
+        help='Run the prompt commands in SCRIPT on each file, without a '
+            'screen, and save the files changed')
+    parser.add_argument('-j', '--jobs', dest='jobs', default=None,
+        type=positive, metavar='N',
+        help='With --batch, edit N files at once (default: one per CPU)')
     parser.add_argument('--version', dest='version', default=False,
         action='store_true', help='Print the version and exit')
+    parser.add_argument('files', nargs='*', metavar='file',
+        help='The file to edit, or with --batch, the files')
     args = parser.parse_args()
+    if len(args.files) > 1 and not args.batch:
+        parser.error("only one file can be edited at a time, except with --batch")
+    args.file = args.files[0] if args.files else None
 
     # Show version?
     if args.version:
+        import curses
         pyver = sys.version_info
         python_version = "%s.%s.%s" % (pyver.major, pyver.minor, pyver.micro)
         print "evdoc version %s (using Python %s, curses %s)" % \
           (evdoc.VERSION, python_version, curses.version)
         sys.exit()
 
+    # Edit files without a screen
+    if args.batch:
+        sys.exit(batch(args))
+
+    # Run a server, or attach to one
+    if args.server or args.client:
+        import evdoc.server as server
+        try:
+            if args.server:
+                server.Server(args).serve()
+            else:
+                server.connect().attach(args.file)
+        except server.ServerError as e:
+            sys.exit("evdoc: %s" % e)
+        return
+
     # Run the app
+    edit(args)
+
+def batch(args):
+    "Run a batch script on the files given, returning the exit status"
+    import evdoc.batch
+    try:
+        script = evdoc.batch.Script.load(args.batch)
+    except evdoc.batch.ScriptError as e:
+        return "evdoc: %s" % e
+    return 1 if evdoc.batch.run(script, args.files, args.jobs) else 0
+
+def edit(args):
+    "Run the editor"
+    import evdoc.app
     app = evdoc.app.App(args)
     app.start()
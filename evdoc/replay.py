@@ -0,0 +1,331 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import evdoc
+import evdoc.app
+import evdoc.headless
+import evdoc.search
+
+#==============================================================================
+# Replays keystroke traces against the app running on the headless terminal,
+# and reports how long each input took to handle and how much rendering it
+# caused.
+#
+# A trace is a dict with a name, an optional terminal size, document and file
+# name for it, and a list of events. Each event is one of:
+#   {"type": "keys", "keys": "hello"}           - typed one key at a time
+#   {"type": "paste", "text": "a\nb"}           - arrives as one burst
+#   {"type": "key", "key": "KEY_DOWN", "repeat": 10}
+#   {"type": "key", "key": "KEY_DOWN", "repeat": 10, "burst": true}
+#   {"type": "resize", "rows": 40, "cols": 120}
+#   {"type": "click", "y": 5, "x": 10}
+# Key names are names of curses constants or of curses.ascii characters, such
+# as KEY_NPAGE, ESC, LF or DEL. Repeated keys arrive one at a time, or all at
+# once with "burst", like a held key that repeats faster than it is handled.
+#==============================================================================
+
+def key_code(name):
+    "Return the key code for a key name such as 'KEY_UP' or 'ESC'"
+    curses = evdoc.headless
+    if hasattr(curses, name):
+        return getattr(curses, name)
+    if hasattr(curses.ascii, name):
+        return getattr(curses.ascii, name)
+    if len(name) == 1:
+        return ord(name)
+    raise ValueError("Unknown key: %s" % name)
+
+def feed_event(terminal, event):
+    "Queue the input for a trace event on the headless terminal"
+    kind = event['type']
+    if kind == 'keys':
+        for c in event['keys']:
+            terminal.feed([ord(c)])
+    elif kind == 'paste':
+        terminal.feed([ord(c) for c in event['text']])
+    elif kind == 'key':
+        keys = [key_code(event['key'])] * event.get('repeat', 1)
+        if event.get('burst'):
+            terminal.feed(keys)
+        else:
+            for c in keys:
+                terminal.feed([c])
+    elif kind == 'resize':
+        terminal.feed([(event['rows'], event['cols'])])
+    elif kind == 'click':
+        curses = evdoc.headless
+        terminal.feed([curses.KEY_MOUSE],
+            (event['y'], event['x'], curses.BUTTON1_CLICKED))
+    else:
+        raise ValueError("Unknown event type: %s" % kind)
+
+def percentile(values, pct):
+    "Return the given percentile of a list of numbers"
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+class Args(object):
+    "Command line arguments for the App"
+    def __init__(self, **kwargs):
+        self.debug     = False
+        self.logfile   = None
+        self.log_level = 'debug'
+        self.file      = None
+        self.memory_budget = None
+        self.profile_startup = False
+        self.stats     = False
+        self.stats_file = None
+        self.__dict__.update(kwargs)
+
+def replay(trace):
+    '''
+    Run the app on a headless terminal with the input of a trace, and return
+    the results as a dict.
+    '''
+    rows, cols = trace.get('rows', 24), trace.get('cols', 80)
+    terminal = evdoc.headless.install(rows, cols)
+    directory = tempfile.mkdtemp(prefix='evdoc-replay-')
+
+    # Frames drawn in the middle of a burst, and how much of a search is
+    # done in each idle slice, depend on the speed of the machine, so turn
+    # them off to keep the counters exact
+    interval = evdoc.ui.RenderScheduler.FRAME_INTERVAL
+    scan_time = evdoc.search.Search.SCAN_TIME
+    evdoc.ui.RenderScheduler.FRAME_INTERVAL = float('inf')
+    evdoc.search.Search.SCAN_TIME = float('inf')
+    try:
+        # Write the starting document, if there is one
+        filename = None
+        if 'document' in trace:
+            filename = os.path.join(directory,
+                trace.get('filename', 'document.txt'))
+            with open(filename, 'w') as file:
+                file.write(make_document(trace['document']))
+
+        for event in trace['events']:
+            feed_event(terminal, event)
+        evdoc.app.App(Args(file=filename)).start()
+    finally:
+        evdoc.ui.RenderScheduler.FRAME_INTERVAL = interval
+        evdoc.search.Search.SCAN_TIME = scan_time
+        evdoc.headless.uninstall()
+        shutil.rmtree(directory)
+
+    ms = [t * 1000 for t in terminal.latencies]
+    return {
+        'trace':       trace['name'],
+        'inputs':      len(ms),
+        'p50_ms':      percentile(ms, 50),
+        'p90_ms':      percentile(ms, 90),
+        'p99_ms':      percentile(ms, 99),
+        'max_ms':      max(ms) if ms else 0.0,
+        'doupdate':    terminal.counts.get('doupdate', 0),
+        'noutrefresh': terminal.counts.get('noutrefresh', 0),
+        'addstr':      terminal.counts.get('addstr', 0),
+        'bytes':       terminal.bytes,
+    }
+
+def make_document(spec):
+    '''
+    Return the text of a document for a trace. The spec is either the text
+    itself, or a dict with the number of lines and their width.
+    '''
+    if isinstance(spec, basestring):
+        return spec
+    width = spec.get('width', 60)
+    words = "the quick brown fox jumps over the lazy dog ".split()
+    lines = []
+    for i in xrange(spec.get('lines', 1000)):
+        line = "%d:" % i
+        while len(line) < width:
+            line += ' ' + words[(i + len(line)) % len(words)]
+        lines.append(line[:width])
+    return "\n".join(lines)
+
+#==============================================================================
+# Built-in traces covering the hot paths
+#==============================================================================
+
+PROSE = ("It was a bright cold day in April, and the clocks were striking "
+    "thirteen.\n")
+
+MARKDOWN = '''# Notes
+
+Some *emphasis*, **strong** text, `code` and a [link](http://example.com).
+
+- one
+- two
+> quoted
+
+```
+code block
+```
+'''
+
+def builtin_traces():
+    "Return the list of built-in traces"
+    typing = [{'type': 'keys', 'keys': PROSE * 20},
+              {'type': 'key', 'key': 'DEL', 'repeat': 50},
+              {'type': 'keys', 'keys': PROSE * 5}]
+
+    pasting = [{'type': 'paste', 'text': PROSE * 500},
+               {'type': 'keys', 'keys': "typed after the paste\n"}] * 10
+
+    scrolling = [{'type': 'key', 'key': 'KEY_DOWN', 'repeat': 300},
+                 {'type': 'key', 'key': 'KEY_NPAGE', 'repeat': 50},
+                 {'type': 'key', 'key': 'KEY_PPAGE', 'repeat': 50},
+                 {'type': 'key', 'key': 'KEY_UP', 'repeat': 300},
+                 {'type': 'key', 'key': 'ESC'},
+                 {'type': 'keys', 'keys': "4000\n"},
+                 {'type': 'key', 'key': 'KEY_DOWN', 'repeat': 100},
+                 {'type': 'click', 'y': 10, 'x': 10}]
+
+    holding = [{'type': 'key', 'key': 'KEY_DOWN', 'repeat': 200, 'burst': True},
+               {'type': 'key', 'key': 'KEY_RIGHT', 'repeat': 30, 'burst': True},
+               {'type': 'key', 'key': 'DEL', 'repeat': 30, 'burst': True},
+               {'type': 'key', 'key': 'KEY_UP', 'repeat': 100, 'burst': True}]
+
+    markdown = [{'type': 'key', 'key': 'KEY_NPAGE', 'repeat': 20},
+                {'type': 'keys', 'keys': "```\n"},
+                {'type': 'key', 'key': 'KEY_DOWN', 'repeat': 30},
+                {'type': 'keys', 'keys': "*more* text\n"},
+                {'type': 'key', 'key': 'ESC'},
+                {'type': 'keys', 'keys': "3000\n"},
+                {'type': 'key', 'key': 'KEY_UP', 'repeat': 30}]
+
+    undoing = [{'type': 'keys', 'keys': PROSE * 5},
+               {'type': 'paste', 'text': PROSE * 500},
+               {'type': 'key', 'key': 'US', 'repeat': 20},
+               {'type': 'key', 'key': 'DC2', 'repeat': 20}]
+
+    searching = [{'type': 'key', 'key': 'ESC'},
+                 {'type': 'keys', 'keys': "/lazy"},
+                 {'type': 'key', 'key': 'LF'},
+                 {'type': 'key', 'key': 'SO', 'repeat': 30},
+                 {'type': 'key', 'key': 'DLE', 'repeat': 10},
+                 {'type': 'key', 'key': 'ESC'},
+                 {'type': 'keys', 'keys': "r/^9+:"},
+                 {'type': 'key', 'key': 'LF'},
+                 {'type': 'key', 'key': 'SO', 'repeat': 20},
+                 {'type': 'key', 'key': 'ESC'},
+                 {'type': 'keys', 'keys': "?no such text"},
+                 {'type': 'key', 'key': 'ESC'}]
+
+    replacing = [{'type': 'key', 'key': 'ESC'},
+                 {'type': 'keys', 'keys': "/lazy\n"},
+                 {'type': 'key', 'key': 'ESC'},
+                 {'type': 'keys', 'keys': "replace sleepy\n"},
+                 {'type': 'key', 'key': 'US'},
+                 {'type': 'key', 'key': 'DC2'}]
+
+    resizing = []
+    for i in xrange(20):
+        resizing.append({'type': 'resize', 'rows': 24 + i % 3 * 10,
+            'cols': 80 + i % 4 * 20})
+        resizing.append({'type': 'keys', 'keys': "resized\n"})
+        resizing.append({'type': 'key', 'key': 'KEY_DOWN', 'repeat': 5})
+
+    return [
+        {'name': 'typing',    'events': typing},
+        {'name': 'pasting',   'events': pasting},
+        {'name': 'scrolling', 'events': scrolling,
+            'document': {'lines': 5000}},
+        {'name': 'holding',   'events': holding,
+            'document': {'lines': 5000}},
+        {'name': 'markdown',  'events': markdown,
+            'document': MARKDOWN * 500, 'filename': 'notes.md'},
+        {'name': 'undoing',   'events': undoing,
+            'document': {'lines': 100000}},
+        {'name': 'searching', 'events': searching,
+            'document': {'lines': 100000}},
+        {'name': 'replacing', 'events': replacing,
+            'document': {'lines': 100000}},
+        {'name': 'resizing',  'events': resizing,
+            'document': {'lines': 1000}},
+    ]
+
+#==============================================================================
+# Command line interface
+#==============================================================================
+
+COLUMNS = ['inputs', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms', 'doupdate',
+    'noutrefresh', 'addstr', 'bytes']
+
+# Results that do not depend on the speed of the machine, and so can be
+# checked exactly against a baseline
+COUNTERS = ['doupdate', 'noutrefresh', 'addstr', 'bytes']
+
+def format_table(results):
+    "Format a list of results as a text table"
+    lines = ["%-10s" % 'trace' + ''.join("%12s" % c for c in COLUMNS)]
+    for result in results:
+        cells = []
+        for c in COLUMNS:
+            value = result[c]
+            cells.append("%12.3f" % value if isinstance(value, float) else
+                "%12d" % value)
+        lines.append("%-10s" % result['trace'] + ''.join(cells))
+    return "\n".join(lines)
+
+def regressions(results, baseline, tolerance, latency):
+    '''
+    Compare results to a baseline, and return a list of messages for every
+    counter (and latency, if asked) that grew by more than the tolerance.
+    '''
+    previous = dict((r['trace'], r) for r in baseline)
+    checked = COUNTERS + (['p50_ms', 'p99_ms'] if latency else [])
+    messages = []
+    for result in results:
+        old = previous.get(result['trace'])
+        if not old:
+            continue
+        for c in checked:
+            if result[c] > old[c] * (1 + tolerance) and result[c] > old[c] + 1:
+                messages.append("%s: %s went from %s to %s" %
+                    (result['trace'], c, old[c], result[c]))
+    return messages
+
+def run(argv=None):
+    "Run the replay benchmark from the command line. Returns the exit status."
+    parser = argparse.ArgumentParser(
+        description='Replay keystroke traces against a headless evdoc.')
+    parser.add_argument('traces', nargs='*', metavar='TRACE',
+        help='JSON trace files to replay (default: the built-in traces)')
+    parser.add_argument('--json', dest='json', default=None, metavar='FILE',
+        help='Write the results to a JSON file')
+    parser.add_argument('--baseline', dest='baseline', default=None,
+        metavar='FILE', help='Fail if results regressed from this JSON file')
+    parser.add_argument('--tolerance', dest='tolerance', default=10.0,
+        type=float, metavar='PCT', help='Allowed regression (default: 10%%)')
+    parser.add_argument('--check-latency', dest='latency', default=False,
+        action='store_true', help='Also check latencies against the baseline')
+    args = parser.parse_args(argv)
+
+    traces = builtin_traces()
+    if args.traces:
+        traces = []
+        for name in args.traces:
+            with open(name) as file:
+                traces.append(json.load(file))
+
+    results = [replay(trace) for trace in traces]
+    print format_table(results)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        messages = regressions(results, baseline, args.tolerance / 100.0,
+            args.latency)
+        for message in messages:
+            print "REGRESSION: " + message
+        if messages:
+            return 1
+    return 0
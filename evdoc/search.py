@@ -0,0 +1,390 @@
+import bisect
+import re
+import sre_parse
+import time
+import evdoc.core
+
+#==============================================================================
+# Searching a document. A Search keeps an index of the matches of a pattern,
+# which is filled in incrementally: the lines on screen first, then outward
+# from there in slices, whenever the app is idle. After an edit only the
+# changed lines are scanned again.
+#
+# The index holds one item per matching line, in two CountIndex objects with
+# the same items. In `gaps` the count of an item is the distance from the line
+# before it that matches, so the line numbers of all later matches shift
+# by changing a single count. In `sizes` the count is the number of matches
+# in the line, and the data is their (start, end) spans.
+#==============================================================================
+
+def compile_pattern(pattern, regex=False):
+    '''
+    Compile a search pattern, which is taken literally unless `regex` is
+    true. Raises re.error if the regular expression is not valid.
+    '''
+    if not regex:
+        pattern = re.escape(pattern)
+    return re.compile(pattern, re.MULTILINE)
+
+def check_template(regex, template):
+    '''
+    Check a replacement for the matches of a compiled regular expression, in
+    which backreferences such as \\1 are expanded. Raises re.error if it is
+    not valid, such as if it refers to a group the expression does not have.
+    '''
+    try:
+        groups, literals = sre_parse.parse_template(template, regex)
+    except IndexError as e:
+        raise re.error(str(e))
+    for i, group in groups:
+        if group > regex.groups:
+            raise re.error("invalid group reference %d" % group)
+
+class Search(object):
+    '''
+    The matches of a pattern in a Document. Matches never span lines, and
+    empty matches are ignored. Lines in the ranges in `pending` have not been
+    scanned yet, and have no matches in the index.
+    '''
+    # scan_pending() scans this many lines at a time, up to SLICE_LINES
+    # lines or SCAN_TIME seconds in all
+    SCAN_LINES = 1024
+    SLICE_LINES = 100000
+    SCAN_TIME = 0.02
+    # Changes bigger than this are scanned by scan_pending(), not right away
+    EDIT_LINES = 1000
+
+    def __init__(self, doc, pattern, regex=False):
+        self.doc     = doc
+        self.pattern = pattern
+        self.regex   = compile_pattern(pattern, regex)
+        self.expand  = regex    # Expand backreferences when replacing
+        self.gaps    = evdoc.core.CountIndex()
+        self.sizes   = evdoc.core.CountIndex()
+        self.pending = [(0, len(doc.lines))]    # Sorted ranges not scanned
+        self.center  = 0    # Where scan_pending() spreads out from
+        doc.add_listener(self._on_change)
+
+    def close(self):
+        "Stop following changes to the document"
+        self.doc.remove_listener(self._on_change)
+
+    def done(self):
+        "Return true if the whole document has been scanned"
+        return not self.pending
+
+    def total(self):
+        "Return the number of matches found so far"
+        return self.sizes.total()
+
+    #--------------------------------------------------------------------------
+    # Looking up matches
+    #--------------------------------------------------------------------------
+
+    def _line(self, i):
+        "Return the line number of item i"
+        return self.gaps.prefix(i + 1) - 1
+
+    def _item_at(self, y):
+        "Return (i, line) for the first item whose line is y or after, or (count, None)"
+        i, rest = self.gaps.find(y)
+        if i == len(self.gaps):
+            return i, None
+        return i, self._line(i)
+
+    def spans(self, y):
+        "Return the (start, end) spans of the matches in line y"
+        self.scan(y, y + 1)
+        i, line = self._item_at(y)
+        return self.sizes.get(i)[1] if line == y else ()
+
+    def rank(self, y, x):
+        "Return the number of matches that start before (y, x)"
+        i, line = self._item_at(y)
+        before = self.sizes.prefix(i)
+        if line == y:
+            before += sum(1 for start, end in self.sizes.get(i)[1] if start < x)
+        return before
+
+    def find(self, y, x, forward=True, limit=None):
+        '''
+        Return (y, start, end) for the first match after (y, x), or the last
+        one before it if not `forward`, scanning lines in between as needed.
+        The search wraps around the ends of the document. Returns None if
+        there are no matches, or if none was found after scanning about
+        `limit` lines, if given.
+        '''
+        count = len(self.doc.lines)
+        budget = [limit]
+        if forward:
+            return (self._find_from(y, x, True, count, budget) or
+                self._find_from(0, -1, True, y + 1, budget))
+        return (self._find_from(y, x, False, 0, budget) or
+            self._find_from(count - 1, 1 << 62, False, y, budget))
+
+    def _find_from(self, y, x, forward, stop, budget):
+        '''
+        Like _find_scanned(), but for matches up to line `stop`, going forward,
+        or down to it, going back. The lines on the way are scanned a block at
+        a time, in bigger blocks as the search goes on, until the match found
+        is sure to be the nearest one, or budget[0] lines have been scanned.
+        '''
+        size = Search.SCAN_LINES
+        while True:
+            match = self._find_scanned(y, x, forward)
+            if forward:
+                bound = min(match[0] + 1, stop) if match else stop
+                pending = self._pending_in(y, bound)
+                found = match and match[0] < stop
+            else:
+                bound = max(match[0], stop) if match else stop
+                pending = self._pending_in(bound, y + 1)
+                found = match and match[0] >= stop
+            if not pending:
+                return match if found else None
+
+            if budget[0] is not None:
+                if budget[0] <= 0:
+                    return None
+                size = min(size, budget[0])
+            if forward:
+                first = max(pending[0][0], y)
+                last = min(pending[0][1], bound, first + size)
+            else:
+                last = min(pending[-1][1], y + 1)
+                first = max(pending[-1][0], bound, last - size)
+            self._scan(first, last)
+            if budget[0] is not None:
+                budget[0] -= last - first
+            size *= 2
+
+    def _find_scanned(self, y, x, forward):
+        "Like find(), but only look at scanned lines, and do not wrap around"
+        i, line = self._item_at(y)
+        if line == y:
+            spans = self.sizes.get(i)[1]
+            if forward:
+                for start, end in spans:
+                    if start > x:
+                        return (y, start, end)
+                i += 1
+            else:
+                for start, end in reversed(spans):
+                    if start < x:
+                        return (y, start, end)
+        if forward:
+            if i >= len(self.gaps):
+                return None
+        else:
+            i -= 1
+            if i < 0:
+                return None
+            spans = self.sizes.get(i)[1]
+            return (self._line(i),) + spans[-1]
+        return (self._line(i),) + self.sizes.get(i)[1][0]
+
+    #--------------------------------------------------------------------------
+    # Scanning
+    #--------------------------------------------------------------------------
+
+    def _pending_in(self, start, end):
+        "Return the pending ranges that overlap [start, end)"
+        i = bisect.bisect_right(self.pending, (start, start))
+        if i > 0 and self.pending[i-1][1] > start:
+            i -= 1
+        ranges = []
+        while i < len(self.pending) and self.pending[i][0] < end:
+            ranges.append(self.pending[i])
+            i += 1
+        return ranges
+
+    def scan(self, start, end):
+        "Scan the lines in [start, end) that are not scanned yet, such as those on screen"
+        for first, last in self._pending_in(start, end):
+            self._scan(max(first, start), min(last, end))
+
+    def scan_pending(self, timeout=None):
+        '''
+        Scan the lines that are not scanned yet for about `timeout` seconds,
+        or SCAN_TIME, nearest to the line `center` first. Returns true if
+        there are more to scan.
+        '''
+        deadline = time.time() + (timeout or Search.SCAN_TIME)
+        limit = Search.SLICE_LINES
+        while self.pending and limit > 0 and time.time() < deadline:
+            # Scan the range just after the center, or else the one nearest
+            # before it, from its end
+            i = bisect.bisect_right(self.pending, (self.center, self.center))
+            if i > 0 and self.pending[i-1][1] > self.center:
+                i -= 1
+            if i < len(self.pending):
+                first, last = self.pending[i]
+                first = max(first, self.center)
+                last = min(last, first + Search.SCAN_LINES)
+            else:
+                first, last = self.pending[i-1]
+                first = max(first, last - Search.SCAN_LINES)
+            self._scan(first, last)
+            limit -= last - first
+        return not self.done()
+
+    def _unpend(self, start, end):
+        "Remove the range [start, end) from the pending ranges"
+        pending = []
+        for first, last in self.pending:
+            if last <= start or first >= end:
+                pending.append((first, last))
+                continue
+            if first < start:
+                pending.append((first, start))
+            if last > end:
+                pending.append((end, last))
+        self.pending = pending
+
+    def _matches(self, start, end):
+        '''
+        Iterate over the lines in [start, end) with matches, as tuples of
+        (y, offset, matches), where matches are the match objects in line y,
+        whose offsets are off by `offset`
+        '''
+        search = self.regex.search
+        finditer = self.regex.finditer
+        y = start
+        for text, count in self.doc.lines.iter_blocks(start, end):
+            # Find the lines with a match quickly by searching the whole
+            # block, then find the matches in each of those lines
+            pos = 0
+            line = y
+            line_start = 0
+            while True:
+                match = search(text, pos)
+                if match is None:
+                    break
+                line += text.count("\n", line_start, match.start())
+                line_start = text.rfind("\n", 0, match.start()) + 1
+                line_end = text.find("\n", match.start())
+                if line_end < 0:
+                    line_end = len(text)
+                found = [m for m in finditer(text, line_start, line_end)
+                    if m.end() > m.start()]
+                if found:
+                    yield line, line_start, found
+                pos = line_end + 1
+                if pos > len(text):
+                    break
+            y += count
+
+    def _scan(self, start, end):
+        "Scan the lines in [start, end), which must all be pending"
+        lines = []
+        spans = []
+        for y, offset, matches in self._matches(start, end):
+            lines.append(y)
+            spans.append(tuple((m.start() - offset, m.end() - offset)
+                for m in matches))
+        self._unpend(start, end)
+        self._insert(start, end, lines, spans)
+
+    def _insert(self, start, end, lines, spans):
+        '''
+        Replace the items of lines in [start, end), in which line numbers have
+        already been shifted, with the given ones
+        '''
+        first, first_line = self._item_at(start)
+        last, next_line = self._item_at(end)
+        before = self._line(first - 1) if first > 0 else -1
+
+        # The item after the range keeps its line, but its gap changes
+        gaps = []
+        for line in lines:
+            gaps.append(line - before)
+            before = line
+        counts = [len(found) for found in spans]
+        data = list(spans)
+        if next_line is not None:
+            gaps.append(next_line - before)
+            counts.append(self.sizes.get(last)[0])
+            data.append(self.sizes.get(last)[1])
+            last += 1
+        self.gaps.replace(first, last, gaps)
+        self.sizes.replace(first, last, counts, data)
+
+    #--------------------------------------------------------------------------
+    # Replacing
+    #--------------------------------------------------------------------------
+
+    def replace_all(self, template):
+        '''
+        Replace every match in the document with a string, in which
+        backreferences such as \\1 are expanded if the pattern is a regular
+        expression. This is a single edit and undo step. Returns the number
+        of matches replaced. Raises re.error, leaving the document as it
+        was, if backreferences are expanded and the string is not valid.
+        '''
+        expand = self.expand and "\\" in template
+        if expand:
+            check_template(self.regex, template)
+        edits = []
+        for y, offset, matches in self._matches(0, len(self.doc.lines)):
+            for m in matches:
+                text = m.expand(template) if expand else template
+                edits.append(((y, m.start() - offset), (y, m.end() - offset),
+                    text))
+        if edits:
+            self.doc.apply_edits(edits)
+        return len(edits)
+
+    #--------------------------------------------------------------------------
+    # Following changes to the document
+    #--------------------------------------------------------------------------
+
+    def _on_change(self, start, end, count):
+        "Document listener. Scan the changed lines again."
+        delta = count - (end - start)
+
+        # Shift the pending ranges, dropping the changed lines from them
+        pending = []
+        for first, last in self.pending:
+            if last <= start:
+                pending.append((first, last))
+            elif first >= end:
+                pending.append((first + delta, last + delta))
+            else:
+                if first < start:
+                    pending.append((first, start))
+                if last > end:
+                    pending.append((start + count, last + delta))
+        self.pending = pending
+
+        # Drop the items of the changed lines, and shift the ones after them
+        first, first_line = self._item_at(start)
+        last, next_line = self._item_at(end)
+        if next_line is not None:
+            next_line += delta
+        gaps, counts, data = [], [], []
+        if next_line is not None:
+            before = self._line(first - 1) if first > 0 else -1
+            gaps.append(next_line - before)
+            counts.append(self.sizes.get(last)[0])
+            data.append(self.sizes.get(last)[1])
+            last += 1
+        self.gaps.replace(first, last, gaps)
+        self.sizes.replace(first, last, counts, data)
+
+        if count > Search.EDIT_LINES:
+            bisect.insort(self.pending, (start, start + count))
+            self._merge_pending()
+        elif count:
+            self.pending.append((start, start + count))
+            self.pending.sort()
+            self._scan(start, start + count)
+
+    def _merge_pending(self):
+        "Join adjacent pending ranges"
+        pending = []
+        for first, last in self.pending:
+            if pending and pending[-1][1] >= first:
+                pending[-1] = (pending[-1][0], max(pending[-1][1], last))
+            elif last > first:
+                pending.append((first, last))
+        self.pending = pending
@@ -0,0 +1,527 @@
+import copy
+import errno
+import fcntl
+import json
+import os
+import select
+import signal
+import socket
+import stat
+import subprocess
+import struct
+import sys
+import termios
+import time
+import _multiprocessing
+import evdoc
+
+#==============================================================================
+# A server that keeps documents open between runs of the editor. It listens
+# on a Unix socket, and `evdoc -c FILE` attaches the terminal to it instead of
+# starting the editor itself, so a file the server still has open, with its
+# highlighting and search indexes, is shown without loading it again.
+#
+# Every message is a JSON object on a line of its own. The client sends
+# requests, each with an "op", and the server answers each with an object
+# whose "ok" is true, or false with an "error" saying why:
+#
+#   ping                        -> pid, documents: the number open
+#   open {file}                 -> lines, modified, cached: whether it was
+#                                  open already
+#   list                        -> documents: [{file, lines, modified}], with
+#                                  null lines for those evicted from memory
+#   close {file, force}         -> closes a document, unless it has unsaved
+#                                  changes and not `force`, which throws
+#                                  them away
+#   attach {file, term}         -> runs the editor on the client's terminal
+#   shutdown                    -> stops the server
+#
+# For attach, the server first answers {"ok": true}, then the client sends
+# the file descriptors of its terminal's input and output with SCM_RIGHTS.
+# The editor runs until the user quits, and then the server answers again.
+# Meanwhile the client forwards what only it can see, since it owns the
+# terminal: "resize" {rows, cols} when its window changes size, and
+# "interrupt" for Ctrl-C. These get no answer.
+#
+# The server answers the requests of each client as they come in, but runs
+# one editor at a time. Requests from other clients wait until it quits. A
+# request that is not valid gets an error, like one that was refused.
+#==============================================================================
+
+class ServerError(Exception):
+    "A request that the server refused"
+    pass
+
+def socket_directory():
+    "Return the private directory of the user's server socket"
+    directory = os.environ.get('TMPDIR', '/tmp')
+    return os.path.join(directory, 'evdoc-%d' % os.getuid())
+
+def socket_path():
+    "Return the name of the server's socket, from $EVDOC_SOCKET or a private directory"
+    if os.environ.get('EVDOC_SOCKET'):
+        return os.environ['EVDOC_SOCKET']
+    return os.path.join(socket_directory(), 'socket')
+
+def check_directory(path):
+    '''
+    Raise ServerError unless the private directory that a socket is in, if it
+    exists, is a directory of the user's own that nobody else can get into.
+    Otherwise another user could listen there first, and be sent a client's
+    terminal. Sockets in other directories, as named by $EVDOC_SOCKET, are
+    left to the user.
+    '''
+    directory = os.path.dirname(path)
+    if directory != socket_directory():
+        return
+    try:
+        info = os.lstat(directory)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return
+        raise ServerError("%s: %s" % (directory, e.strerror))
+    if not stat.S_ISDIR(info.st_mode):
+        raise ServerError("%s is not a directory" % directory)
+    if info.st_uid != os.getuid():
+        raise ServerError("%s is not owned by you" % directory)
+    if info.st_mode & 077:
+        raise ServerError("%s can be used by other users (chmod 700 it)"
+            % directory)
+
+def argument(request, name, required=True):
+    '''
+    Return an argument of a request that names a file or a terminal type, or
+    None if it is not `required` and not given. Raises ServerError if it is
+    not a string.
+    '''
+    value = request.get(name)
+    if value is None and not required:
+        return None
+    if not isinstance(value, basestring):
+        raise ServerError("Bad request: %s must be a string" % name)
+    return value
+
+def terminal_size(fd):
+    "Return the size of the terminal open on a file descriptor as (rows, cols)"
+    size = fcntl.ioctl(fd, termios.TIOCGWINSZ, '\0' * 8)
+    return struct.unpack('HHHH', size)[:2]
+
+class Connection(object):
+    "One end of a connection between a client and the server"
+    def __init__(self, sock):
+        self.sock   = sock
+        self.buffer = ''
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, message):
+        "Send a message, a dict"
+        self.sock.sendall(json.dumps(message) + "\n")
+
+    def read(self):
+        '''
+        Wait for more of the messages to arrive. Returns false if the other
+        end has closed the connection instead.
+        '''
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            self.buffer += data
+            return bool(data)
+
+    def has_message(self):
+        "Return true if the next message has arrived in full"
+        return "\n" in self.buffer
+
+    def next_message(self):
+        '''
+        Return the next message, once has_message() is true. Raises
+        ValueError if it is not valid JSON.
+        '''
+        line, self.buffer = self.buffer.split("\n", 1)
+        return json.loads(line)
+
+    def receive(self):
+        "Return the next message, or None if the other end has closed the connection"
+        while not self.has_message():
+            if not self.read():
+                return None
+        return self.next_message()
+
+    def send_fd(self, fd):
+        "Send a file descriptor"
+        _multiprocessing.sendfd(self.sock.fileno(), fd)
+
+    def receive_fd(self):
+        "Return a file descriptor sent with send_fd()"
+        return _multiprocessing.recvfd(self.sock.fileno())
+
+    def close(self):
+        self.sock.close()
+
+#==============================================================================
+# The server
+#==============================================================================
+
+class Server(object):
+    '''
+    Keeps documents open, and runs the editor on the terminals of clients
+    that attach to it. Documents are kept in an evdoc.buffers.BufferList
+    until closed, or until the server stops; edits that were not saved stay
+    in their journals.
+    '''
+    # Wait this long for a new server to start listening, in seconds
+    START_TIMEOUT = 5.0
+
+    def __init__(self, args, path=None):
+        self.args      = args
+        self.path      = path or socket_path()
+        self.buffers   = evdoc.buffers.BufferList(args.memory_budget)
+        self.sessions  = 0      # The number of times the editor has run
+        self.running   = False
+        self.listener  = None
+        self.connections = []   # Those of the clients, as Connections
+
+    def listen(self):
+        '''
+        Start listening on the socket. Raises ServerError if another server
+        is already listening there, or if its directory is not safe to use.
+        '''
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory, 0700)
+            except OSError as e:
+                # Made by something else meanwhile, which is checked below
+                if e.errno != errno.EEXIST:
+                    raise
+        check_directory(self.path)
+        try:
+            Client(self.path).close()
+        except socket.error:
+            # Nobody is listening, so the socket was left by a server that
+            # died
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        else:
+            raise ServerError("A server is already listening on %s" % self.path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        os.chmod(self.path, 0600)
+        self.listener.listen(16)
+
+    def serve(self):
+        '''
+        Answer requests until a shutdown request, or until interrupted. The
+        clients are answered as their requests arrive, so one that is slow to
+        send its request holds up no other.
+        '''
+        if not self.listener:
+            self.listen()
+        self.running = True
+        try:
+            while self.running:
+                try:
+                    readable = select.select([self.listener] +
+                        self.connections, [], [])[0]
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for source in readable:
+                    if source is self.listener:
+                        self._accept()
+                    elif self.running:
+                        self._serve_connection(source)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def _accept(self):
+        "Accept a connection from a client"
+        try:
+            sock, address = self.listener.accept()
+        except socket.error as e:
+            if e.args[0] in (errno.EINTR, errno.EAGAIN, errno.ECONNABORTED):
+                return
+            raise
+        self.connections.append(Connection(sock))
+
+    def close(self):
+        "Stop listening, hang up on the clients, and close the buffers"
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+        if self.listener:
+            self.listener.close()
+            self.listener = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        self.buffers.close()
+
+    def _serve_connection(self, connection):
+        '''
+        Answer the requests that have arrived from a client, once its
+        connection is readable, closing it if the client has hung up
+        '''
+        try:
+            alive = connection.read()
+            while self.running and connection.has_message():
+                try:
+                    request = connection.next_message()
+                except ValueError:
+                    reply = {'ok': False, 'error': "Bad request"}
+                else:
+                    if (isinstance(request, dict) and
+                            request.get('op') == 'attach'):
+                        self.attach(connection, request)
+                        continue
+                    reply = self.answer(request)
+                connection.send(reply)
+        except socket.error:
+            alive = False
+        if not alive:
+            self.connections.remove(connection)
+            connection.close()
+
+    def answer(self, request):
+        "Return the answer to a request other than attach"
+        try:
+            if not isinstance(request, dict):
+                raise ServerError("Bad request")
+            op = request.get('op')
+            method = getattr(self, 'op_' + str(op), None)
+            if not method:
+                raise ServerError("Unknown request: %s" % op)
+            return method(request)
+        except (ServerError, IOError, OSError) as e:
+            return {'ok': False, 'error': str(e)}
+        except (KeyError, TypeError, ValueError) as e:
+            return {'ok': False, 'error': "Bad request: %s: %s" % (
+                type(e).__name__, e)}
+
+    #--------------------------------------------------------------------------
+    # Documents
+    #--------------------------------------------------------------------------
+
+    def buffer(self, filename):
+        '''
+        Return (buffer, cached) for a file, loading its document unless it
+        has one already. A document with no unsaved changes is loaded again
+        if its file was changed by something else since.
+        '''
+        buffer = self.buffers.open(os.path.abspath(filename))
+        if buffer.stale():
+            buffer.evict()
+        cached = buffer.document is not None
+        if not cached:
+            buffer.load()
+            self.buffers.trim()
+        return buffer, cached
+
+    def op_ping(self, request):
+        return {'ok': True, 'pid': os.getpid(), 'documents': len(self.buffers)}
+
+    def op_open(self, request):
+        buffer, cached = self.buffer(argument(request, 'file'))
+        return {'ok': True, 'lines': len(buffer.document.lines),
+            'modified': buffer.modified(), 'cached': cached}
+
+    def op_list(self, request):
+        return {'ok': True, 'documents': [{'file': buffer.path(),
+            'lines': len(buffer.document.lines) if buffer.document else None,
+            'modified': buffer.modified()} for buffer in self.buffers]}
+
+    def op_close(self, request):
+        filename = argument(request, 'file')
+        buffer = self.buffers.find(filename)
+        if not buffer:
+            raise ServerError("Not open: %s" % filename)
+        if buffer.modified() and not request.get('force'):
+            raise ServerError("Unsaved changes: %s" % buffer.path())
+        self.buffers.remove(buffer)
+        return {'ok': True}
+
+    def op_shutdown(self, request):
+        self.running = False
+        return {'ok': True}
+
+    #--------------------------------------------------------------------------
+    # Running the editor on a client's terminal
+    #--------------------------------------------------------------------------
+
+    def attach(self, connection, request):
+        '''
+        Run the editor on the terminal of a client, which sends its file
+        descriptors once told to
+        '''
+        try:
+            filename = argument(request, 'file', required=False)
+            term = argument(request, 'term', required=False)
+            if filename:
+                self.buffer(filename)
+        except (ServerError, IOError, OSError) as e:
+            connection.send({'ok': False, 'error': str(e)})
+            return
+        connection.send({'ok': True})
+        fds = []
+        try:
+            fds = [connection.receive_fd(), connection.receive_fd()]
+        except OSError as e:
+            for fd in fds:
+                os.close(fd)
+            connection.send({'ok': False, 'error': str(e)})
+            return
+
+        # The editor uses stdin and stdout, so put the client's terminal in
+        # their place while it runs
+        saved = [os.dup(0), os.dup(1)]
+        os.dup2(fds[0], 0)
+        os.dup2(fds[1], 1)
+        saved_term = os.environ.get('TERM')
+        if term:
+            os.environ['TERM'] = term
+        error = None
+        try:
+            self._run_editor(connection, filename)
+        except Exception as e:
+            error = e
+        finally:
+            sys.stdout.flush()
+            os.dup2(saved[0], 0)
+            os.dup2(saved[1], 1)
+            for fd in saved + fds:
+                os.close(fd)
+            if saved_term is not None:
+                os.environ['TERM'] = saved_term
+        reply = {'ok': error is None}
+        if error is not None:
+            reply['error'] = "%s: %s" % (type(error).__name__, error)
+        connection.send(reply)
+
+    def _run_editor(self, connection, filename):
+        "Run the editor until the user quits, following the client's messages"
+        import curses
+        import evdoc.app
+        import evdoc.ui
+        args = copy.copy(self.args)
+        args.file = filename
+        app = evdoc.app.App(args, self.buffers)
+        if self.sessions:
+            # Curses was set up for the terminal of an earlier client. Take
+            # the modes of this one as those to go back to on exit, and the
+            # size of its window.
+            curses.def_shell_mode()
+            curses.resizeterm(*evdoc.ui.Layout.terminal_size())
+        self.sessions += 1
+
+        def on_message():
+            message = connection.receive()
+            if message is None or message.get('op') == 'interrupt':
+                raise KeyboardInterrupt
+            if message.get('op') == 'resize':
+                curses.resizeterm(message['rows'], message['cols'])
+                app.resize()
+        app.loop.add_reader(connection.fileno(), on_message)
+        app.start()
+
+#==============================================================================
+# The client
+#==============================================================================
+
+class Client(object):
+    '''
+    A connection to a server. request() sends a request and returns the
+    answer, and attach() runs the editor on a terminal. Raises socket.error
+    if no server is listening, and ServerError if the directory of the
+    socket is not safe to use.
+    '''
+    def __init__(self, path=None):
+        self.path = path or socket_path()
+        check_directory(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except socket.error:
+            sock.close()
+            raise
+        self.connection = Connection(sock)
+
+    def close(self):
+        self.connection.close()
+
+    def request(self, op, **args):
+        "Send a request, and return the answer. Raises ServerError if it was refused."
+        args['op'] = op
+        self.connection.send(args)
+        reply = self.connection.receive()
+        if reply is None:
+            raise ServerError("The server hung up")
+        if not reply.get('ok'):
+            raise ServerError(reply.get('error'))
+        return reply
+
+    def attach(self, filename=None, stdin=0, stdout=1):
+        '''
+        Run the editor on the terminal open on the file descriptors `stdin`
+        and `stdout`, opening a file, until the user quits. Resizes and
+        Ctrl-C are passed on to the server meanwhile.
+        '''
+        self.request('attach', file=filename and os.path.abspath(filename),
+            term=os.environ.get('TERM'))
+        self.connection.send_fd(stdin)
+        self.connection.send_fd(stdout)
+
+        def on_resize(signum, frame):
+            rows, cols = terminal_size(stdout)
+            self.connection.send({'op': 'resize', 'rows': rows, 'cols': cols})
+
+        def on_interrupt(signum, frame):
+            self.connection.send({'op': 'interrupt'})
+
+        handlers = {signal.SIGWINCH: on_resize, signal.SIGINT: on_interrupt}
+        saved = dict((signum, signal.signal(signum, handler))
+            for signum, handler in handlers.items())
+        try:
+            reply = self.connection.receive()
+        finally:
+            for signum, handler in saved.items():
+                signal.signal(signum, handler)
+        if reply is None:
+            raise ServerError("The server hung up")
+        if not reply.get('ok'):
+            raise ServerError(reply.get('error'))
+
+def start_server(path=None, argv=None):
+    '''
+    Start a server in the background, in a session of its own, and wait for
+    it to listen. `argv` is the command that runs evdoc, by default the one
+    this process was started with.
+    '''
+    path = path or socket_path()
+    argv = argv or [sys.executable, os.path.abspath(sys.argv[0])]
+    env = dict(os.environ, EVDOC_SOCKET=path)
+    with open(os.devnull, 'r+') as null:
+        subprocess.Popen(argv + ['--server'], stdin=null, stdout=null,
+            stderr=null, close_fds=True, preexec_fn=os.setsid, env=env)
+    deadline = time.time() + Server.START_TIMEOUT
+    while True:
+        try:
+            return Client(path)
+        except socket.error:
+            if time.time() > deadline:
+                raise ServerError("The server did not start")
+            time.sleep(0.01)
+
+def connect(path=None):
+    "Return a Client for the server, starting one if none is listening"
+    try:
+        return Client(path)
+    except socket.error:
+        return start_server(path)
@@ -0,0 +1,148 @@
+import json
+import math
+import time
+
+#==============================================================================
+# Timing of the phases of handling keys, for --stats. The methods of the
+# editor that make up each phase are wrapped by KeyTimings.install(), which
+# replaces them on the objects with versions that time each call. Without
+# --stats nothing is wrapped, and this module is not even imported, so the
+# timing costs nothing unless it is asked for.
+#
+# The times of each phase go in a Histogram of a fixed number of buckets, so
+# the memory taken stays the same however long the editor runs, at the cost
+# of percentiles being off by up to the width of a bucket, about 9%.
+#==============================================================================
+
+class Histogram(object):
+    '''
+    Counts of durations in buckets whose bounds grow by a constant ratio,
+    from MIN seconds up to about 100 seconds
+    '''
+    # The upper bound of the first bucket, in seconds. Shorter times go there.
+    MIN = 1e-6
+    # Buckets per doubling of the duration, and the number of buckets. The
+    # last one also holds anything longer than its upper bound.
+    STEPS = 8
+    BUCKETS = 216
+
+    def __init__(self):
+        self.counts = [0] * Histogram.BUCKETS
+        self.count  = 0
+        self.total  = 0.0
+        self.max    = 0.0
+
+    def add(self, seconds):
+        "Count a duration"
+        if seconds > Histogram.MIN:
+            i = int(math.log(seconds / Histogram.MIN, 2) * Histogram.STEPS) + 1
+            self.counts[min(i, Histogram.BUCKETS - 1)] += 1
+        else:
+            self.counts[0] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @staticmethod
+    def upper(i):
+        "Return the upper bound of bucket i, in seconds"
+        return Histogram.MIN * 2 ** (float(i) / Histogram.STEPS)
+
+    def percentile(self, pct):
+        '''
+        Return about the given percentile of the durations, in seconds: the
+        upper bound of the bucket it is in, or the longest duration if that
+        is less
+        '''
+        if not self.count:
+            return 0.0
+        rank = min(self.count - 1, int(self.count * pct / 100.0))
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen > rank:
+                return min(Histogram.upper(i), self.max)
+        return self.max
+
+class KeyTimings(object):
+    '''
+    A Histogram of the time taken by each phase of handling keys. The phases
+    are, in the order of PHASES: handling the keys that are waiting, from
+    reading them to drawing the result; reading a key; changing the
+    document; scrolling; working out the lines to draw; the status callback;
+    and drawing the frame, which ends in curses.doupdate().
+    '''
+    PHASES = ('keys', 'getch', 'edit', 'scroll', 'content', 'on_char', 'render')
+
+    def __init__(self):
+        self.histograms = dict((name, Histogram()) for name in self.PHASES)
+
+    def timed(self, name, func, ignore=None):
+        '''
+        Return a function that calls func() and counts how long it took in
+        the histogram of a phase. Calls that return `ignore`, if given, are
+        not counted, such as reading a key when none is waiting.
+        '''
+        add = self.histograms[name].add
+        clock = time.time
+
+        def timed(*args):
+            start = clock()
+            result = func(*args)
+            if ignore is None or result != ignore:
+                add(clock() - start)
+            return result
+        timed.__name__ = func.__name__
+        return timed
+
+    def install(self, app):
+        '''
+        Time the phases of handling keys in an App, once its windows have
+        been created. Only the editor's keys are timed, not the prompt's.
+        '''
+        editor = app.editor
+        app._on_input = self.timed('keys', app._on_input)
+        editor.getch = self.timed('getch', editor.getch, ignore=-1)
+        for name in ('addch', 'addstr', 'backspace', 'delete'):
+            setattr(editor, name, self.timed('edit', getattr(editor, name)))
+        editor._update_scroll = self.timed('scroll', editor._update_scroll)
+        editor._update_content = self.timed('content', editor._update_content)
+        if editor.on_char:
+            editor.on_char = self.timed('on_char', editor.on_char)
+        app.scheduler.render = self.timed('render', app.scheduler.render,
+            ignore=False)
+
+    def report(self):
+        "Return a table of the count, p50, p99 and longest time of each phase"
+        lines = ["%-10s %8s %10s %10s %10s" % ('phase', 'count', 'p50 ms',
+            'p99 ms', 'max ms')]
+        for name in self.PHASES:
+            histogram = self.histograms[name]
+            lines.append("%-10s %8d %10.3f %10.3f %10.3f" % (name,
+                histogram.count, histogram.percentile(50) * 1000,
+                histogram.percentile(99) * 1000, histogram.max * 1000))
+        return lines
+
+    def export(self, filename):
+        '''
+        Write the timings to a file as JSON: a list with a dict for each
+        phase, which has the non-empty buckets of its histogram as
+        [upper bound in ms, count] pairs
+        '''
+        phases = []
+        for name in self.PHASES:
+            histogram = self.histograms[name]
+            phases.append({
+                'phase':    name,
+                'count':    histogram.count,
+                'p50_ms':   histogram.percentile(50) * 1000,
+                'p99_ms':   histogram.percentile(99) * 1000,
+                'max_ms':   histogram.max * 1000,
+                'total_ms': histogram.total * 1000,
+                'buckets':  [[Histogram.upper(i) * 1000, count]
+                    for i, count in enumerate(histogram.counts) if count],
+            })
+        with open(filename, 'w') as file:
+            json.dump(phases, file, indent=2)
+            file.write("\n")
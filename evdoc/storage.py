@@ -0,0 +1,507 @@
+#==============================================================================
+# Storage engines for the lines of a Document.
+#
+# Every engine behaves like a list of strings for reading (len, indexing,
+# slicing, iteration) and assignment of single lines. Structural changes go
+# through replace_lines(), which replaces a range of lines with new ones.
+# snapshot() returns a copy that later edits do not change, which other
+# threads may read while the document is edited.
+#==============================================================================
+
+import collections
+import mmap
+import os
+import threading
+
+# The memory a line takes besides its text, in bytes, for memory_size()
+LINE_OVERHEAD = 48
+# The memory an offset cached by a MappedFile takes, in bytes
+OFFSET_SIZE = 32
+
+class ListStorage(list):
+    '''
+    Stores lines in a plain Python list. Structural changes are O(n), but
+    the constant factor is tiny, so this is fine for small documents.
+    '''
+    # The number of lines in each block of iter_blocks()
+    BLOCK_LINES = 4096
+
+    @classmethod
+    def load(cls, filename):
+        "Read all lines of a file into memory"
+        with open(filename, 'rb') as file:
+            return cls(file.read().split("\n"))
+
+    def replace_lines(self, start, end, lines):
+        "Replace the lines in the range [start, end) with the given lines"
+        self[start:end] = list(lines)
+
+    def insert_lines(self, index, lines):
+        "Insert lines before the given line index"
+        self.replace_lines(index, index, lines)
+
+    def delete_lines(self, start, end):
+        "Delete the lines in the range [start, end)"
+        self.replace_lines(start, end, [])
+
+    def copy_lines(self, start, end):
+        "Return the lines in the range [start, end) as a new ListStorage"
+        return ListStorage(self[start:end])
+
+    def snapshot(self):
+        "Return a copy of all lines. This is O(n)."
+        return ListStorage(self)
+
+    def memory_size(self):
+        "Return about how many bytes of memory the lines take. This is O(n)."
+        return sum(len(line) for line in self) + len(self) * LINE_OVERHEAD
+
+    def iter_lines(self, start=0, end=None):
+        "Iterate over the lines in the range [start, end)"
+        end = len(self) if end is None else min(end, len(self))
+        for i in xrange(start, end):
+            yield self[i]
+
+    def iter_blocks(self, start=0, end=None):
+        '''
+        Iterate over the text of the lines in the range [start, end) in
+        blocks, as tuples of (text, number of lines). Blocks are joined with
+        newlines.
+        '''
+        end = len(self) if end is None else min(end, len(self))
+        for i in xrange(start, end, ListStorage.BLOCK_LINES):
+            block = self[i:min(i + ListStorage.BLOCK_LINES, end)]
+            yield "\n".join(block), len(block)
+
+#==============================================================================
+# A read-only memory mapping of a file. The file is split into chunks of about
+# CHUNK_SIZE bytes that end on line boundaries, and only the number of lines
+# in each chunk is counted up front. The offsets of the lines within a chunk
+# are computed when a line from that chunk is first needed, and only a few of
+# those offset tables are kept around, so memory use stays flat no matter how
+# big the file is.
+#==============================================================================
+
+class MappedFile(object):
+    CHUNK_SIZE = 1 << 20
+    CACHED_CHUNKS = 64
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.file = open(filename, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.chunks = []    # Holds each chunk as a tuple: (start, end, lines)
+        self.offsets = collections.OrderedDict()
+        self._index_chunks()
+
+    def _index_chunks(self):
+        '''
+        Split the file into chunks, and count the lines in each one. This is
+        done with plain reads rather than through the mapping, so that the
+        pages of the mapping are not all pulled into memory.
+        '''
+        start = 0
+        while start < self.size:
+            # Read a block, and extend it to the end of its last line
+            block = self.file.read(self.CHUNK_SIZE)
+            block += self.file.readline()
+            end = start + len(block)
+            self.chunks.append((start, end, block.count("\n")))
+            start = end
+        # The text after the last newline is one more line, even if empty
+        start, end, count = self.chunks[-1]
+        self.chunks[-1] = (start, end, count + 1)
+
+    def _line_offsets(self, chunk):
+        '''
+        Return the start offset of each line in a chunk, followed by the
+        offset just past the end of its last line plus one
+        '''
+        # Snapshots of a document may be read from other threads, so the
+        # cache is only touched under the lock
+        with self.lock:
+            offsets = self.offsets.pop(chunk, None)
+            if offsets is None:
+                start, end, count = self.chunks[chunk]
+                data = self._read(start, end)
+                offsets = [start]
+                newline = data.find("\n")
+                while newline >= 0:
+                    offsets.append(start + newline + 1)
+                    newline = data.find("\n", newline + 1)
+                if len(offsets) == count:
+                    offsets.append(end + 1)
+                if len(self.offsets) >= self.CACHED_CHUNKS:
+                    self.offsets.popitem(last=False)
+            self.offsets[chunk] = offsets
+            return offsets
+
+    def _read(self, start, end):
+        "Read bytes [start, end) of the file without going through the mapping"
+        with self.lock:
+            self.file.seek(start)
+            return self.file.read(end - start)
+
+    def text(self, chunk, lo, hi):
+        "Return lines [lo, hi) of a chunk as a single string, without newlines"
+        if lo >= hi:
+            return ''
+        start, end, count = self.chunks[chunk]
+        if lo == 0 and hi == count:
+            # The last chunk has no newline after its last line
+            last = (chunk == len(self.chunks) - 1)
+            return self._read(start, end if last else end - 1)
+        offsets = self._line_offsets(chunk)
+        return self._read(offsets[lo], offsets[hi] - 1)
+
+    def lines(self, chunk, lo, hi):
+        "Return lines [lo, hi) of a chunk as a list of strings"
+        if lo >= hi:
+            return []
+        offsets = self._line_offsets(chunk)
+        return self.map[offsets[lo] : offsets[hi] - 1].split("\n")
+
+    def leaves(self):
+        "Return a leaf for each chunk of the file"
+        return [_MappedLeaf(self, i, 0, count)
+            for i, (start, end, count) in enumerate(self.chunks)]
+
+    def memory_size(self):
+        '''
+        Return about how many bytes of memory the line counts and cached line
+        offsets take. The pages of the mapping are not counted, since the
+        system can drop them whenever it needs the memory.
+        '''
+        with self.lock:
+            offsets = sum(len(offsets) for offsets in self.offsets.itervalues())
+        return (offsets + len(self.chunks)) * OFFSET_SIZE
+
+    def close(self):
+        "Close the mapping and the file"
+        self.map.close()
+        self.file.close()
+
+#==============================================================================
+# Rope nodes. Nodes are never modified after construction, so subtrees can be
+# shared freely between ropes.
+#==============================================================================
+
+class _Leaf(object):
+    "A leaf holding a tuple of lines"
+    __slots__ = ('items', 'count')
+    height = 0
+
+    def __init__(self, items):
+        self.items = tuple(items)
+        self.count = len(self.items)
+
+    def get(self, i):
+        "Return line i of the leaf"
+        return self.items[i]
+
+    def set(self, i, line):
+        "Return a new leaf with line i replaced"
+        return _Leaf(self.items[:i] + (line,) + self.items[i+1:])
+
+    def split(self, i):
+        "Split the leaf into two leaves at line i"
+        return _Leaf(self.items[:i]), _Leaf(self.items[i:])
+
+    def slice(self, lo, hi):
+        "Return lines [lo, hi) of the leaf as a list"
+        return list(self.items[lo:hi])
+
+    def text(self, lo, hi):
+        "Return lines [lo, hi) of the leaf joined with newlines"
+        return "\n".join(self.items[lo:hi])
+
+    def merge(self, other):
+        "Return a single leaf holding both leaves, or None if it would be too big"
+        if isinstance(other, _Leaf) and self.count + other.count <= LEAF_SIZE:
+            return _Leaf(self.items + other.items)
+        return None
+
+class _MappedLeaf(object):
+    "A leaf holding lines [lo, hi) of one chunk of a MappedFile"
+    __slots__ = ('source', 'chunk', 'lo', 'hi', 'count')
+    height = 0
+
+    def __init__(self, source, chunk, lo, hi):
+        self.source = source
+        self.chunk = chunk
+        self.lo = lo
+        self.hi = hi
+        self.count = hi - lo
+
+    def get(self, i):
+        "Return line i of the leaf"
+        return self.source.lines(self.chunk, self.lo + i, self.lo + i + 1)[0]
+
+    def set(self, i, line):
+        "Mapped lines cannot be replaced in place"
+        return None
+
+    def split(self, i):
+        "Split the leaf into two leaves at line i"
+        return (_MappedLeaf(self.source, self.chunk, self.lo, self.lo + i),
+                _MappedLeaf(self.source, self.chunk, self.lo + i, self.hi))
+
+    def slice(self, lo, hi):
+        "Return lines [lo, hi) of the leaf as a list"
+        return self.source.lines(self.chunk, self.lo + lo, self.lo + hi)
+
+    def text(self, lo, hi):
+        "Return lines [lo, hi) of the leaf joined with newlines"
+        return self.source.text(self.chunk, self.lo + lo, self.lo + hi)
+
+    def merge(self, other):
+        "Rejoin adjacent ranges of the same chunk, otherwise return None"
+        if (isinstance(other, _MappedLeaf) and other.source is self.source and
+                other.chunk == self.chunk and other.lo == self.hi):
+            return _MappedLeaf(self.source, self.chunk, self.lo, other.hi)
+        return None
+
+class _Node(object):
+    "An internal node joining two subtrees"
+    __slots__ = ('left', 'right', 'count', 'height')
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+        self.count = left.count + right.count
+        self.height = 1 + max(left.height, right.height)
+
+LEAF_SIZE = 64
+_EMPTY = _Leaf(())
+
+def _balance(l, r):
+    "Join two subtrees whose heights differ by at most 3, rotating if needed"
+    if l.height > r.height + 2:
+        if l.left.height >= l.right.height:
+            return _Node(l.left, _Node(l.right, r))
+        return _Node(_Node(l.left, l.right.left), _Node(l.right.right, r))
+    if r.height > l.height + 2:
+        if r.right.height >= r.left.height:
+            return _Node(_Node(l, r.left), r.right)
+        return _Node(_Node(l, r.left.left), _Node(r.left.right, r.right))
+    return _Node(l, r)
+
+def _concat(a, b):
+    "Concatenate two subtrees in O(log n)"
+    if a.count == 0:
+        return b
+    if b.count == 0:
+        return a
+    if a.height == 0 and b.height == 0:
+        merged = a.merge(b)
+        if merged is not None:
+            return merged
+    if a.height > b.height + 2:
+        return _balance(a.left, _concat(a.right, b))
+    if b.height > a.height + 2:
+        return _balance(_concat(a, b.left), b.right)
+    return _Node(a, b)
+
+def _split(node, i):
+    "Split a subtree into the first i lines and the rest, in O(log n)"
+    if i <= 0:
+        return _EMPTY, node
+    if i >= node.count:
+        return node, _EMPTY
+    if node.height == 0:
+        return node.split(i)
+    lcount = node.left.count
+    if i < lcount:
+        l, r = _split(node.left, i)
+        return l, _concat(r, node.right)
+    if i == lcount:
+        return node.left, node.right
+    l, r = _split(node.right, i - lcount)
+    return _concat(node.left, l), r
+
+def _get(node, i):
+    "Return line i of a subtree"
+    while node.height:
+        if i < node.left.count:
+            node = node.left
+        else:
+            i -= node.left.count
+            node = node.right
+    return node.get(i)
+
+def _set(node, i, line):
+    '''
+    Return a copy of a subtree with line i replaced. Copies only one path.
+    Returns None if the line is in a leaf that cannot be replaced in place.
+    '''
+    if node.height == 0:
+        return node.set(i, line)
+    if i < node.left.count:
+        left = _set(node.left, i, line)
+        return _Node(left, node.right) if left is not None else None
+    right = _set(node.right, i - node.left.count, line)
+    return _Node(node.left, right) if right is not None else None
+
+def _build(leaves):
+    "Build a balanced tree from a list of leaves"
+    if not leaves:
+        return _EMPTY
+    while len(leaves) > 1:
+        paired = [_Node(leaves[i], leaves[i+1]) for i in xrange(0, len(leaves) - 1, 2)]
+        if len(leaves) % 2:
+            paired[-1] = _Node(paired[-1], leaves[-1]) if paired else leaves[-1]
+        leaves = paired
+    return leaves[0]
+
+def _leaves(node, start, end):
+    "Yield (leaf, lo, hi) for every leaf overlapping lines [start, end)"
+    stack = [(node, 0)]
+    while stack:
+        node, offset = stack.pop()
+        if offset >= end or offset + node.count <= start:
+            continue
+        if node.height == 0:
+            yield node, max(start - offset, 0), min(end - offset, node.count)
+        else:
+            stack.append((node.right, offset + node.left.count))
+            stack.append((node.left, offset))
+
+#==============================================================================
+# A balanced rope of lines. Lookups and edits are O(log n).
+#==============================================================================
+
+class RopeStorage(object):
+    def __init__(self, lines=()):
+        if isinstance(lines, RopeStorage):
+            self.root = lines.root
+        else:
+            self.root = RopeStorage._from_list(list(lines))
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        Memory-map a file. Lines are only read from the mapping when they are
+        accessed, and lines that are never edited stay backed by it.
+        '''
+        rope = cls()
+        if os.path.getsize(filename) == 0:
+            rope.root = _Leaf([''])
+        else:
+            rope.root = _build(MappedFile(filename).leaves())
+        return rope
+
+    @staticmethod
+    def _from_list(lines):
+        "Build a balanced tree from a list of lines, in O(n)"
+        return _build([_Leaf(lines[i:i+LEAF_SIZE])
+            for i in xrange(0, len(lines), LEAF_SIZE)])
+
+    @staticmethod
+    def _tree(lines):
+        "Return the tree for a RopeStorage or any iterable of lines"
+        if isinstance(lines, RopeStorage):
+            return lines.root
+        return RopeStorage._from_list(list(lines))
+
+    def __len__(self):
+        return self.root.count
+
+    def _index(self, i):
+        "Convert a (possibly negative) index into a line number"
+        if i < 0:
+            i += self.root.count
+        if i < 0 or i >= self.root.count:
+            raise IndexError("line index out of range")
+        return i
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.root.count)
+            if step != 1:
+                return list(self.iter_lines())[i]
+            return list(self.iter_lines(start, stop))
+        return _get(self.root, self._index(i))
+
+    def __setitem__(self, i, line):
+        i = self._index(i)
+        root = _set(self.root, i, line)
+        if root is not None:
+            self.root = root
+        else:
+            self.replace_lines(i, i+1, [line])
+
+    def __iter__(self):
+        return self.iter_lines()
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def iter_lines(self, start=0, end=None):
+        "Iterate over the lines in the range [start, end)"
+        end = self.root.count if end is None else min(end, self.root.count)
+        for leaf, lo, hi in _leaves(self.root, start, end):
+            for line in leaf.slice(lo, hi):
+                yield line
+
+    def iter_blocks(self, start=0, end=None):
+        '''
+        Iterate over the text of the lines in the range [start, end) in
+        blocks, as tuples of (text, number of lines). Blocks are joined with
+        newlines. Text that is backed by a file is read in whole chunks,
+        without decoding lines.
+        '''
+        end = self.root.count if end is None else min(end, self.root.count)
+        for leaf, lo, hi in _leaves(self.root, start, end):
+            yield leaf.text(lo, hi), hi - lo
+
+    def replace_lines(self, start, end, lines):
+        '''
+        Replace the lines in the range [start, end) with the given lines.
+        `lines` may be any iterable of strings, or another RopeStorage, in
+        which case its tree is shared rather than copied.
+        '''
+        left, rest = _split(self.root, start)
+        middle, right = _split(rest, end - start)
+        self.root = _concat(_concat(left, RopeStorage._tree(lines)), right)
+
+    def insert_lines(self, index, lines):
+        "Insert lines before the given line index"
+        self.replace_lines(index, index, lines)
+
+    def delete_lines(self, start, end):
+        "Delete the lines in the range [start, end)"
+        self.replace_lines(start, end, ())
+
+    def copy_lines(self, start, end):
+        '''
+        Return the lines in the range [start, end) as a new RopeStorage. The
+        copy shares the nodes of this rope, so this is O(log n).
+        '''
+        rope = RopeStorage()
+        rope.root = _split(_split(self.root, start)[1], end - start)[0]
+        return rope
+
+    def snapshot(self):
+        '''
+        Return a copy of all lines. Nodes are never modified, so the copy
+        shares the whole tree and this is O(1).
+        '''
+        return RopeStorage(self)
+
+    def memory_size(self):
+        '''
+        Return about how many bytes of memory the lines take. Lines that are
+        backed by a file take next to none; see MappedFile.memory_size().
+        This is O(number of leaves).
+        '''
+        size = 0
+        sources = set()
+        for leaf, lo, hi in _leaves(self.root, 0, self.root.count):
+            if isinstance(leaf, _MappedLeaf):
+                sources.add(leaf.source)
+            else:
+                size += (sum(len(line) for line in leaf.items) +
+                    leaf.count * LINE_OVERHEAD)
+        return size + sum(source.memory_size() for source in sources)
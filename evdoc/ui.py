@@ -1,6 +1,11 @@
 import curses
 import curses.ascii
+import fcntl
 import os
+import struct
+import sys
+import termios
+import time
 import evdoc
 
 #==============================================================================
@@ -15,11 +20,18 @@ class Layout(object):
 
     def __init__(self):
         "Determine the terminal size, and size of each window"
+        self.terminal_rows = None
+        self.terminal_cols = None
         self.update()
 
     def update(self):
-        "Update the terminal size, and size of each window"
+        '''
+        Update the terminal size, and size of each window. The sizes are only
+        worked out again if the terminal size changed. Returns true if it did.
+        '''
         rows, cols = Layout.terminal_size()
+        if (rows, cols) == (self.terminal_rows, self.terminal_cols):
+            return False
 
         # Save terminal size
         self.terminal_rows = rows
@@ -50,12 +62,62 @@ class Layout(object):
         self.prompt_cols      = cols
         self.prompt_start_row = rows - 1
         self.prompt_start_col = 0
+        return True
 
     @staticmethod
     def terminal_size():
-        "Return the current terminal size, as a tuple of (rows, cols)"
-        rows, cols = os.popen('stty size', 'r').read().split()
-        return (int(rows), int(cols))
+        '''
+        Return the current terminal size, as a tuple of (rows, cols). The
+        size is asked of the terminal with an ioctl, or else taken from the
+        LINES and COLUMNS environment variables, or else is 24 x 80.
+        '''
+        for file in (sys.stdout, sys.stdin, sys.stderr):
+            try:
+                size = fcntl.ioctl(file.fileno(), termios.TIOCGWINSZ, '\0' * 8)
+            except (IOError, OSError, ValueError):
+                continue
+            rows, cols = struct.unpack('HHHH', size)[:2]
+            if rows and cols:
+                return (rows, cols)
+        try:
+            return (int(os.environ['LINES']), int(os.environ['COLUMNS']))
+        except (KeyError, ValueError):
+            return (24, 80)
+
+#==============================================================================
+# The look of each highlighting style, as a curses color and attribute. The
+# attributes are set up by init_styles() once curses has started.
+#==============================================================================
+
+STYLES = {
+    'heading':  ('COLOR_BLUE',    'A_BOLD'),
+    'quote':    ('COLOR_GREEN',   'A_NORMAL'),
+    'list':     ('COLOR_YELLOW',  'A_BOLD'),
+    'code':     ('COLOR_CYAN',    'A_NORMAL'),
+    'strong':   ('COLOR_WHITE',   'A_BOLD'),
+    'emphasis': ('COLOR_MAGENTA', 'A_NORMAL'),
+    'link':     ('COLOR_BLUE',    'A_UNDERLINE'),
+    'match':    ('COLOR_YELLOW',  'A_REVERSE'),     # Search matches
+}
+
+STYLE_ATTRS = {}
+
+def init_styles():
+    "Set up a color pair for each highlighting style, if the terminal has colors"
+    colors = curses.has_colors()
+    if colors:
+        curses.start_color()
+        try:
+            curses.use_default_colors()
+            background = -1
+        except curses.error:
+            background = curses.COLOR_BLACK
+    for pair, style in enumerate(sorted(STYLES), 1):
+        color, attr = STYLES[style]
+        STYLE_ATTRS[style] = getattr(curses, attr)
+        if colors:
+            curses.init_pair(pair, getattr(curses, color), background)
+            STYLE_ATTRS[style] |= curses.color_pair(pair)
 
 #==============================================================================
 # Base window object for the app
@@ -65,6 +127,7 @@ class AppWindow(object):
     def __init__(self, logger):
         self.logger = logger
         self.dirty = False
+        self.scheduler = None   # Set by RenderScheduler.register()
 
     def set_dirty(self):
         "Set the window as dirty"
@@ -75,10 +138,66 @@ class AppWindow(object):
         return self.dirty
 
     def redraw(self):
-        "Redraw the window and set the dirty flag to false"
-        self.logger.log("redraw!")
-        self.window.refresh()
-        self.dirty = False
+        '''
+        Redraw the window and set the dirty flag to false. With a scheduler,
+        every other dirty window is drawn in the same update.
+        '''
+        self.logger.debug("redraw!")
+        if self.scheduler:
+            self.scheduler.render()
+        else:
+            self.window.refresh()
+            self.dirty = False
+
+#==============================================================================
+# The render scheduler draws the windows that changed with a single update of
+# the terminal, at most once per batch of input.
+#==============================================================================
+
+class RenderScheduler(object):
+    # While input keeps arriving, draw at least this often, in seconds
+    FRAME_INTERVAL = 1.0 / 30
+
+    def __init__(self, logger):
+        self.logger  = logger
+        self.windows = []       # Registered windows, in drawing order
+        self.focused = None     # The window that shows the cursor
+        self.last    = 0        # When the last frame was drawn
+
+    def register(self, window):
+        "Draw a window through this scheduler"
+        window.scheduler = self
+        self.windows.append(window)
+
+    def focus(self, window):
+        "Show the cursor in a window"
+        self.focused = window
+        window.set_dirty()
+
+    def render(self, pending=False):
+        '''
+        Update the terminal with every dirty window in one curses.doupdate(),
+        and return true if anything was drawn. If more input is pending, wait
+        for it unless a frame is overdue, so that a batch of input is drawn
+        once.
+        '''
+        now = time.time()
+        if pending and now - self.last < RenderScheduler.FRAME_INTERVAL:
+            return False
+        dirty = [w for w in self.windows if w.is_dirty()]
+        if not dirty:
+            return False
+
+        # Curses leaves the cursor in the last window copied to the screen
+        for window in dirty:
+            window.dirty = False
+            if window is not self.focused:
+                window.window.noutrefresh()
+        if self.focused:
+            self.focused.window.noutrefresh()
+        curses.doupdate()
+        self.last = now
+        return True
 
 #==============================================================================
 # This just displays the title
@@ -89,25 +208,29 @@ class Title(AppWindow):
         super(evdoc.ui.Title, self).__init__(logger)
         self.layout = layout
         self.text = text
+        self.shown = None   # The width the title was last drawn for
         self.window = curses.newwin(layout.title_rows, layout.title_cols,
             layout.title_start_row, layout.title_start_col)
         self.update()
 
     def update(self):
         '''
-        Update the window's contents. The window will not be redrawn until
-        curses.doupdate() is called.
+        Update the window's contents, if they changed. The window will not be
+        redrawn until redraw() is called.
         '''
+        if self.shown == self.layout.title_cols:
+            return
+        self.shown = self.layout.title_cols
         self.window.resize(self.layout.title_rows, self.layout.title_cols)
         start_col = (self.layout.title_cols - len(self.text)) / 2
-        self.window.clear()
+        self.window.erase()
         self.window.addstr(0, start_col, self.text, curses.A_BOLD)
-        self.window.noutrefresh()
         self.set_dirty()
 
     def resize(self, layout):
         "Update the window size"
         self.layout = layout
+        self.shown = None
         self.update()
 
 #==============================================================================
@@ -122,38 +245,53 @@ class StatusBar(AppWindow):
         self.x      = 0
         self.pct    = ''
         self.file   = '(new file)'
+        self.message = ''
+        self.matches = ''   # Search matches, such as '3/10 matches'
+        self.shown  = None  # The text last drawn
         self.window = curses.newwin(layout.status_rows, layout.status_cols,
             layout.status_start_row, layout.status_start_col)
         self.update()
 
-    def update(self, y=None, x=None, pct=None, file=None):
+    def update(self, y=None, x=None, pct=None, file=None, message=None,
+            matches=None):
         '''
-        Update the window's contents. The window will not be redrawn until
-        curses.doupdate() is called.
+        Update the window's contents, if they changed. The window will not be
+        redrawn until redraw() is called.
         '''
         # Update internal variables
         if y: self.y = y
         if x: self.x = x
         if pct: self.pct = pct
         if file: self.file = file
+        if message is not None: self.message = message
+        if matches is not None: self.matches = matches
 
         # Build the status bar string
         text = "  %d,%d" % (self.y, self.x)                 # y,x coordinates
         text = ("%*s " % (-12, text)) + self.file           # add file
+        if self.matches:
+            text = text + '   ' + self.matches              # add matches
+        if self.message:
+            text = text + '   ' + self.message              # add message
         text = "%*s" % (-(self.layout.status_cols-8), text) # trailing spaces
         text = text + (' %*s  ' % (4, self.pct))          # percent location
         text = text[0:self.layout.status_cols-1]            # truncate if needed
+        if text == self.shown:
+            return
+        self.shown = text
 
         # Set the window contents
+        # Note: erase() rather than clear(), which would make curses repaint
+        # the entire terminal on the next update
         self.window.resize(self.layout.status_rows, self.layout.status_cols)
-        self.window.clear()
+        self.window.erase()
         self.window.addstr(0, 0, text, curses.A_REVERSE)
-        self.window.noutrefresh()
         self.set_dirty()
 
     def resize(self, layout):
         "Update the window size"
         self.layout = layout
+        self.shown = None
         self.update()
 
 #==============================================================================
@@ -164,22 +302,27 @@ class Frame(AppWindow):
     def __init__(self, layout, logger):
         super(evdoc.ui.Frame, self).__init__(logger)
         self.layout = layout
+        self.shown = None   # The size the frame was last drawn for
         self.window = curses.newwin(layout.frame_rows, layout.frame_cols,
             layout.frame_start_row, layout.frame_start_col)
 
     def update(self):
         '''
-        Update the window's contents. The window will not be redrawn until
-        curses.doupdate() is called.
+        Update the window's contents, if they changed. The window will not be
+        redrawn until redraw() is called.
         '''
+        size = (self.layout.frame_rows, self.layout.frame_cols)
+        if self.shown == size:
+            return
+        self.shown = size
         self.window.resize(self.layout.frame_rows, self.layout.frame_cols)
         self.window.border()
-        self.window.noutrefresh()
         self.set_dirty()
 
     def resize(self, layout):
         "Update the window size"
         self.layout = layout
+        self.shown = None
         self.update()
 
 #==============================================================================
@@ -188,6 +331,12 @@ class Frame(AppWindow):
 #==============================================================================
 
 class EditBox(AppWindow):
+    # Keys that handle_key() leaves to the caller
+    TERMINATORS = (curses.ascii.ESC,)
+    # While there is highlighting left to do, wait this long for a key before
+    # doing some of it, in milliseconds
+    IDLE_TIMEOUT = 50
+
     def __init__(self, rows, cols, start_row, start_col, logger):
         super(evdoc.ui.EditBox, self).__init__(logger)
         self.document    = evdoc.core.Document()
@@ -200,8 +349,16 @@ class EditBox(AppWindow):
         self.scroll_y    = 0
         self.on_char     = None
         self.on_char_arg = None
+        self.damage      = []       # Document changes not yet drawn
+        self.drawn       = None     # The (scroll_y, scroll_x) last drawn
+        self.highlight   = None     # HighlightCache, if highlighting
+        self.search      = None     # evdoc.search.Search, if searching
+        self.columns     = evdoc.columns.ColumnCache()
         self.window      = curses.newwin(rows, cols, start_row, start_col)
         self.window.keypad(1)
+        self.window.idlok(1)
+        self.window.nodelay(1)      # The event loop waits for input
+        self.document.add_listener(self._on_change)
         self._resize(rows, cols, start_row, start_col)
 
     def set_on_char(self, func, app):
@@ -211,7 +368,7 @@ class EditBox(AppWindow):
     def update(self):
         '''
         Repopulate all contents of the window and move focus to it. The window
-        will not be redrawn until curses.doupdate() is called.
+        will not be redrawn until redraw() is called.
         '''
         self._update_scroll()
         self._update_content()
@@ -220,40 +377,259 @@ class EditBox(AppWindow):
     def _update_scroll(self):
         '''
         Update the X and Y scroll position of the window, if needed, to ensure
-        that the location of the cursor in the document is in view. Returns
-        true if updated, false if no changes made.
+        that the location of the cursor in the document is in view. If the
+        cursor is less than a page out of view, scroll just far enough to show
+        it. If it is further away, center the view on it. Returns true if
+        updated, false if no changes made.
         '''
         changed = False
         y, x = self.document.getyx()
+        col = self._column(y, x)
 
         # Update the horizontal scroll to make sure the cursor is visible
-        if x < self.scroll_x or x >= self.scroll_x + self.cols:
-            self.scroll_x = max(x - (self.cols / 2), 0)
+        if col < self.scroll_x or col >= self.scroll_x + self.cols:
+            self.scroll_x = max(col - (self.cols / 2), 0)
             changed = True
 
         # Update the vertical scroll
-        if y < self.scroll_y:
-            self.scroll_y -= 1
+        if y < self.scroll_y - self.rows or y >= self.scroll_y + 2 * self.rows:
+            self.scroll_y = max(y - (self.rows / 2), 0)
+            changed = True
+        elif y < self.scroll_y:
+            self.scroll_y = y
             changed = True
         elif y >= self.scroll_y + self.rows:
-            self.scroll_y += 1
+            self.scroll_y = y - self.rows + 1
             changed = True
 
         return changed
 
-    def _update_content(self):
-        self.window.clear()
+    def _line_columns(self, y):
+        "Return the evdoc.columns.LineColumns of document line y"
+        return self.columns.get(y, self.document.lines[y])
+
+    def _column(self, y, x):
+        "Return the display column of document location (y,x)"
+        if y >= len(self.document.lines):
+            return 0
+        return self._line_columns(y).column(x)
+
+    def _offset(self, y, col):
+        "Return the offset in document line y of the character at a display column"
+        if y >= len(self.document.lines):
+            return 0
+        return self._line_columns(y).offset(col)
+
+    def _on_change(self, start, end, count):
+        "Document listener. Remember the changed lines until the next update."
+        self.damage.append((start, end, count))
+
+    def _on_repaint(self, start, end):
+        "Highlighting of lines [start, end) changed. Redraw them on the next update."
+        if self.damage:
+            # Join runs of lines whose highlighting changed
+            first, last, count = self.damage[-1]
+            if last == start and count == last - first:
+                self.damage[-1] = (first, end, end - first)
+                return
+        self.damage.append((start, end, end - start))
+
+    def set_highlighter(self, highlighter):
+        "Highlight the document with a highlighter from evdoc.highlight, or None"
+        if not (self.highlight or highlighter):
+            return
+        if self.highlight:
+            self.highlight.close()
+            self.highlight = None
+        if highlighter:
+            import evdoc.highlight
+            self.highlight = evdoc.highlight.HighlightCache(self.document,
+                highlighter, self._on_repaint)
+        self.drawn = None
+
+    def set_document(self, document):
+        '''
+        Show and edit another Document, with its cursor where it was left.
+        Highlighting and search are turned off. Does not redraw.
+        '''
+        self.close()
+        self.document = document
+        self.document.add_listener(self._on_change)
+        self.columns  = evdoc.columns.ColumnCache()
+        self.damage   = []
+        self.drawn    = None
+        self.scroll_x = 0
+        self.scroll_y = 0
+        self.update()
 
-        # Draw the last N messages, where N is the number of visible rows
-        row = 0
-        for line in self.document.lines[self.scroll_y : self.scroll_y + self.rows]:
-            substr = line[self.scroll_x : self.scroll_x + self.cols]
-            self.window.addstr(row, 0, substr)
-            row += 1
+    def close(self):
+        "Stop following changes to the document, such as before handing it to another EditBox"
+        self.set_highlighter(None)
+        self.set_search(None)
+        self.document.remove_listener(self._on_change)
+
+    def set_search(self, search):
+        "Show the matches of an evdoc.search.Search, or None"
+        if self.search is search:
+            return
+        if self.search:
+            self.search.close()
+        self.search = search
+        self.drawn = None
+
+    def find_next(self, forward=True, limit=None):
+        '''
+        Move the cursor to the next match of the search, or the previous one
+        if not `forward`. Returns the match as (y, start, end), or None. See
+        evdoc.search.Search.find() for `limit`.
+        '''
+        if not self.search:
+            return None
+        y, x = self.document.getyx()
+        match = self.search.find(y, x, forward, limit)
+        if match:
+            self.goto(match[0], match[1])
+        return match
 
-        # Update the cursor and refresh
-        self.window.noutrefresh()
-        self.set_dirty()
+    def _update_content(self):
+        '''
+        Redraw the rows of the window that have changed since the last update.
+        Rows that only moved, because lines were inserted or deleted or the
+        window was scrolled by less than a page, are shifted with insdelln()
+        and scroll(), so curses can use the terminal's own line insert, delete
+        and scroll operations. Everything is redrawn after a resize or a
+        horizontal scroll, or when the view jumps by a page or more.
+        '''
+        damage = self.damage
+        self.damage = []
+
+        rows = set()
+        full = (self.drawn is None or self.drawn[1] != self.scroll_x or
+            abs(self.scroll_y - self.drawn[0]) >= self.rows)
+
+        # Bring the window up to date with the document, in the scroll
+        # position it was last drawn at
+        if not full:
+            for start, end, count in damage:
+                full = self._apply_change(rows, start - self.drawn[0],
+                    end - start, count)
+                if full:
+                    break
+
+        # Then scroll it to the new position
+        if not full and self.scroll_y != self.drawn[0]:
+            self._scroll_rows(rows, self.scroll_y - self.drawn[0])
+
+        if full:
+            self.window.erase()
+            rows = xrange(self.rows)
+        self._draw_rows(sorted(rows))
+        self.drawn = (self.scroll_y, self.scroll_x)
+
+        # Redraw, if anything changed on screen
+        if full or rows:
+            self.set_dirty()
+
+    def _apply_change(self, rows, top, old_count, new_count):
+        '''
+        Update the window for `old_count` lines at window row `top` being
+        replaced by `new_count` lines. Rows below the change are shifted, and
+        the rows that need drawing are added to the `rows` set, whose rows are
+        shifted as well. Returns true if the whole window must be redrawn
+        instead.
+        '''
+        delta = new_count - old_count
+        if top + old_count <= 0:
+            # Lines inserted or deleted above the window only change which
+            # document lines are drawn, not what the window shows
+            self.drawn = (self.drawn[0] + delta, self.drawn[1])
+            return False
+        if top < 0:
+            if delta:
+                return True
+            rows.update(xrange(0, min(top + new_count, self.rows)))
+            return False
+        if top >= self.rows:
+            return False
+
+        below = top + min(old_count, new_count)
+        if delta and below < self.rows and abs(delta) >= self.rows - below:
+            # Everything below the change shifts out of the window
+            rows.update(xrange(below, self.rows))
+        elif delta and below < self.rows:
+            self.window.move(below, 0)
+            self.window.insdelln(delta)
+            shifted = [r + delta for r in rows if r >= below and
+                (delta > 0 or r >= below - delta)]
+            rows.difference_update([r for r in rows if r >= below])
+            rows.update(r for r in shifted if r < self.rows)
+            if delta < 0:
+                rows.update(xrange(max(below, self.rows + delta), self.rows))
+        rows.update(xrange(top, min(top + new_count, self.rows)))
+        return False
+
+    def _scroll_rows(self, rows, delta):
+        '''
+        Scroll the contents of the window by `delta` rows, and add the rows
+        that scrolled into view to the `rows` set, whose rows are shifted.
+        '''
+        self.window.scrollok(1)
+        self.window.scroll(delta)
+        self.window.scrollok(0)
+        shifted = [r - delta for r in rows]
+        rows.clear()
+        rows.update(r for r in shifted if 0 <= r < self.rows)
+        if delta > 0:
+            rows.update(xrange(self.rows - delta, self.rows))
+        else:
+            rows.update(xrange(0, -delta))
+
+    def _draw_rows(self, rows):
+        "Draw the given rows of the window"
+        count = len(self.document.lines)
+        if self.search and rows:
+            # Find the matches on screen in one go
+            self.search.scan(self.scroll_y + min(rows),
+                self.scroll_y + max(rows) + 1)
+        for row in rows:
+            self.window.move(row, 0)
+            self.window.clrtoeol()
+            y = self.scroll_y + row
+            if y < count:
+                columns = self._line_columns(y)
+                substr = columns.render(self.scroll_x, self.cols)
+                try:
+                    self.window.addstr(row, 0, substr)
+                except curses.error:
+                    # Writing the bottom-right cell moves the cursor off the
+                    # window, which curses reports as an error
+                    pass
+                if self.highlight:
+                    self._draw_spans(row, y, columns)
+                if self.search:
+                    self._draw_matches(row, y, columns)
+
+    def _span_cells(self, columns, start, end):
+        "Return the window columns [start, end) that show a span of a line"
+        start = max(columns.column(start) - self.scroll_x, 0)
+        end = min(columns.column(end) - self.scroll_x, self.cols)
+        return start, end
+
+    def _draw_spans(self, row, y, columns):
+        "Apply the highlighting of document line y to a row of the window"
+        for start, end, style in self.highlight.spans(y):
+            start, end = self._span_cells(columns, start, end)
+            if start < end:
+                self.window.chgat(row, start, end - start,
+                    STYLE_ATTRS.get(style, curses.A_NORMAL))
+
+    def _draw_matches(self, row, y, columns):
+        "Show the search matches in document line y on a row of the window"
+        for start, end in self.search.spans(y):
+            start, end = self._span_cells(columns, start, end)
+            if start < end:
+                self.window.chgat(row, start, end - start,
+                    STYLE_ATTRS.get('match', curses.A_REVERSE))
 
     def _update_cursor(self):
         '''
@@ -261,12 +637,15 @@ class EditBox(AppWindow):
         has been updated.
         '''
         y, x = self.document.getyx()
-        self.window.move(y - self.scroll_y, x - self.scroll_x)
+        old = self.window.getyx()
+        self.window.move(y - self.scroll_y, self._column(y, x) - self.scroll_x)
+        if self.window.getyx() != old:
+            self.set_dirty()
 
     def _resize(self, rows, cols, start_row, start_col):
         '''
         Update the window size. The window will not be redrawn until
-        curses.doupdate() is called.
+        redraw() is called.
         '''
         changed = False
 
@@ -274,6 +653,7 @@ class EditBox(AppWindow):
             self.rows = rows
             self.cols = cols
             self.window.resize(rows, cols)
+            self.drawn = None
             changed = True
 
         if self.start_row != start_row or self.start_col != start_col:
@@ -289,20 +669,79 @@ class EditBox(AppWindow):
         "Clear the editbox of all contents and redraw it"
         self.document.clear()
         self.window.clear()
+        self.drawn = None
         self.redraw()   #TODO: do not redraw automatically (?)
 
+    def load(self, filename, lines=None):
+        "Load a file into the editbox. Does not redraw. See Document.load()."
+        self.document.load(filename, lines)
+        self.scroll_x = 0
+        self.scroll_y = 0
+        self.update()
+
     def contents(self):
         "Get the contents of the EditBox, as a string"
         return "\n".join(self.document.lines)
 
     def getch(self):
-        "Get a single character from the user"
+        "Get a single character from the user, or -1 if none is waiting"
         return self.window.getch()
 
+    def idle(self):
+        '''
+        Do a slice of the work left for when the user is idle, which is
+        highlighting the rest of the document, then finding the rest of the
+        search matches, nearest to the view first. Returns true if there is
+        more.
+        '''
+        if self.highlight and self.highlight.pending():
+            self.highlight.highlight_pending()
+            self.update()
+        elif self.search and not self.search.done():
+            self.search.center = self.scroll_y
+            self.search.scan_pending()
+        return bool(self.highlight and self.highlight.pending() or
+            self.search and not self.search.done())
+
+    @staticmethod
+    def _is_text(c):
+        "Return true if key c is part of text to insert, including bytes of UTF-8 characters"
+        return (c in (curses.ascii.LF, curses.ascii.TAB) or
+            curses.ascii.isprint(c) or 0x80 <= c <= 0xff)
+
+    def _read_burst(self, c):
+        '''
+        Collect the characters of text that are already waiting after the
+        character c, and return them as a string. Pasting into the terminal
+        delivers its text this way. The first key that is not part
+        of the text is pushed back for the next read_key().
+        '''
+        chars = [chr(c)]
+        while True:
+            c = self.getch()
+            if c == -1:
+                break
+            if c in self.TERMINATORS or not self._is_text(c):
+                curses.ungetch(c)
+                break
+            chars.append(chr(c))
+        return ''.join(chars)
+
+    def read_key(self):
+        "Return the next key that is waiting, or -1 if there is none"
+        # Curses refreshes a window that changed before reading from it, so
+        # copy it to the virtual screen to leave drawing to the scheduler
+        self.window.noutrefresh()
+        return self.getch()
+
     def addch(self, c):
         "Append a character to the editor. Does not redraw."
         self.document.addch(c)
 
+    def addstr(self, str):
+        "Append a string to the editor. Does not redraw."
+        self.document.addstr(str)
+
     def backspace(self):
         "Delete the character to the left of the cursor. Does not redraw."
         self.document.backspace()
@@ -311,25 +750,90 @@ class EditBox(AppWindow):
         "Delete the character at the cursor. Does not redraw."
         self.document.delete()
 
+    def undo(self):
+        "Undo the last edit, and redraw. Returns false if there was none."
+        done = self.document.undo()
+        self.update()
+        return done
+
+    def redo(self):
+        "Redo the last edit that was undone, and redraw. Returns false if there was none."
+        done = self.document.redo()
+        self.update()
+        return done
+
     def focus(self):
         "Move focus to this window"
+        if self.scheduler:
+            self.scheduler.focus(self)
         self.redraw()
 
     def redraw_current_line(self):
         "Redraw the current line"
-        y, x = self.window.getyx()
-        line = self.document.lines[y]
-        substr = line[self.scroll_x : self.scroll_x + self.cols]
-        self.window.addstr(y, 0, substr)
-        self.window.redrawln(y, 0)
-        self.window.move(y, x)
+        y, x = self.document.getyx()
+        self.redraw_lines(y, y+1)
+
+    def redraw_lines(self, start, end):
+        '''
+        Redraw the lines of the document in the range [start, end) that are in
+        view. The window will not be redrawn until redraw() is called.
+        '''
+        win_y, win_x = self.window.getyx()
+        first = max(start - self.scroll_y, 0)
+        last = min(end - self.scroll_y, self.rows)
+        self._draw_rows(xrange(first, last))
+        self.window.move(win_y, win_x)
+        self.set_dirty()
+
+    def _move_to_line(self, y):
+        "Move the cursor to line y, keeping it in the same display column"
+        old_y, x = self.document.getyx()
+        col = self._column(old_y, x)
+        y = max(0, min(y, self.document.max_y()))
+        self.document.move(y, self._offset(y, col))
 
     def move_up(self):
-        self.document.move_up()
+        y, x = self.document.getyx()
+        if y == 0:
+            self.document.move_up()
+        else:
+            self._move_to_line(y - 1)
+        self.update()
+
+    def page_up(self):
+        "Move the cursor and the view up by one page"
+        y, x = self.document.getyx()
+        self.scroll_y = max(self.scroll_y - self.rows, 0)
+        self._move_to_line(y - self.rows)
+        self.update()
+
+    def page_down(self):
+        "Move the cursor and the view down by one page"
+        y, x = self.document.getyx()
+        last_page = max(len(self.document.lines) - self.rows, 0)
+        self.scroll_y = min(self.scroll_y + self.rows, last_page)
+        self._move_to_line(y + self.rows)
+        self.update()
+
+    def goto(self, y, x=0):
+        "Move the cursor to the given location, centering it if it is far away"
+        self.document.move(y, x)
         self.update()
 
+    def click(self, screen_y, screen_x):
+        "Move the cursor to the document location shown at a screen location"
+        if self.window.enclose(screen_y, screen_x):
+            begin_y, begin_x = self.window.getbegyx()
+            y = min(self.scroll_y + screen_y - begin_y,
+                self.document.max_y())
+            self.goto(y, self._offset(y, self.scroll_x + screen_x - begin_x))
+
     def move_down(self):
-        self.document.move_down()
+        y, x = self.document.getyx()
+        if y == self.document.max_y():
+            self.document.move_down()
+        else:
+            self._move_to_line(y + 1)
         self.update()
 
     def move_left(self):
@@ -340,64 +844,67 @@ class EditBox(AppWindow):
         self.document.move_right()
         self.update()
 
-    def edit(self, terminators=[curses.ascii.ESC]):
+    def handle_key(self, c):
         '''
-        Collect input keystrokes from the user. When a given terminator character
-        is received, stop and return it.
-        - Always ignores the Escape character.
-        - Always returns a KEY_RESIZE character.
+        Act on a key read with read_key(). Returns the key if it is one of
+        the TERMINATORS or KEY_RESIZE, which are left to the caller, and
+        otherwise None. The window will not be redrawn until redraw() is
+        called.
         '''
-        while True:
-            # Get input
-            c = self.getch()
-
-            if c in terminators:
-                return c
-            if c == curses.KEY_RESIZE:
-                return c
-
-            # Take action
-            if c == curses.ascii.LF:
+        if c in self.TERMINATORS or c == curses.KEY_RESIZE:
+            return c
+
+        # Take action. Text that arrives in a burst, such as a paste, is
+        # inserted and drawn all at once.
+        if self._is_text(c):
+            text = self._read_burst(c)
+            if "\n" in text:
                 self.scroll_x = 0
-                self.addch(c)
-                self.update()
-            elif c == curses.ascii.TAB:
-                pass
-            elif curses.ascii.isprint(c):
-                self.addch(c)
-                self.update()
-            elif c == curses.KEY_UP:
-                self.move_up()
-            elif c == curses.KEY_DOWN:
-                self.move_down()
-            elif c == curses.KEY_LEFT:
-                self.move_left()
-            elif c == curses.KEY_RIGHT:
-                self.move_right()
-            elif c == curses.ascii.DEL:
-                self.backspace()
-                self.update()
-            elif c == curses.KEY_DC:
-                self.delete()
-                self.update()
-            elif c == curses.KEY_MOUSE:
-                id, x, y, z, bstate = curses.getmouse()
-                self.logger.log("Mouse event: id=%d, x=%d, y=%d, z=%d, bstate=%d" %
-                    (id, x, y, z, bstate))
-
-            # Run the on_char callback
-            if self.on_char:
-                self.on_char(self.on_char_arg)
-
-            # Redraw the window if dirty
-            if self.is_dirty():
-                self.redraw()
-
-            # Debug output
-            win_y, win_x = self.window.getyx()
-            doc_y, doc_x = self.document.getyx()
-            self.logger.log("doc: (%d, %d)  win: (%d, %d) scroll: (%d, %d) dims: (%d, %d)" %
-                (doc_y, doc_x, win_y, win_x, self.scroll_y, self.scroll_x, self.rows, self.cols))
+            self.addstr(text)
+            self.update()
+        elif c == curses.KEY_UP:
+            self.move_up()
+        elif c == curses.KEY_DOWN:
+            self.move_down()
+        elif c == curses.KEY_LEFT:
+            self.move_left()
+        elif c == curses.KEY_RIGHT:
+            self.move_right()
+        elif c == curses.KEY_PPAGE:
+            self.page_up()
+        elif c == curses.KEY_NPAGE:
+            self.page_down()
+        elif c == curses.ascii.DEL:
+            self.backspace()
+            self.update()
+        elif c == curses.KEY_DC:
+            self.delete()
+            self.update()
+        elif c == curses.ascii.US:      # Ctrl-_
+            self.undo()
+        elif c == curses.ascii.DC2:     # Ctrl-R
+            self.redo()
+        elif c == curses.ascii.SO:      # Ctrl-N
+            self.find_next()
+        elif c == curses.ascii.DLE:     # Ctrl-P
+            self.find_next(forward=False)
+        elif c == curses.KEY_MOUSE:
+            id, x, y, z, bstate = curses.getmouse()
+            self.logger.debug("Mouse event: id=%d, x=%d, y=%d, z=%d, bstate=%d",
+                id, x, y, z, bstate)
+            if bstate & (curses.BUTTON1_CLICKED | curses.BUTTON1_PRESSED):
+                self.click(y, x)
+
+        # Run the on_char callback
+        if self.on_char:
+            self.on_char(self.on_char_arg)
+
+        # Debug output
+        win_y, win_x = self.window.getyx()
+        doc_y, doc_x = self.document.getyx()
+        self.logger.debug("doc: (%d, %d)  win: (%d, %d) scroll: (%d, %d) dims: (%d, %d)",
+            doc_y, doc_x, win_y, win_x, self.scroll_y, self.scroll_x, self.rows, self.cols)
+        return None
 
 #==============================================================================
 # The Editor class displays the document
@@ -427,6 +934,8 @@ class Editor(EditBox):
 #==============================================================================
 
 class Prompt(EditBox):
+    TERMINATORS = (curses.ascii.ESC, curses.ascii.LF)
+
     def __init__(self, layout, logger=None):
         self.layout = layout
         super(evdoc.ui.Prompt, self).__init__(
@@ -444,7 +953,3 @@ class Prompt(EditBox):
             layout.prompt_cols,
             layout.prompt_start_row,
             layout.prompt_start_col)
-
-    def edit(self):
-        "Get user input from the prompt. Returns the terminator character typed."
-        return super(Prompt, self).edit([curses.ascii.ESC, curses.ascii.LF])
@@ -0,0 +1,139 @@
+import collections
+
+#==============================================================================
+# Undo history for a Document. Each change is recorded as the lines it
+# replaced and the lines that replaced them, so undoing or redoing it costs
+# no more than the change itself. With the rope storage engine the replaced
+# lines share the nodes of the document they came from.
+#==============================================================================
+
+def _size(lines):
+    "Return the approximate number of bytes held by a sequence of lines"
+    if isinstance(lines, list):
+        return sum(len(line) + 1 for line in lines)
+    return sum(len(text) + 1 for text, count in lines.iter_blocks())
+
+class Step(object):
+    '''
+    One undoable step: the changes made by one edit, as a list of tuples of
+    (start, old lines, new lines), and the cursor before and after it.
+    '''
+    __slots__ = ('kind', 'changes', 'before', 'after', 'size')
+
+    def __init__(self, kind, before):
+        self.kind    = kind
+        self.changes = []
+        self.before  = before
+        self.after   = before
+        self.size    = 0
+
+    def merge(self, other):
+        '''
+        Merge a later step into this one, if both are the same kind of edit
+        to a single line and the second one continues where the first one
+        left off, as when typing a word. Returns true if merged.
+        '''
+        if (self.kind is None or other.kind != self.kind or
+                len(self.changes) != 1 or len(other.changes) != 1 or
+                self.after != other.before):
+            return False
+        start, old, new = self.changes[0]
+        other_start, other_old, other_new = other.changes[0]
+        if not (start == other_start and len(old) == len(new) == 1 and
+                len(other_old) == len(other_new) == 1):
+            return False
+        self.changes[0] = (start, old, other_new)
+        self.after = other.after
+        self.size = _size(old) + _size(other_new)
+        return True
+
+class History(object):
+    '''
+    The undo and redo stacks of a document. Edits are grouped into steps
+    between begin() and end() calls, which may be nested. The text held by
+    the steps is limited to about `limit` bytes; the oldest steps are
+    dropped to stay under it.
+    '''
+    def __init__(self, limit):
+        self.limit   = limit
+        self.undos   = collections.deque()
+        self.redos   = []
+        self.size    = 0        # Bytes held by all steps
+        self.depth   = 0        # Nesting of begin() calls
+        self.step    = None     # The step being recorded
+        self.sealed  = True     # Do not merge with the last step
+
+    def clear(self):
+        "Forget all steps"
+        self.undos.clear()
+        self.redos = []
+        self.size = 0
+        self.sealed = True
+
+    def begin(self, kind, cursor):
+        '''
+        Start a step, at the given cursor location. Steps of the same kind,
+        which is a name such as 'insert', or None, may be merged.
+        '''
+        self.depth += 1
+        if self.depth == 1:
+            self.step = Step(kind, cursor)
+
+    def record(self, start, old, new):
+        '''
+        Record that the lines `old` starting at line `start` were replaced by
+        `new`, as part of the step started by begin()
+        '''
+        assert self.step is not None, "change recorded outside of a step"
+        self.step.changes.append((start, old, new))
+        self.step.size += _size(old) + _size(new)
+
+    def end(self, cursor):
+        "End a step, at the given cursor location"
+        self.depth -= 1
+        if self.depth > 0:
+            return
+        step = self.step
+        self.step = None
+        if not step.changes:
+            return
+        step.after = cursor
+
+        for redo in self.redos:
+            self.size -= redo.size
+        self.redos = []
+
+        if not self.sealed and self.undos:
+            last = self.undos[-1]
+            old_size = last.size
+            if last.merge(step):
+                self.size += last.size - old_size
+                self._trim()
+                return
+        self.undos.append(step)
+        self.size += step.size
+        self.sealed = False
+        self._trim()
+
+    def _trim(self):
+        "Drop the oldest steps until the history fits in its limit"
+        while self.size > self.limit and self.undos:
+            self.size -= self.undos.popleft().size
+
+    def undo(self):
+        "Return the step to undo, moving it to the redo stack, or None"
+        if not self.undos:
+            return None
+        step = self.undos.pop()
+        self.redos.append(step)
+        self.sealed = True
+        return step
+
+    def redo(self):
+        "Return the step to redo, moving it to the undo stack, or None"
+        if not self.redos:
+            return None
+        step = self.redos.pop()
+        self.undos.append(step)
+        self.sealed = True
+        return step